@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Benchmark harness for the Telegram CRM service.
+
+Drives the client layer and the FastAPI app against the in-process fake
+Telegram backend (tests/fake_telegram.py), so no live account is needed.
+Reports p50/p99 latency, throughput and peak Python memory per scenario and
+can save the results as JSON to compare revisions:
+
+    python benchmark.py --dialogs 10000 --output before.json
+    python benchmark.py --dialogs 10000 --compare before.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+os.environ.setdefault('TELEGRAM_API_ID', '1')
+os.environ.setdefault('TELEGRAM_API_HASH', 'benchmark')
+os.environ.setdefault('TELEGRAM_PHONE_NUMBER', '+10000000000')
+
+import httpx
+
+from telegram_client.client import TelegramConversationClient
+from telegram_client.models import dispose_engines
+from telegram_client.pool import Account, ClientPool
+from telegram_client.store import MessageStore
+from tests.fake_telegram import FakeTelegramClient
+
+MEMORY_SAMPLE_CALLS = 20
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+async def run_calls(operation, requests, concurrency):
+    """Run operation() `requests` times with bounded concurrency; return (latencies, errors, seconds)"""
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(index):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await operation(index)
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[one(index) for index in range(requests)])
+    return latencies, errors, time.perf_counter() - started
+
+async def measure(operation, requests, concurrency):
+    """Timed pass without tracing, then a short pass under tracemalloc for peak memory"""
+    latencies, errors, seconds = await run_calls(operation, requests, concurrency)
+
+    tracemalloc.start()
+    try:
+        await run_calls(operation, min(requests, MEMORY_SAMPLE_CALLS), concurrency)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+        'throughput_rps': round(requests / seconds, 1),
+        'peak_memory_mb': round(peak / (1024 * 1024), 2)
+    }
+
+def make_fake(args):
+    return FakeTelegramClient(dialogs=args.dialogs, history=args.history, latency=args.latency,
+                              flood_every=args.flood_every, flood_seconds=args.flood_seconds)
+
+async def client_scenarios(args):
+    fake = make_fake(args)
+    client = TelegramConversationClient(telegram_client=fake)
+    chat_ids = [str(chat_id) for chat_id in fake.chat_ids()]
+    rng = random.Random(args.seed)
+
+    async def get_messages_page(_):
+        before_id = rng.randint(args.page_size, args.history) if rng.random() < 0.5 else None
+        await client.get_messages_page(rng.choice(chat_ids), args.page_size, before_id=before_id)
+
+    results = {
+        'client.get_chats': await measure(lambda _: client.get_chats(), args.chat_list_requests, 1),
+        'client.get_messages_page': await measure(get_messages_page, args.requests, args.concurrency),
+    }
+    results['client.get_chats']['rpc_calls'] = dict(fake.calls)
+    return results
+
+async def api_scenarios(args, workdir):
+    from telegram_api import main
+
+    fake = make_fake(args)
+    client = TelegramConversationClient(telegram_client=fake)
+    store = MessageStore(f"sqlite:///{os.path.join(workdir, 'benchmark.db')}")
+    pool = ClientPool([Account('Telegram', client, store)])
+    await pool.start()
+    await pool.wait_connected()
+    main.client_pool = pool
+    chat_ids = [str(chat_id) for chat_id in fake.chat_ids()]
+    rng = random.Random(args.seed)
+
+    transport = httpx.ASGITransport(app=main.app)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url='http://benchmark') as http:
+            async def get(url, ok=(200,)):
+                response = await http.get(url)
+                if response.status_code not in ok:
+                    raise RuntimeError(f"{url}: {response.status_code}")
+
+            etag = (await http.get('/api/chats')).headers.get('etag')
+
+            async def conditional_chats(_):
+                response = await http.get('/api/chats', headers={'If-None-Match': etag})
+                if response.status_code != 304:
+                    raise RuntimeError(f"/api/chats: {response.status_code}")
+
+            # Half of the history requests hit a small set of hot chats to exercise the local store
+            hot_chats = chat_ids[:max(1, len(chat_ids) // 100)]
+
+            async def messages(_):
+                chat_id = rng.choice(hot_chats if rng.random() < 0.5 else chat_ids)
+                await get(f'/api/chats/{chat_id}/messages?limit={args.page_size}')
+
+            results = {
+                'api.GET /api/chats': await measure(lambda _: get('/api/chats'), args.requests, args.concurrency),
+                'api.GET /api/chats (304)': await measure(conditional_chats, args.requests, args.concurrency),
+                'api.GET /api/inbox': await measure(lambda _: get('/api/inbox'), args.requests, args.concurrency),
+                'api.GET /api/chats/{chat_id}/messages': await measure(messages, args.requests, args.concurrency),
+            }
+            results['api.GET /api/chats/{chat_id}/messages']['rpc_calls'] = dict(fake.calls)
+            return results
+    finally:
+        main.client_pool = None
+        await pool.stop()
+        await dispose_engines()
+
+def revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(report, baseline=None):
+    previous = (baseline or {}).get('results', {})
+    print(f"{'scenario':<42} {'p50 ms':>10} {'p99 ms':>10} {'req/s':>10} {'peak MB':>9} {'errors':>7}")
+    for name, result in report['results'].items():
+        line = (f"{name:<42} {result['p50_ms']:>10} {result['p99_ms']:>10} "
+                f"{result['throughput_rps']:>10} {result['peak_memory_mb']:>9} {result['errors']:>7}")
+        old = previous.get(name)
+        if old:
+            changes = []
+            for key, label in (('p50_ms', 'p50'), ('p99_ms', 'p99'), ('throughput_rps', 'req/s')):
+                if old[key]:
+                    changes.append(f"{label} {100.0 * (result[key] - old[key]) / old[key]:+.1f}%")
+            line += '   ' + ', '.join(changes)
+        print(line)
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix='tatargram-benchmark-')
+    try:
+        results = {}
+        if args.scenarios in ('all', 'client'):
+            results.update(await client_scenarios(args))
+        if args.scenarios in ('all', 'api'):
+            results.update(await api_scenarios(args, workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'revision': revision(),
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'results': results
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the service against a fake Telegram backend")
+    parser.add_argument('--scenarios', choices=('all', 'client', 'api'), default='all')
+    parser.add_argument('--dialogs', type=int, default=10000, help="dialogs in the fake account")
+    parser.add_argument('--history', type=int, default=5000, help="messages per chat")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every fake RPC")
+    parser.add_argument('--flood-every', type=int, default=0, help="raise FloodWait on every Nth RPC")
+    parser.add_argument('--flood-seconds', type=int, default=30)
+    parser.add_argument('--requests', type=int, default=200, help="requests per scenario")
+    parser.add_argument('--chat-list-requests', type=int, default=5, help="full get_chats calls")
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="save results as JSON")
+    parser.add_argument('--compare', help="JSON results of a previous run to compare against")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    report = asyncio.run(run(args))
+    print_results(report, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results saved to {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
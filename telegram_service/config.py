@@ -2,6 +2,7 @@
 Конфигурация для сервиса Telegram
 """
 import os
+import json
 from dotenv import load_dotenv
 
 # Загрузка переменных окружения
@@ -26,6 +27,38 @@ class Config:
     # Безопасность
     SECRET_KEY = os.getenv('SECRET_KEY', 'telegram-crm-secret-key')
     
+    # Несколько аккаунтов: JSON-файл со списком
+    # [{"name", "phone_number", "session", "api_id", "api_hash", "database_url"}, ...]
+    TELEGRAM_ACCOUNTS_FILE = os.getenv('TELEGRAM_ACCOUNTS_FILE')
+    
+    # Unix-сокет процесса-владельца подключения (python -m telegram_api.owner);
+    # если задан, процессы API не подключаются к Telegram сами и могут работать в несколько воркеров
+    TELEGRAM_OWNER_SOCKET = os.getenv('TELEGRAM_OWNER_SOCKET')
+    
+    @classmethod
+    def accounts(cls):
+        """Список аккаунтов; без TELEGRAM_ACCOUNTS_FILE - один аккаунт из переменных окружения"""
+        default = {
+            'name': 'Telegram',
+            'phone_number': cls.TELEGRAM_PHONE_NUMBER,
+            'session': cls.SESSION_FILE,
+            'api_id': cls.TELEGRAM_API_ID,
+            'api_hash': cls.TELEGRAM_API_HASH,
+            'database_url': cls.DATABASE_URL
+        }
+        if not cls.TELEGRAM_ACCOUNTS_FILE:
+            return [default]
+        
+        with open(cls.TELEGRAM_ACCOUNTS_FILE, encoding='utf-8') as f:
+            entries = json.load(f)
+        accounts = []
+        for entry in entries:
+            account = dict(default, session=f"telegram_session_{entry['name']}")
+            account['database_url'] = account_database_url(cls.DATABASE_URL, entry['name'])
+            account.update({key: value for key, value in entry.items() if value})
+            accounts.append(account)
+        return accounts
+    
     @classmethod
     def validate(cls):
         """Проверка обязательной конфигурации"""
@@ -37,10 +70,23 @@ class Config:
         if not cls.TELEGRAM_API_HASH:
             errors.append("TELEGRAM_API_HASH обязателен")
             
-        if not cls.TELEGRAM_PHONE_NUMBER:
+        if not cls.TELEGRAM_PHONE_NUMBER and not cls.TELEGRAM_ACCOUNTS_FILE:
             errors.append("TELEGRAM_PHONE_NUMBER обязателен")
+        
+        if cls.TELEGRAM_ACCOUNTS_FILE and not os.path.exists(cls.TELEGRAM_ACCOUNTS_FILE):
+            errors.append(f"Файл аккаунтов {cls.TELEGRAM_ACCOUNTS_FILE} не найден")
             
         return errors
 
+def account_database_url(database_url, account_name):
+    """
+    Отдельная база SQLite для аккаунта: id личных чатов и сообщений
+    уникальны только в пределах аккаунта (telegram.db -> telegram_<name>.db)
+    """
+    if not database_url.startswith('sqlite'):
+        return database_url
+    root, ext = os.path.splitext(database_url)
+    return f"{root}_{account_name}{ext or '.db'}"
+
 # Создание экземпляра конфигурации
 config = Config()
\ No newline at end of file
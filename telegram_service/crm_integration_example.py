@@ -2,9 +2,15 @@
 Example script showing how to integrate Telegram service with existing CRM
 This would be added to the CRM codebase
 """
+import asyncio
+import time
+from collections import OrderedDict
+import aiohttp
 import requests
 import json
-from typing import List, Dict
+from typing import AsyncIterator, Dict, Iterable, List, Optional
+# Dependency-free module; copy it into the CRM codebase together with this example
+from telegram_client.merge import encode_cursor, merge_newest_first, newest_first_key
 
 class TelegramCRMIntegration:
     def __init__(self, telegram_service_url: str = "http://localhost:8001"):
@@ -26,12 +32,15 @@ class TelegramCRMIntegration:
             print(f"Exception fetching Telegram chats: {e}")
             return []
             
-    def get_telegram_messages(self, chat_id: str, offset: int = 0, limit: int = 50) -> Dict:
+    def get_telegram_messages(self, chat_id: str, before_id: str = None, limit: int = 50) -> Dict:
         """
-        Fetch Telegram messages for a specific chat
+        Fetch Telegram messages for a specific chat.
+        Pass the previous response's next_cursor as before_id to page back.
         """
         try:
-            params = {"offset": offset, "limit": limit}
+            params = {"limit": limit}
+            if before_id:
+                params["before_id"] = before_id
             response = requests.get(f"{self.service_url}/api/chats/{chat_id}/messages", params=params)
             if response.status_code == 200:
                 return response.json()
@@ -44,12 +53,13 @@ class TelegramCRMIntegration:
             
     def send_telegram_message(self, chat_id: str, text: str) -> bool:
         """
-        Send a message to a Telegram chat
+        Queue a message to a Telegram chat.
+        Delivery status is available at /api/outbox/{job_id}.
         """
         try:
             payload = {"text": text}
             response = requests.post(f"{self.service_url}/api/chats/{chat_id}/messages", json=payload)
-            return response.status_code == 200
+            return response.status_code == 202
         except Exception as e:
             print(f"Exception sending Telegram message: {e}")
             return False
@@ -67,11 +77,169 @@ class TelegramCRMIntegration:
         # Combine CRM and Telegram chats
         all_chats = crm_chats + telegram_chats
         
-        # Sort by last message date (newest first)
-        all_chats.sort(key=lambda x: x.get("last_message_date", ""), reverse=True)
+        # Sort by parsed last message date (newest first, chats without a date last)
+        all_chats.sort(key=newest_first_key)
         
         return all_chats
 
+class AsyncTelegramCRMIntegration:
+    """
+    Asyncio client for CRM backends that fan out to many chats per page render.
+
+    One keep-alive HTTP session is reused for every request, so connections
+    are set up once instead of per call. Requests for many chats run
+    concurrently, at most `concurrency` at a time. Responses are kept in a
+    local cache: within `cache_ttl` seconds they are served without a
+    request, after that they are revalidated with If-None-Match and a
+    304 Not Modified reuses the cached body.
+
+        async with AsyncTelegramCRMIntegration("http://localhost:8001") as telegram_crm:
+            pages = await telegram_crm.get_messages_for_chats(["123", "456"])
+    """
+
+    def __init__(self, telegram_service_url: str = "http://localhost:8001", concurrency: int = 10,
+                 cache_ttl: float = 5.0, cache_size: int = 1000, timeout: float = 30.0):
+        self.service_url = telegram_service_url.rstrip("/")
+        self.concurrency = concurrency
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.timeout = timeout
+        self._semaphore = None
+        self._cache = OrderedDict()  # key -> (fetched_at, etag, data)
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def _limit(self) -> asyncio.Semaphore:
+        # Created lazily so the semaphore belongs to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _get_json(self, path: str, params: Optional[Dict] = None) -> Dict:
+        """GET with the local cache and conditional revalidation"""
+        params = {key: str(value) for key, value in (params or {}).items() if value is not None}
+        key = path + "?" + "&".join(f"{name}={value}" for name, value in sorted(params.items()))
+        cached = self._cache.get(key)
+        if cached and time.monotonic() - cached[0] < self.cache_ttl:
+            self._cache.move_to_end(key)
+            return cached[2]
+
+        headers = {"If-None-Match": cached[1]} if cached and cached[1] else {}
+        async with self._limit():
+            async with self._get_session().get(self.service_url + path, params=params,
+                                               headers=headers) as response:
+                if response.status == 304 and cached:
+                    data, etag = cached[2], cached[1]
+                else:
+                    response.raise_for_status()
+                    data, etag = await response.json(), response.headers.get("ETag")
+
+        self._cache[key] = (time.monotonic(), etag, data)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return data
+
+    async def get_telegram_chats(self) -> List[Dict]:
+        """Fetch Telegram chats in the CRM format"""
+        try:
+            data = await self._get_json("/api/chats")
+            return data.get("chats", [])
+        except Exception as e:
+            print(f"Exception fetching Telegram chats: {e}")
+            return []
+
+    async def get_telegram_messages(self, chat_id: str, before_id: str = None, limit: int = 50) -> Dict:
+        """Fetch one page of a chat; pass next_cursor as before_id to page back"""
+        try:
+            return await self._get_json(f"/api/chats/{chat_id}/messages",
+                                        {"limit": limit, "before_id": before_id})
+        except Exception as e:
+            print(f"Exception fetching Telegram messages for chat {chat_id}: {e}")
+            return {"messages": [], "totalCount": 0}
+
+    async def get_messages_for_chats(self, chat_ids: Iterable[str], limit: int = 50) -> Dict[str, Dict]:
+        """Fetch the latest page of many chats concurrently: {chat_id: page}"""
+        chat_ids = list(dict.fromkeys(str(chat_id) for chat_id in chat_ids))
+        pages = await asyncio.gather(*[self.get_telegram_messages(chat_id, limit=limit) for chat_id in chat_ids])
+        return dict(zip(chat_ids, pages))
+
+    async def send_telegram_message(self, chat_id: str, text: str) -> Optional[int]:
+        """Queue a message; returns the outbox job id or None"""
+        try:
+            async with self._limit():
+                async with self._get_session().post(f"{self.service_url}/api/chats/{chat_id}/messages",
+                                                    json={"text": text}) as response:
+                    if response.status != 202:
+                        return None
+                    return (await response.json()).get("job_id")
+        except Exception as e:
+            print(f"Exception sending Telegram message: {e}")
+            return None
+
+    async def iter_telegram_inbox(self, page_size: int = 100,
+                                  before_timestamp: Optional[float] = None) -> AsyncIterator[Dict]:
+        """
+        Telegram chats of all accounts, newest first, fetched page by page as they are consumed.
+        With before_timestamp the listing starts at chats last active at or before that time.
+        """
+        # The service pages /api/inbox with the same merge cursors; an empty source and id
+        # position the cursor before every chat that has this timestamp
+        cursor = encode_cursor((-before_timestamp, '', '')) if before_timestamp is not None else None
+        while True:
+            data = await self._get_json("/api/inbox", {"limit": page_size, "cursor": cursor})
+            for chat in data.get("chats", []):
+                chat["platform"] = "telegram"
+                yield chat
+            cursor = data.get("next_cursor")
+            if not cursor:
+                return
+
+    async def merged_inbox(self, sources: Dict[str, AsyncIterator[Dict]], limit: int = 50,
+                           cursor: Optional[str] = None) -> Dict:
+        """
+        One screen of the unified inbox: Telegram plus other platforms.
+
+        Each source must already be sorted newest first (for example the CRM's
+        own query with ORDER BY last_message_date DESC). Sources are merged
+        lazily, so only about `limit` chats are read from each of them.
+        Pass the returned next_cursor to get the following screen.
+        """
+        def telegram(before_timestamp):
+            # Resume at the previous screen's last chat instead of re-reading the pages before it;
+            # two extra chats (that last chat and one to compare against) keep it to one request
+            return self.iter_telegram_inbox(page_size=limit + 2, before_timestamp=before_timestamp)
+
+        page = await merge_newest_first(dict(sources, telegram=telegram), limit=limit, cursor=cursor)
+        return {"chats": page["items"], "next_cursor": page["next_cursor"]}
+
+    async def merge_with_crm_chats(self, crm_chats: List[Dict]) -> List[Dict]:
+        """Merge Telegram chats with existing CRM chats, newest first"""
+        telegram_chats = await self.get_telegram_chats()
+        for chat in telegram_chats:
+            chat["platform"] = "telegram"
+        all_chats = crm_chats + telegram_chats
+        all_chats.sort(key=newest_first_key)
+        return all_chats
+
 # Example usage (this would be integrated into the CRM frontend)
 def example_usage():
     # Initialize the integration
@@ -98,5 +266,12 @@ def example_usage():
     for chat in all_chats:
         print(f"- {chat['name']} ({chat['platform']})")
 
+async def example_dashboard(chat_ids: List[str]):
+    """Render data for a dashboard that shows many chats at once"""
+    async with AsyncTelegramCRMIntegration("http://localhost:8001", concurrency=10) as telegram_crm:
+        pages = await telegram_crm.get_messages_for_chats(chat_ids, limit=20)
+        for chat_id, page in pages.items():
+            print(f"- chat {chat_id}: {len(page['messages'])} messages")
+
 if __name__ == "__main__":
     example_usage()
\ No newline at end of file
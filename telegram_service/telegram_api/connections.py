@@ -0,0 +1,162 @@
+"""
+Рассылка событий по WebSocket с очередями на каждое соединение и подписками на чаты
+"""
+import asyncio
+import json
+import logging
+import os
+from fastapi import WebSocket
+from telegram_client import metrics
+
+logger = logging.getLogger(__name__)
+
+# Сколько неотправленных событий может накопиться у одного соединения
+WS_SEND_QUEUE_SIZE = int(os.getenv('WS_SEND_QUEUE_SIZE', 256))
+
+# Отправляется медленному клиенту вместо пропущенных событий: нужно перечитать данные
+RESYNC_MESSAGE = json.dumps({'type': 'resync'})
+
+class Connection:
+    __slots__ = ('websocket', 'queue', 'task', 'chat_ids', 'dropped')
+
+    def __init__(self, websocket, queue_size):
+        self.websocket = websocket
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.task = None
+        self.chat_ids = set()
+        self.dropped = 0
+
+class ConnectionManager:
+    """
+    Каждое соединение получает ограниченную очередь и отдельную задачу отправки,
+    поэтому медленный браузер не задерживает остальных. При переполнении очереди
+    накопленные события отбрасываются и клиенту отправляется {"type": "resync"}.
+
+    Соединение без подписок получает все события; после subscribe - только
+    события своих чатов (и события без chat_id).
+    """
+
+    def __init__(self, queue_size=WS_SEND_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.connections = {}        # websocket -> Connection
+        self.firehose = set()        # соединения без подписок
+        self.chat_subscribers = {}   # chat_id -> множество соединений
+
+    @property
+    def active_connections(self):
+        return list(self.connections)
+
+    async def connect(self, websocket: WebSocket):
+        await websocket.accept()
+        connection = Connection(websocket, self.queue_size)
+        self.connections[websocket] = connection
+        self.firehose.add(connection)
+        metrics.WS_CONNECTIONS.inc()
+        connection.task = asyncio.create_task(self._writer(connection))
+
+    def disconnect(self, websocket: WebSocket):
+        connection = self.connections.pop(websocket, None)
+        if connection is None:
+            return
+        metrics.WS_CONNECTIONS.dec()
+        self.firehose.discard(connection)
+        self._unsubscribe(connection, list(connection.chat_ids))
+        if connection.task and connection.task is not asyncio.current_task():
+            connection.task.cancel()
+
+    def subscribe(self, websocket: WebSocket, chat_ids):
+        """Получать только события указанных чатов"""
+        connection = self.connections.get(websocket)
+        if connection is None:
+            return
+        for chat_id in map(str, chat_ids):
+            connection.chat_ids.add(chat_id)
+            self.chat_subscribers.setdefault(chat_id, set()).add(connection)
+        if connection.chat_ids:
+            self.firehose.discard(connection)
+
+    def unsubscribe(self, websocket: WebSocket, chat_ids):
+        """Отписаться от чатов; без подписок соединение снова получает все события"""
+        connection = self.connections.get(websocket)
+        if connection is None:
+            return
+        self._unsubscribe(connection, [str(chat_id) for chat_id in chat_ids])
+        if not connection.chat_ids:
+            self.firehose.add(connection)
+
+    def _unsubscribe(self, connection, chat_ids):
+        for chat_id in chat_ids:
+            connection.chat_ids.discard(chat_id)
+            subscribers = self.chat_subscribers.get(chat_id)
+            if subscribers is not None:
+                subscribers.discard(connection)
+                if not subscribers:
+                    del self.chat_subscribers[chat_id]
+
+    async def send_personal_message(self, message: str, websocket: WebSocket):
+        connection = self.connections.get(websocket)
+        if connection is not None:
+            self._enqueue(connection, message)
+
+    async def broadcast(self, message, chat_id=None):
+        """
+        Разослать событие. message - строка или словарь; словарь сериализуется
+        один раз для всех получателей. chat_id ограничивает получателей подписчиками чата.
+        """
+        if not isinstance(message, str):
+            message = json.dumps(message, ensure_ascii=False)
+        if chat_id is None:
+            recipients = self.connections.values()
+        else:
+            recipients = self.firehose | self.chat_subscribers.get(str(chat_id), set())
+        for connection in list(recipients):
+            self._enqueue(connection, message)
+
+    def _enqueue(self, connection, message):
+        try:
+            connection.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # Медленный клиент: пропущенные события заменяются одним сигналом resync
+            connection.dropped += connection.queue.qsize()
+            while not connection.queue.empty():
+                connection.queue.get_nowait()
+            connection.queue.put_nowait(RESYNC_MESSAGE)
+            metrics.WS_RESYNCS.inc()
+            logger.warning(f"WebSocket не успевает получать события, отправлен resync "
+                           f"(всего пропущено {connection.dropped})")
+
+    async def _writer(self, connection):
+        try:
+            while True:
+                message = await connection.queue.get()
+                await connection.websocket.send_text(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.info(f"Соединение WebSocket закрыто при отправке: {e}")
+            self.disconnect(connection.websocket)
+
+    async def handle_command(self, websocket: WebSocket, data: str):
+        """
+        Обработать сообщение клиента. Поддерживаются
+        {"action": "subscribe" | "unsubscribe", "chat_ids": [...]};
+        прочий текст возвращается эхом. Возвращает True, если это была команда.
+        """
+        try:
+            command = json.loads(data)
+        except ValueError:
+            command = None
+        if not isinstance(command, dict) or command.get('action') not in ('subscribe', 'unsubscribe'):
+            await self.send_personal_message(f"Вы отправили: {data}", websocket)
+            return False
+        chat_ids = command.get('chat_ids') or []
+        if command['action'] == 'subscribe':
+            self.subscribe(websocket, chat_ids)
+        else:
+            self.unsubscribe(websocket, chat_ids)
+        connection = self.connections.get(websocket)
+        await self.send_personal_message(json.dumps({
+            'type': 'subscriptions',
+            'chat_ids': sorted(connection.chat_ids) if connection else []
+        }), websocket)
+        return True
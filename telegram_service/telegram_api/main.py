@@ -2,22 +2,56 @@
 Сервис FastAPI для предоставления бесед Telegram в формате, подобном CRM
 """
 import asyncio
-from fastapi import FastAPI, HTTPException, Depends
+import hashlib
+import json
+import logging
+import time
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from fastapi.routing import APIRoute
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 import uvicorn
 import os
 from dotenv import load_dotenv
-from telegram_client.client import TelegramConversationClient
+from telegram_client import metrics
+from telegram_client.media import MediaCache
+from telegram_api.connections import ConnectionManager
+from telegram_api.responses import FastJSONResponse
+from telegram_client.serialization import dumps, parse_fields, project
 from config import config
 from pydantic import BaseModel
+from typing import Optional
 
-# Проверка конфигурации
-config_errors = config.validate()
-if config_errors:
-    raise ValueError(f"Ошибки конфигурации: {', '.join(config_errors)}")
+class MetricsRoute(APIRoute):
+    """Маршрут, учитывающий задержку, статусы и запросы в обработке в метриках"""
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        route = self.path
+
+        async def metered_handler(request: Request):
+            # Остается установленным до конца задачи запроса, включая потоковый ответ
+            metrics.current_route.set(route)
+            metrics.HTTP_IN_FLIGHT.inc(route)
+            started = time.perf_counter()
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status_code
+                return response
+            except HTTPException as e:
+                status = e.status_code
+                raise
+            finally:
+                metrics.HTTP_IN_FLIGHT.dec(route)
+                metrics.HTTP_REQUESTS.inc(request.method, route, str(status))
+                metrics.HTTP_LATENCY.observe(request.method, route, value=time.perf_counter() - started)
+
+        return metered_handler
 
 app = FastAPI(title="Сервис Telegram CRM", version="1.0.0")
+app.router.route_class = MetricsRoute
 
 # Добавление промежуточного ПО CORS
 app.add_middleware(
@@ -32,8 +66,14 @@ app.add_middleware(
 if os.path.exists("telegram_frontend"):
     app.mount("/frontend", StaticFiles(directory="telegram_frontend", html=True), name="frontend")
 
-# Инициализация клиента Telegram
-telegram_client = None
+# Пул аккаунтов Telegram (клиент, хранилище и список чатов каждого) и кэш медиа
+client_pool = None
+media_cache = None
+# Ошибки конфигурации проверяются при запуске и отдаются в /health/ready
+config_errors = []
+startup_task = None
+
+logger = logging.getLogger(__name__)
 
 class AuthCode(BaseModel):
     code: str
@@ -43,20 +83,69 @@ class Password(BaseModel):
 
 @app.on_event("startup")
 async def startup_event():
-    global telegram_client
-    telegram_client = TelegramConversationClient()
+    """
+    Запуск не ждет Telegram: сервер начинает принимать соединения сразу,
+    хранилища и подключения поднимаются в фоновой задаче.
+    """
+    global media_cache, startup_task, config_errors
+    # Рабочему процессу при TELEGRAM_OWNER_SOCKET учетные данные Telegram не нужны
+    config_errors = [] if config.TELEGRAM_OWNER_SOCKET else config.validate()
+    if config_errors:
+        logger.error(f"Ошибки конфигурации: {', '.join(config_errors)}")
+        return
+    media_cache = MediaCache()
+    startup_task = asyncio.create_task(start_accounts())
+
+async def start_accounts():
+    global client_pool
+    # Telethon и SQLAlchemy импортируются здесь, а не при импорте модуля
     try:
-        await telegram_client.connect()
-        print("Подключено к Telegram")
+        if config.TELEGRAM_OWNER_SOCKET:
+            # Подключение к Telegram держит процесс-владелец (telegram_api/owner.py),
+            # этот процесс обращается к нему через Unix-сокет
+            from telegram_client.rpc import RemotePool
+            pool = RemotePool(config.TELEGRAM_OWNER_SOCKET)
+        else:
+            from telegram_client.pool import Account, ClientPool
+            pool = ClientPool(Account.from_config(account) for account in config.accounts())
+        await pool.start(handle_update)
     except Exception as e:
-        print(f"Не удалось подключиться к Telegram: {e}")
+        config_errors.append(str(e))
+        logger.error(f"Не удалось запустить аккаунты Telegram: {e}")
+        return
+    client_pool = pool
+    print(f"Аккаунтов Telegram: {len(client_pool)}")
+
+async def handle_update(account, delta):
+    """Записать событие Telegram в локальное хранилище и разослать его по WebSocket"""
+    try:
+        await account.record_update(delta)
+        delta['account'] = account.name
+        await manager.broadcast(delta, chat_id=delta['chat_id'])
+    except Exception as e:
+        logger.error(f"Ошибка обработки обновления {delta['type']}: {e}")
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    global telegram_client
-    if telegram_client:
-        await telegram_client.disconnect()
+    from telegram_client.models import dispose_engines
+
+    if startup_task:
+        startup_task.cancel()
+    if media_cache:
+        media_cache.close()
+    if client_pool:
+        await client_pool.stop()
         print("Отключено от Telegram")
+    await dispose_engines()
+
+def get_account(account: Optional[str] = None) -> "Account":
+    """Аккаунт из пути запроса; без имени - аккаунт по умолчанию"""
+    if not client_pool:
+        raise HTTPException(status_code=503, detail="Клиент Telegram не инициализирован")
+    selected = client_pool.get(account)
+    if selected is None:
+        raise HTTPException(status_code=404, detail=f"Аккаунт {account} не найден")
+    return selected
 
 @app.get("/")
 async def root():
@@ -64,128 +153,348 @@ async def root():
     return {"message": "Добро пожаловать в Telegram CRM API. Перейдите к /docs для документации API или к /frontend для веб-интерфейса."}
 
 @app.post("/api/auth/code")
-async def set_auth_code(auth_code: AuthCode):
+@app.post("/api/accounts/{account}/auth/code")
+async def set_auth_code(auth_code: AuthCode, account: Optional[str] = None):
     """Установить код аутентификации Telegram"""
     try:
-        if not telegram_client:
-            raise HTTPException(status_code=503, detail="Клиент Telegram не инициализирован")
+        selected = get_account(account)
+        telegram_client = selected.client
         
         telegram_client.set_auth_code(auth_code.code)
         # Попытка повторного подключения с новым кодом
         await telegram_client.connect()
+        if telegram_client.connected:
+            await selected.on_authorized()
         return {"status": "success", "message": "Код аутентификации установлен"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/auth/password")
-async def set_password(password: Password):
+@app.post("/api/accounts/{account}/auth/password")
+async def set_password(password: Password, account: Optional[str] = None):
     """Установить пароль для двухфакторной аутентификации Telegram"""
     try:
-        if not telegram_client:
-            raise HTTPException(status_code=503, detail="Клиент Telegram не инициализирован")
+        telegram_client = get_account(account).client
         
         telegram_client.set_password(password.password)
         return {"status": "success", "message": "Пароль установлен"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/api/chats")
-async def get_chats():
-    """Получить все чаты Telegram в формате CRM"""
+@app.get("/api/accounts")
+async def get_accounts():
+    """Список аккаунтов пула и их состояние"""
+    if not client_pool:
+        raise HTTPException(status_code=503, detail="Клиент Telegram не инициализирован")
+    return {"accounts": [
+        {
+            "name": account.name,
+            "flood_wait_seconds": round(account.client.flood_wait_remaining()),
+            "chats_loaded": account.chat_list.loaded
+        }
+        for account in client_pool
+    ]}
+
+def variant_etag(etag, *parts):
+    """
+    ETag варианта ответа: выбранные поля, страница. Части хэшируются,
+    поэтому кавычки и не-ASCII символы из запроса не попадают в заголовок.
+    """
+    parts = [str(part) for part in parts if part]
+    if not parts or not etag:
+        return etag
+    variant = ';'.join([etag.strip('"')] + parts)
+    return '"%s"' % hashlib.sha1(variant.encode('utf-8')).hexdigest()
+
+@app.get("/api/inbox")
+async def get_inbox(request: Request, fields: Optional[str] = None, limit: Optional[int] = None,
+                    cursor: Optional[str] = None):
+    """
+    Общий список чатов всех аккаунтов, сначала новые; поле account_name указывает аккаунт.
+    
+    limit ограничивает страницу, следующая страница - cursor=next_cursor.
+    """
     try:
-        if not telegram_client:
+        if not client_pool:
             raise HTTPException(status_code=503, detail="Клиент Telegram не инициализирован")
         
-        chats = await telegram_client.get_chats()
-        return {"chats": chats}
+        fields = parse_fields(fields)
+        try:
+            page, etag = await client_pool.inbox(limit=limit, cursor=cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        etag = variant_etag(etag, ','.join(fields or ()), limit, cursor)
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        return FastJSONResponse({"chats": project(page["chats"], fields), "next_cursor": page["next_cursor"]},
+                                headers=headers)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/chats")
+@app.get("/api/accounts/{account}/chats")
+async def get_chats(request: Request, account: Optional[str] = None, fields: Optional[str] = None):
+    """
+    Получить все чаты Telegram в формате CRM.
+    
+    Ответ отдается из общего снимка списка чатов, уже сериализованного;
+    при совпадении If-None-Match возвращается 304 Not Modified без тела.
+    fields=chat_id,name,... оставляет в ответе только перечисленные поля.
+    """
+    try:
+        selected = get_account(account)
+        chat_list = selected.chat_list
+        if not chat_list.loaded and not selected.client.connected:
+            raise HTTPException(status_code=503, detail="Идет подключение к Telegram, список чатов еще не загружен",
+                                headers={"Retry-After": "5"})
+        fields = parse_fields(fields)
+        await chat_list.get()
+        etag = variant_etag(chat_list.etag, ','.join(fields or ()))
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        return FastJSONResponse(chat_list.render(fields), headers=headers)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/chats/{chat_id}/messages")
-async def get_chat_messages(chat_id: str, offset: int = 0, limit: int = 50):
-    """Получить сообщения из определенного чата в формате CRM"""
+@app.get("/api/accounts/{account}/chats/{chat_id}/messages")
+async def get_chat_messages(chat_id: str, request: Request, limit: int = 50, before_id: Optional[int] = None,
+                            after_id: Optional[int] = None, account: Optional[str] = None,
+                            fields: Optional[str] = None):
+    """
+    Получить сообщения из определенного чата в формате CRM.
+    
+    Пагинация курсорная: без параметров возвращаются последние сообщения,
+    before_id=next_cursor листает историю назад, after_id догружает новые.
+    fields=message_id,text_content,... оставляет только перечисленные поля.
+    Ответ содержит ETag; при совпадении If-None-Match тело не передается (304).
+    """
     try:
-        if not telegram_client:
-            raise HTTPException(status_code=503, detail="Клиент Telegram не инициализирован")
+        page = await get_account(account).sync.get_messages_page(chat_id, limit, before_id=before_id, after_id=after_id)
         
-        messages = await telegram_client.get_messages(chat_id, limit)
+        body = dumps({
+            "messages": project(page["messages"], parse_fields(fields)),
+            "totalCount": len(page["messages"]),
+            "next_cursor": page["next_cursor"],
+            "prev_cursor": page["prev_cursor"]
+        })
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        return FastJSONResponse(body, headers=headers)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/chats/{chat_id}/export")
+@app.get("/api/accounts/{account}/chats/{chat_id}/export")
+async def export_chat(chat_id: str, from_id: int = 0, source: str = "telegram",
+                      account: Optional[str] = None):
+    """
+    Выгрузить всю историю чата потоком NDJSON (одно сообщение на строку, сначала старые).
+    Вложения без текста выгружаются с message_type=media и media_url; служебные
+    сообщения Telegram (вступления, закрепления) в выгрузку не входят.
+    
+    source=telegram читает историю из Telegram с ограничением частоты запросов,
+    source=store - из локального хранилища. Память не зависит от длины истории.
+    Если выгрузка прервалась, последняя строка - {"error": ..., "from_id": ...};
+    повторный запрос с этим from_id продолжит выгрузку.
+    """
+    if source not in ("telegram", "store"):
+        raise HTTPException(status_code=400, detail="source должен быть telegram или store")
+    selected = get_account(account)
+    if source == "store":
+        messages = selected.store.iter_messages(chat_id, from_id)
+    else:
+        messages = selected.client.iter_history(chat_id, from_id)
+
+    async def lines():
+        last_id = from_id
+        try:
+            async for message in messages:
+                last_id = int(message['message_id'])
+                yield json.dumps(message, ensure_ascii=False) + "\n"
+        except Exception as e:
+            logger.error(f"Выгрузка чата {chat_id} прервана на сообщении {last_id}: {e}")
+            yield json.dumps({"error": str(e), "from_id": last_id}, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson", headers={
+        "Content-Disposition": f'attachment; filename="chat_{chat_id}.ndjson"'
+    })
+
+async def _media_response(request: Request, entry, thumb: bool, cache_control: str):
+    """Отдать файл из кэша медиа с ETag; Range обрабатывает FileResponse"""
+    if not entry:
+        raise HTTPException(status_code=404, detail="Медиа не найдено")
+    if thumb and entry['mime_type'].startswith('image/'):
+        entry = await media_cache.thumbnail(entry)
+    headers = {"ETag": f'"{entry["digest"]}"', "Cache-Control": cache_control}
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(entry['path'], media_type=entry['mime_type'], headers=headers)
+
+@app.get("/api/chats/{chat_id}/photo")
+@app.get("/api/accounts/{account}/chats/{chat_id}/photo")
+async def get_chat_photo(chat_id: str, request: Request, thumb: bool = False,
+                         v: Optional[str] = None, account: Optional[str] = None):
+    """Аватар чата; v - версия фото из photo_url, thumb=true - миниатюра"""
+    try:
+        telegram_client = get_account(account).client
         
-        # Реализация пагинации
-        total_count = len(messages)
-        if offset == 0:
-            # Вернуть последние N сообщений
-            start = max(0, total_count - limit)
-            end = total_count
-        else:
-            # Вернуть предыдущие N сообщений
-            start = max(0, total_count - offset - limit)
-            end = total_count - offset
-            
-        paginated_messages = messages[start:end]
+        entry = await media_cache.get_or_fetch(
+            f"avatar:{telegram_client.account_name}:{chat_id}:{v or ''}",
+            lambda: telegram_client.download_chat_photo(chat_id)
+        )
+        cache_control = "public, max-age=31536000, immutable" if v else "public, max-age=3600"
+        return await _media_response(request, entry, thumb, cache_control)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/messages/{chat_id}/{message_id}/media")
+@app.get("/api/accounts/{account}/messages/{chat_id}/{message_id}/media")
+async def get_message_media(chat_id: str, message_id: int, request: Request,
+                            thumb: bool = False, account: Optional[str] = None):
+    """Вложение сообщения; thumb=true - миниатюра для изображений"""
+    try:
+        telegram_client = get_account(account).client
         
-        return {
-            "messages": paginated_messages,
-            "totalCount": total_count
-        }
+        entry = await media_cache.get_or_fetch(
+            f"media:{telegram_client.account_name}:{chat_id}:{message_id}",
+            lambda: telegram_client.download_message_media(chat_id, message_id)
+        )
+        return await _media_response(request, entry, thumb, "private, max-age=86400")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/chats/{chat_id}/messages")
-async def send_message(chat_id: str, message: dict):
-    """Отправить сообщение в чат"""
+@app.post("/api/chats/{chat_id}/messages", status_code=202)
+@app.post("/api/accounts/{account}/chats/{chat_id}/messages", status_code=202)
+async def send_message(chat_id: str, message: dict, account: Optional[str] = None):
+    """
+    Поставить сообщение в очередь отправки.
+    
+    Возвращает job_id; состояние доставки - GET /api/outbox/{job_id}.
+    """
     try:
-        if not telegram_client:
-            raise HTTPException(status_code=503, detail="Клиент Telegram не инициализирован")
+        outbox = get_account(account).outbox
         
         text = message.get("text", "")
         if not text:
             raise HTTPException(status_code=400, detail="Текст сообщения обязателен")
         
-        success = await telegram_client.send_message(chat_id, text)
-        if success:
-            return {"status": "sent"}
-        else:
-            raise HTTPException(status_code=500, detail="Не удалось отправить сообщение")
+        job = await outbox.enqueue(chat_id, text)
+        return {"status": job["status"], "job_id": job["job_id"]}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/health")
-async def health_check():
-    """Конечная точка проверки состояния"""
-    return {"status": "healthy"}
-
-# Конечная точка WebSocket для обновлений в реальном времени (аналогично CRM)
-from fastapi import WebSocket, WebSocketDisconnect
+@app.get("/api/outbox/{job_id}")
+@app.get("/api/accounts/{account}/outbox/{job_id}")
+async def get_outbox_job(job_id: int, account: Optional[str] = None):
+    """Состояние задания отправки: queued, sending, sent или failed"""
+    try:
+        job = await get_account(account).outbox.get_job(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Задание не найдено")
+        return job
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: list[WebSocket] = []
+@app.get("/api/sync/status")
+@app.get("/api/accounts/{account}/sync/status")
+async def get_sync_status(account: Optional[str] = None):
+    """Ход загрузки полной истории: прогресс каждого чата и скорость (BACKFILL_ENABLED)"""
+    try:
+        return await get_account(account).backfill.status()
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
+@app.get("/api/search")
+@app.get("/api/accounts/{account}/search")
+async def search_messages(q: str, chat_id: Optional[str] = None, sender: Optional[str] = None,
+                          date_from: Optional[str] = None, date_to: Optional[str] = None,
+                          limit: int = Query(20, ge=1, le=100), cursor: Optional[str] = None,
+                          account: Optional[str] = None):
+    """
+    Полнотекстовый поиск по локальному хранилищу сообщений без обращения к Telegram.
+    
+    Результаты с фрагментом текста (snippet) упорядочены по релевантности;
+    для следующей страницы передайте next_cursor в cursor.
+    """
+    try:
+        store = get_account(account).store
+        try:
+            page = await store.search(q, chat_id=chat_id, sender=sender, date_from=date_from,
+                                      date_to=date_to, limit=limit, cursor=cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return FastJSONResponse(page)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+@app.get("/health")
+@app.get("/health/live")
+async def health_check():
+    """Проверка живости: процесс отвечает (Telegram может еще подключаться)"""
+    return {"status": "healthy"}
 
-    async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
+@app.get("/health/ready")
+async def readiness_check():
+    """
+    Проверка готовности: хранилища открыты и данные можно отдавать.
+    Подключение к Telegram не требуется - до него ответы идут из локального хранилища.
+    """
+    accounts = [
+        {"name": account.name, "ready": account.ready, "telegram_connected": account.client.connected}
+        for account in client_pool or []
+    ]
+    ready = bool(accounts) and not config_errors and all(account["ready"] for account in accounts)
+    body = {"status": "ready" if ready else "starting", "accounts": accounts}
+    if config_errors:
+        body["errors"] = config_errors
+    return JSONResponse(body, status_code=200 if ready else 503)
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Метрики процесса в текстовом формате Prometheus"""
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
 
+# Конечная точка WebSocket для обновлений в реальном времени (аналогично CRM)
 manager = ConnectionManager()
 
 @app.websocket("/ws/chats/")
 async def websocket_endpoint(websocket: WebSocket):
+    """
+    Поток событий new_message, message_edited, message_deleted.
+    Клиент может ограничить его чатами: {"action": "subscribe", "chat_ids": ["123"]}.
+    """
     await manager.connect(websocket)
     try:
         while True:
             data = await websocket.receive_text()
-            # Обработка входящих сообщений WebSocket
-            # Пока просто эхо
-            await manager.send_personal_message(f"Вы отправили: {data}", websocket)
+            await manager.handle_command(websocket, data)
     except WebSocketDisconnect:
         manager.disconnect(websocket)
 
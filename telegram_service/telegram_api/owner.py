@@ -0,0 +1,53 @@
+"""
+Процесс-владелец подключения к Telegram для запуска API в нескольких процессах
+
+Держит единственное подключение к каждому аккаунту и поток обновлений,
+рабочие процессы API обращаются к нему через Unix-сокет:
+
+    TELEGRAM_OWNER_SOCKET=/tmp/tatargram.sock python -m telegram_api.owner
+    TELEGRAM_OWNER_SOCKET=/tmp/tatargram.sock uvicorn telegram_api.main:app --workers 4
+"""
+import asyncio
+import logging
+import signal
+import sys
+from config import config
+
+logger = logging.getLogger(__name__)
+
+async def serve(path):
+    from telegram_client.models import dispose_engines
+    from telegram_client.pool import Account, ClientPool
+    from telegram_client.rpc import OwnerServer
+
+    pool = ClientPool(Account.from_config(account) for account in config.accounts())
+    server = OwnerServer(pool, path)
+    await pool.start(server.handle_update)
+    await server.start()
+    print(f"Аккаунтов Telegram: {len(pool)}, сокет {path}")
+
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopped.set)
+    try:
+        await stopped.wait()
+    finally:
+        await server.stop()
+        await pool.stop()
+        await dispose_engines()
+        print("Отключено от Telegram")
+
+def main():
+    errors = config.validate()
+    if not config.TELEGRAM_OWNER_SOCKET:
+        errors.append("TELEGRAM_OWNER_SOCKET обязателен")
+    if errors:
+        print(f"Ошибки конфигурации: {', '.join(errors)}")
+        return 1
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve(config.TELEGRAM_OWNER_SOCKET))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,17 @@
+"""
+Классы ответов FastAPI
+"""
+from fastapi.responses import Response
+from telegram_client.serialization import dumps
+
+class FastJSONResponse(Response):
+    """
+    JSON-ответ, минующий jsonable_encoder: содержимое сериализуется сразу
+    в байты (orjson, если установлен), а готовые байты отдаются как есть.
+    """
+    media_type = "application/json"
+
+    def render(self, content):
+        if isinstance(content, bytes):
+            return content
+        return dumps(content)
@@ -0,0 +1,137 @@
+"""
+Фоновая загрузка полной истории чатов в локальное хранилище с контрольными точками
+"""
+import asyncio
+import logging
+import os
+import time
+from telethon.errors import FloodWaitError
+from .ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Запускать загрузку истории после подключения аккаунта
+BACKFILL_ENABLED = os.getenv('BACKFILL_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+# Сколько чатов загружается одновременно
+BACKFILL_CONCURRENCY = int(os.getenv('BACKFILL_CONCURRENCY', 4))
+# Общий для всех чатов аккаунта бюджет запросов истории в секунду
+BACKFILL_REQUESTS_PER_SECOND = float(os.getenv('BACKFILL_REQUESTS_PER_SECOND', 1))
+# Сообщений за запрос (максимум Telegram - 100)
+BACKFILL_BATCH_SIZE = int(os.getenv('BACKFILL_BATCH_SIZE', 100))
+
+class Backfill:
+    """
+    Загрузка истории чатов от новых сообщений к старым.
+
+    Несколько чатов обходятся параллельно, но все запросы аккаунта проходят
+    через одну корзину токенов, а при FloodWait загрузка ждет вся. После
+    каждой пачки в хранилище записывается контрольная точка (наименьший
+    загруженный id), поэтому после перезапуска загрузка продолжается с нее;
+    завершенные чаты повторно не обходятся.
+    """
+
+    def __init__(self, client, store, concurrency=BACKFILL_CONCURRENCY,
+                 requests_per_second=BACKFILL_REQUESTS_PER_SECOND, batch_size=BACKFILL_BATCH_SIZE):
+        self.client = client
+        self.store = store
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.bucket = TokenBucket(requests_per_second, 1)
+        self.checkpoints = {}
+        self.requests = 0
+        self.fetched = 0
+        self.started_at = None
+        self.finished_at = None
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self, chat_ids):
+        """Начать или продолжить загрузку истории указанных чатов (по порядку)"""
+        if not self.running:
+            self._task = asyncio.create_task(self.run(chat_ids))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self, chat_ids):
+        self.checkpoints = await self.store.get_checkpoints()
+        self.started_at, self.finished_at = time.monotonic(), None
+        self.requests = self.fetched = 0
+        queue = asyncio.Queue()
+        for chat_id in map(str, chat_ids):
+            checkpoint = self.checkpoints.setdefault(chat_id, {
+                'chat_id': chat_id, 'oldest_id': None, 'messages': 0, 'total': None,
+                'done': False, 'last_error': None
+            })
+            if not checkpoint['done']:
+                queue.put_nowait(chat_id)
+
+        async def worker():
+            while not queue.empty():
+                await self._backfill_chat(queue.get_nowait())
+
+        await asyncio.gather(*[worker() for _ in range(self.concurrency)])
+        self.finished_at = time.monotonic()
+        logger.info(f"Загрузка истории завершена: {self.fetched} сообщений, {self.requests} запросов")
+
+    async def _backfill_chat(self, chat_id):
+        checkpoint = self.checkpoints[chat_id]
+        while not checkpoint['done']:
+            wait = self.client.flood_wait_remaining()
+            if wait:
+                await asyncio.sleep(wait)
+            await self.bucket.acquire()
+            self.requests += 1
+            try:
+                page = await self.client.fetch_messages_page(chat_id, self.batch_size,
+                                                             before_id=checkpoint['oldest_id'])
+            except FloodWaitError:
+                # Клиент запомнил срок FloodWait; пачка будет запрошена снова после него
+                continue
+            except Exception as e:
+                # Чат пропускается до следующего запуска, остальные продолжают загружаться
+                logger.error(f"Ошибка загрузки истории чата {chat_id}: {e}")
+                checkpoint['last_error'] = str(e)
+                await self.store.save_checkpoint(checkpoint)
+                return
+
+            await self.store.save_messages(chat_id, page['messages'])
+            self.fetched += len(page['messages'])
+            checkpoint['messages'] += len(page['messages'])
+            checkpoint['total'] = page.get('total') or checkpoint['total']
+            checkpoint['last_error'] = None
+            if page['next_cursor']:
+                checkpoint['oldest_id'] = int(page['next_cursor'])
+            else:
+                checkpoint['done'] = True
+            await self.store.save_checkpoint(checkpoint)
+
+    async def status(self):
+        """Ход загрузки: по каждому чату и общая скорость (сообщений и запросов в секунду)"""
+        elapsed = ((self.finished_at or time.monotonic()) - self.started_at) if self.started_at else 0
+        chats = list(self.checkpoints.values())
+        return {
+            'running': self.running,
+            'chats_total': len(chats),
+            'chats_done': sum(1 for chat in chats if chat['done']),
+            'messages': self.fetched,
+            'requests': self.requests,
+            'elapsed_seconds': round(elapsed, 1),
+            'messages_per_second': round(self.fetched / elapsed, 1) if elapsed else 0.0,
+            'requests_per_second': round(self.requests / elapsed, 2) if elapsed else 0.0,
+            'flood_wait_seconds': round(self.client.flood_wait_remaining()),
+            'chats': [
+                dict(chat, progress=round(min(1.0, chat['messages'] / chat['total']), 3)
+                     if chat['total'] else (1.0 if chat['done'] else None))
+                for chat in chats
+            ]
+        }
@@ -0,0 +1,47 @@
+"""
+Ограниченный LRU-кэш с временем жизни записей
+"""
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """LRU-кэш фиксированного размера, записи которого устаревают через ttl секунд"""
+
+    def __init__(self, maxsize=10000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        """Получить значение по ключу, если оно есть и не устарело"""
+        item = self._data.get(key)
+        if item is None:
+            return default
+        value, expires_at = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        """Сохранить значение, вытесняя самые старые записи при переполнении"""
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Удалить запись и вернуть ее значение"""
+        item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._data)
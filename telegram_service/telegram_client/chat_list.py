@@ -0,0 +1,185 @@
+"""
+Снимок списка чатов в памяти с фоновым обновлением и ETag
+"""
+import asyncio
+import hashlib
+import logging
+import os
+from . import metrics
+from .merge import newest_first_key
+from .serialization import dumps, project
+
+logger = logging.getLogger(__name__)
+
+# Интервал фонового обновления списка чатов, секунды
+CHATS_REFRESH_SECONDS = int(os.getenv('CHATS_REFRESH_SECONDS', 60))
+
+# Сколько вариантов ?fields= хранится сериализованными для текущего снимка
+PROJECTION_CACHE_SIZE = 8
+
+class ChatListCache:
+    """
+    Общий для всех запросов снимок списка чатов.
+
+    Снимок обновляется в фоне раз в refresh_interval секунд или сразу после
+    invalidate(); новые сообщения из обновлений Telegram применяются к снимку
+    на месте без запроса диалогов. ETag меняется только при изменении содержимого.
+    Тело ответа {"chats": [...]} сериализуется один раз на версию снимка.
+    """
+
+    def __init__(self, sync, refresh_interval=CHATS_REFRESH_SECONDS):
+        self.sync = sync
+        self.refresh_interval = refresh_interval
+        self.chats = None
+        self.etag = None
+        self.body = None
+        self._projections = {}
+        self._by_date = None
+        self.version = 0
+        self._generation = 0
+        self._lock = asyncio.Lock()
+        self._stale = asyncio.Event()
+        self._task = None
+
+    async def get(self):
+        """Вернуть (чаты, ETag), загрузив снимок при первом обращении"""
+        metrics.cache_lookup('chat_list', self.chats is not None)
+        if self.chats is None:
+            await self.refresh()
+        return self.chats, self.etag
+
+    @property
+    def loaded(self):
+        """Есть ли снимок, который можно отдать без обращения к Telegram"""
+        return self.chats is not None
+
+    def seed(self, chats):
+        """Показать последний известный список (из хранилища), пока нет свежего"""
+        if self.chats is None and chats:
+            self._publish(chats)
+
+    async def refresh(self):
+        """Перечитать диалоги; одновременные вызовы объединяются в один запрос"""
+        generation = self._generation
+        async with self._lock:
+            if self._generation != generation:
+                return
+            self._publish(await self.sync.get_chats())
+            self._generation += 1
+
+    def apply_update(self, delta):
+        """Применить событие Telegram к снимку"""
+        if self.chats is None:
+            return
+        if delta['type'] == 'message_edited':
+            self._apply_edit(delta)
+            return
+        if delta['type'] == 'message_deleted':
+            self._apply_delete(delta)
+            return
+        if delta['type'] != 'new_message':
+            self.invalidate()
+            return
+
+        message = delta['message']
+        chats = list(self.chats)
+        for index, chat in enumerate(chats):
+            if chat['chat_id'] == delta['chat_id']:
+                break
+        else:
+            # Новый диалог - нужен полный список
+            self.invalidate()
+            return
+
+        if int(message['message_id']) <= (chats[index].get('last_message_id') or 0):
+            # Уже учтено: живое обновление и догрузка пропущенного могут совпасть
+            return
+        chat = dict(chats.pop(index))
+        chat['last_message'] = (message['text_content'] or '')[:100]
+        chat['last_message_date'] = message['created_at']
+        chat['last_message_id'] = int(message['message_id'])
+        if not message['from_me']:
+            chat['unread_count'] = (chat.get('unread_count') or 0) + 1
+        chats.insert(0, chat)
+        self._publish(chats)
+
+    def _apply_edit(self, delta):
+        """Правка последнего сообщения чата меняет его превью; остальные правки снимок не затрагивают"""
+        if 'text_content' not in delta['changes']:
+            return
+        chats = list(self.chats)
+        for index, chat in enumerate(chats):
+            if chat['chat_id'] == delta['chat_id']:
+                if chat.get('last_message_id') == int(delta['message_id']):
+                    chats[index] = dict(chat, last_message=(delta['changes']['text_content'] or '')[:100])
+                    self._publish(chats)
+                return
+
+    def _apply_delete(self, delta):
+        """
+        Удаление последнего сообщения меняет превью, а новое последнее сообщение
+        известно только Telegram - тогда список перечитывается
+        """
+        deleted = {int(msg_id) for msg_id in delta['message_ids']}
+        for chat in self.chats:
+            if delta['chat_id'] is not None and chat['chat_id'] != delta['chat_id']:
+                continue
+            # Для чатов из хранилища id последнего сообщения неизвестен
+            if chat.get('last_message_id') is None or chat['last_message_id'] in deleted:
+                self.invalidate()
+                return
+
+    def invalidate(self):
+        """Запросить внеочередное фоновое обновление"""
+        self._stale.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._stale.wait(), timeout=self.refresh_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._stale.clear()
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Ошибка фонового обновления списка чатов: {e}")
+
+    def render(self, fields=None):
+        """Сериализованное тело {"chats": [...]} текущего снимка, при fields - только эти поля"""
+        if not fields:
+            return self.body
+        body = self._projections.get(fields)
+        if body is None:
+            if len(self._projections) >= PROJECTION_CACHE_SIZE:
+                self._projections.clear()
+            body = self._projections[fields] = dumps({'chats': project(self.chats, fields)})
+        return body
+
+    def by_date(self):
+        """Чаты снимка по убыванию даты последнего сообщения (закрепленные не первыми)"""
+        if self._by_date is None and self.chats is not None:
+            self._by_date = sorted(self.chats, key=newest_first_key)
+        return self._by_date or []
+
+    def _publish(self, chats):
+        body = dumps({'chats': chats})
+        self.chats = chats
+        self.body = body
+        self._projections = {}
+        self._by_date = None
+        self.version += 1
+        self.etag = '"%s"' % hashlib.sha1(body).hexdigest()
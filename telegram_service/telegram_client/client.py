@@ -3,13 +3,21 @@
 """
 import asyncio
 import logging
-from telethon import TelegramClient
-from telethon.errors import SessionPasswordNeededError
+import time
+from telethon import TelegramClient, events
+from telethon.errors import SessionPasswordNeededError, FloodWaitError
 from telethon.tl.functions.messages import GetHistoryRequest
-from telethon.tl.types import PeerUser, PeerChat, PeerChannel, User, Chat, Channel
+from telethon.tl.types.updates import ChannelDifferenceTooLong, DifferenceTooLong
+from telethon.tl.types import PeerUser, PeerChat, PeerChannel, User, Chat, Channel, InputPeerPhotoFileLocation
+from telethon import utils
 import os
 from dotenv import load_dotenv
 from datetime import datetime
+from urllib.parse import quote
+from .cache import TTLCache
+from .peers import PeerCache, display_name
+from .ratelimit import TokenBucket
+from . import metrics
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -18,36 +26,158 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# FloodWait короче этого порога Telethon пережидает автоматически
+FLOOD_SLEEP_THRESHOLD = int(os.getenv('FLOOD_SLEEP_THRESHOLD', 60))
+
+# Выгрузка истории: сообщений за запрос (максимум Telegram - 100) и запросов в секунду
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 100))
+EXPORT_REQUESTS_PER_SECOND = float(os.getenv('EXPORT_REQUESTS_PER_SECOND', 1))
+
+# Общий для процесса кэш имен отправителей: peer_id -> отображаемое имя
+sender_cache = TTLCache(
+    maxsize=int(os.getenv('SENDER_CACHE_SIZE', 10000)),
+    ttl=int(os.getenv('SENDER_CACHE_TTL', 3600))
+)
+
+# Сколько последних событий помнится, чтобы не разослать повторно догруженное после переподключения
+UPDATE_DEDUP_SIZE = int(os.getenv('UPDATE_DEDUP_SIZE', 10000))
+
+# Поля сообщения, которые меняет редактирование (событие message_edited передает только их)
+EDIT_FIELDS = ('text_content', 'message_type', 'media_url', 'is_edit', 'edited_at')
+
+def _chat_key(peer_id):
+    """Идентификатор чата, как его отдает get_chats (без префикса -100 у каналов)"""
+    return str(utils.resolve_id(peer_id)[0])
+
+def _has_content(msg):
+    """Сообщение с текстом или вложением; служебные (вступления, закрепления) и пустые пропускаются"""
+    return bool(getattr(msg, 'message', None) or getattr(msg, 'media', None))
+
+class InstrumentedTelegramClient(TelegramClient):
+    """
+    TelegramClient, учитывающий каждый RPC-запрос в метриках.
+    
+    Короткие FloodWait пережидаются здесь, а не внутри Telethon, чтобы
+    попадать в метрики; длинные пробрасываются вызывающему коду.
+    
+    Обновления, пропущенные за время обрыва или простоя, Telethon догружает
+    сам (catch_up=True, состояние pts/qts/date/seq и pts каналов хранится
+    в файле сессии) и передает обычным обработчикам событий. Если разрыв
+    слишком велик для getDifference, вызывается on_gap: данные нужно
+    перечитать полностью.
+    """
+    
+    def __init__(self, *args, account_name='Telegram', flood_sleep_threshold=FLOOD_SLEEP_THRESHOLD, **kwargs):
+        super().__init__(*args, flood_sleep_threshold=0, catch_up=True, **kwargs)
+        self.account_name = account_name
+        self.auto_sleep_threshold = flood_sleep_threshold
+        self.on_gap = None
+    
+    async def _call(self, sender, request, ordered=False, flood_sleep_threshold=None):
+        name = metrics.request_name(request)
+        while True:
+            started = time.perf_counter()
+            outcome = 'ok'
+            try:
+                result = await super()._call(sender, request, ordered=ordered, flood_sleep_threshold=0)
+                if self.on_gap and isinstance(result, (DifferenceTooLong, ChannelDifferenceTooLong)):
+                    self.on_gap()
+                return result
+            except FloodWaitError as e:
+                outcome = 'flood_wait'
+                metrics.FLOOD_WAITS.inc(self.account_name, name)
+                metrics.FLOOD_WAIT_SECONDS.inc(self.account_name, amount=e.seconds)
+                if e.seconds > self.auto_sleep_threshold:
+                    raise
+                wait = e.seconds
+                logger.info(f"FloodWait {wait} с на {name}, ожидание")
+            except Exception:
+                outcome = 'error'
+                raise
+            finally:
+                metrics.RPC_REQUESTS.inc(self.account_name, name, metrics.current_route.get(), outcome)
+                metrics.RPC_LATENCY.observe(name, value=time.perf_counter() - started)
+            await asyncio.sleep(wait)
+
 class TelegramConversationClient:
-    def __init__(self):
-        # Получение учетных данных из переменных окружения
-        self.api_id = int(os.getenv('TELEGRAM_API_ID'))
-        self.api_hash = os.getenv('TELEGRAM_API_HASH')
-        self.phone_number = os.getenv('TELEGRAM_PHONE_NUMBER')
-        
-        # Используем абсолютный путь для файла сессии в домашней директории пользователя
-        home_dir = os.path.expanduser("~")
-        session_path = os.path.join(home_dir, 'telegram_session')
-        logger.info(f"Using session path: {session_path}")
-        
-        # Инициализация клиента
-        self.client = TelegramClient(session_path, self.api_id, self.api_hash)
+    def __init__(self, account_name='Telegram', session_name='telegram_session',
+                 phone_number=None, api_id=None, api_hash=None, telegram_client=None):
+        # Учетные данные: явные параметры аккаунта или переменные окружения
+        self.account_name = account_name
+        self.url_prefix = f"/api/accounts/{quote(account_name)}"
+        self.api_id = int(api_id or os.getenv('TELEGRAM_API_ID'))
+        self.api_hash = api_hash or os.getenv('TELEGRAM_API_HASH')
+        self.phone_number = phone_number or os.getenv('TELEGRAM_PHONE_NUMBER')
+        
+        if telegram_client is not None:
+            # Готовый клиент (например, имитация Telegram в тестах и замерах)
+            self.client = telegram_client
+        else:
+            # Используем абсолютный путь для файла сессии в домашней директории пользователя
+            home_dir = os.path.expanduser("~")
+            session_path = os.path.join(home_dir, session_name)
+            logger.info(f"Using session path: {session_path}")
+            
+            # Инициализация клиента; короткие FloodWait клиент пережидает сам,
+            # и это задерживает только запросы данного аккаунта
+            self.client = InstrumentedTelegramClient(session_path, self.api_id, self.api_hash,
+                                                     account_name=account_name)
+            self.client.on_gap = self._on_gap
+        self.flood_wait_until = 0
+        # Подключен и авторизован; до этого данные отдаются только из локального хранилища
+        self.connected = False
+        # Общая для всех выгрузок аккаунта, чтобы параллельные экспорты не множили запросы
+        self.export_bucket = TokenBucket(EXPORT_REQUESTS_PER_SECOND, 1)
+        # access_hash встреченных чатов и отправителей (сохраняется в хранилище, см. pool)
+        self.peers = PeerCache()
+        self._update_callbacks = []
+        self._recent_updates = TTLCache(maxsize=UPDATE_DEDUP_SIZE, ttl=3600)
+        self._gap_task = None
         self.phone_code = None
         self.password = None
+    
+    def flood_wait_remaining(self):
+        """Сколько секунд аккаунт еще ограничен FloodWait (0 - не ограничен)"""
+        return max(0.0, self.flood_wait_until - time.monotonic())
+    
+    def _remember_entities(self, entities):
+        """Занести пользователей и чаты из ответа Telegram в кэш отправителей и таблицу собеседников"""
+        entities = list(entities)
+        for entity in entities:
+            sender_cache.set(utils.get_peer_id(entity), display_name(entity))
+        self.peers.remember(entities)
+    
+    async def _input_peer(self, chat_id):
+        """InputPeer чата из таблицы собеседников; get_entity (запрос к Telegram) - только для новых чатов"""
+        peer = self.peers.input_peer(chat_id)
+        metrics.cache_lookup('peer', peer is not None)
+        if peer is None:
+            entity = await self.client.get_entity(int(chat_id))
+            self.peers.remember([entity])
+            peer = utils.get_input_peer(entity)
+        return peer
+    
+    def _note_flood_wait(self, error):
+        self.flood_wait_until = max(self.flood_wait_until, time.monotonic() + error.seconds)
+        logger.warning(f"FloodWait {error.seconds} с для аккаунта {self.account_name}")
         
     async def connect(self):
         """Подключение к Telegram и аутентификация"""
         await self.client.connect()
         
         # Проверка авторизации
-        if not await self.client.is_user_authorized():
+        if await self.client.is_user_authorized():
+            self.connected = True
+        else:
             await self.client.send_code_request(self.phone_number)
             if self.phone_code:
                 try:
                     await self.client.sign_in(self.phone_number, self.phone_code)
+                    self.connected = True
                 except SessionPasswordNeededError:
                     if self.password:
                         await self.client.sign_in(password=self.password)
+                        self.connected = True
             else:
                 logger.warning("Требуется код подтверждения. Используйте метод set_auth_code для установки кода.")
                 
@@ -61,7 +191,12 @@ class TelegramConversationClient:
                 
     async def get_chats(self):
         """Получить все чаты в формате, подобном CRM"""
-        dialogs = await self.client.get_dialogs()
+        try:
+            dialogs = await self.client.get_dialogs()
+        except FloodWaitError as e:
+            self._note_flood_wait(e)
+            raise
+        self.peers.remember(dialog.entity for dialog in dialogs)
         chats = []
         
         for dialog in dialogs:
@@ -70,9 +205,7 @@ class TelegramConversationClient:
             # Определение типа чата и имени
             if isinstance(chat, User):
                 chat_type = "user"
-                title = f"{chat.first_name or ''} {chat.last_name or ''}".strip()
-                if not title:
-                    title = chat.username or f"Пользователь {chat.id}"
+                title = display_name(chat)
             elif isinstance(chat, Chat):
                 chat_type = "group"
                 title = chat.title
@@ -86,8 +219,11 @@ class TelegramConversationClient:
             # Получить URL фото, если доступно
             photo_url = None
             if hasattr(chat, 'photo') and chat.photo:
-                # В реальной реализации вы бы скачали и обслужили фото
-                photo_url = f"/api/chats/{chat.id}/photo"  # Заполнитель
+                # Версия в URL меняется вместе с фото, поэтому ответ можно кэшировать навсегда
+                photo_id = getattr(chat.photo, 'photo_id', None)
+                photo_url = f"{self.url_prefix}/chats/{chat.id}/photo"
+                if photo_id:
+                    photo_url += f"?v={photo_id}"
             
             chat_info = {
                 'id': str(chat.id),
@@ -99,93 +235,307 @@ class TelegramConversationClient:
                 'unread_count': dialog.unread_count,
                 'last_message': str(dialog.message)[:100] if dialog.message else '',
                 'last_message_date': dialog.date.isoformat() if dialog.date else None,
+                'last_message_id': getattr(dialog.message, 'id', None),
                 'photo_url': photo_url,
                 'is_verified_read': False,
                 'is_no_reply_needed': False,
                 'is_pinned': False,
-                'account_name': 'Telegram'
+                'account_name': self.account_name
             }
             chats.append(chat_info)
             
         return chats
     
-    async def get_messages(self, chat_id, limit=50):
+    async def get_messages(self, chat_id, limit=50, before_id=None, after_id=None):
         """Получить сообщения из определенного чата в формате, подобном CRM"""
+        page = await self.get_messages_page(chat_id, limit, before_id, after_id)
+        return page['messages']
+    
+    async def get_messages_page(self, chat_id, limit=50, before_id=None, after_id=None):
+        """
+        Получить страницу истории по курсору.
+        
+        before_id - сообщения старше указанного id (прокрутка назад),
+        after_id - сообщения новее указанного id (догрузка новых).
+        Возвращает сообщения (сначала старые), next_cursor для следующей
+        страницы в прошлое (None, если история закончилась) и prev_cursor -
+        id самого нового сообщения страницы. При ошибке возвращается пустая страница.
+        """
         try:
-            # Получить сущность для чата
-            entity = await self.client.get_entity(int(chat_id))
+            return await self.fetch_messages_page(chat_id, limit, before_id, after_id)
+        except Exception as e:
+            logger.error(f"Ошибка получения сообщений для чата {chat_id}: {e}")
+            return {'messages': [], 'next_cursor': None, 'prev_cursor': None}
+    
+    async def fetch_messages_page(self, chat_id, limit=50, before_id=None, after_id=None):
+        """
+        То же, что get_messages_page, но ошибки (в том числе FloodWaitError) пробрасываются.
+        total - число сообщений в чате по данным Telegram, если оно известно.
+        """
+        try:
+            # InputPeer из таблицы собеседников, без отдельного запроса
+            entity = await self._input_peer(chat_id)
+            
+            # Telegram отдает историю от новых к старым начиная с offset_id;
+            # для движения вперед окно сдвигается отрицательным add_offset
+            if after_id:
+                offset_id, add_offset, min_id = int(after_id) + 1, -limit, int(after_id)
+            else:
+                offset_id, add_offset, min_id = int(before_id or 0), 0, 0
             
             # Получить историю сообщений
             messages = await self.client(GetHistoryRequest(
                 peer=entity,
                 limit=limit,
                 offset_date=None,
-                offset_id=0,
+                offset_id=offset_id,
                 max_id=0,
-                min_id=0,
-                add_offset=0,
+                min_id=min_id,
+                add_offset=add_offset,
                 hash=0
             ))
+            self._remember_entities(list(messages.users) + list(messages.chats))
+            
+            message_list = [
+                self._message_to_dict(msg, chat_id)
+                for msg in messages.messages
+                if _has_content(msg)
+            ]
             
-            message_list = []
-            for msg in messages.messages:
-                if hasattr(msg, 'message') and msg.message:
-                    # Определить тип сообщения
-                    message_type = "text"
-                    if msg.media:
-                        message_type = "media"
-                    
-                    # Определить отправителя
-                    from_me = msg.out
-                    sender_name = "Вы" if from_me else ""
-                    
-                    # Попытаться получить информацию об отправителе
-                    if not from_me and msg.sender_id:
-                        try:
-                            sender = await self.client.get_entity(msg.sender_id)
-                            if isinstance(sender, User):
-                                sender_name = f"{sender.first_name or ''} {sender.last_name or ''}".strip()
-                                if not sender_name:
-                                    sender_name = sender.username or f"Пользователь {sender.id}"
-                        except:
-                            sender_name = f"Пользователь {msg.sender_id}"
-                    
-                    message_info = {
-                        'id': str(msg.id),
-                        'message_id': str(msg.id),
-                        'chat_id': str(chat_id),
-                        'from_me': from_me,
-                        'created_at': msg.date.isoformat() if msg.date else None,
-                        'message_type': message_type,
-                        'text_content': msg.message,
-                        'media_url': None,  # Нужно реализовать обработку медиа
-                        'is_read': True,  # Сообщения Telegram обычно прочитаны
-                        'is_delivered': True,
-                        'sender_name': sender_name,
-                        'is_edit': False,
-                        'is_deleted': False
-                    }
-                    message_list.append(message_info)
-                    
             # Сортировать сообщения по дате (сначала старые)
             message_list.sort(key=lambda x: x['created_at'] or '')
-            return message_list
-        except Exception as e:
-            logger.error(f"Ошибка получения сообщений для чата {chat_id}: {e}")
-            return []
+            
+            # Курсоры считаются по всей странице, включая пропущенные служебные сообщения
+            page_ids = [msg.id for msg in messages.messages]
+            next_cursor = None
+            if page_ids and len(page_ids) >= limit and not after_id:
+                next_cursor = str(min(page_ids))
+            prev_cursor = str(max(page_ids)) if page_ids else (str(after_id) if after_id else None)
+            
+            return {
+                'messages': message_list,
+                'next_cursor': next_cursor,
+                'prev_cursor': prev_cursor,
+                'total': getattr(messages, 'count', None)
+            }
+        except FloodWaitError as e:
+            self._note_flood_wait(e)
+            raise
+    
+    async def iter_history(self, chat_id, from_id=0, batch_size=EXPORT_BATCH_SIZE):
+        """
+        Пройти всю историю чата от старых сообщений к новым, начиная после from_id.
+        Выдаются все сообщения, включая вложения без текста (message_type, media_url);
+        служебные сообщения (вступления, закрепления) пропускаются.
+        
+        Асинхронный генератор: в памяти находится только текущая пачка, запросы
+        ограничены export_bucket. Ошибки (в том числе FloodWait) пробрасываются,
+        продолжить можно с id последнего полученного сообщения.
+        """
+        entity = await self._input_peer(chat_id)
+        last_id = int(from_id or 0)
+        while True:
+            await self.export_bucket.acquire()
+            try:
+                history = await self.client(GetHistoryRequest(
+                    peer=entity,
+                    limit=batch_size,
+                    offset_date=None,
+                    offset_id=last_id + 1,
+                    max_id=0,
+                    min_id=last_id,
+                    add_offset=-batch_size,
+                    hash=0
+                ))
+            except FloodWaitError as e:
+                self._note_flood_wait(e)
+                raise
+            self._remember_entities(list(history.users) + list(history.chats))
+            batch = sorted(history.messages, key=lambda msg: msg.id)
+            for msg in batch:
+                if _has_content(msg):
+                    yield self._message_to_dict(msg, chat_id)
+            if len(batch) < batch_size:
+                return
+            last_id = batch[-1].id
+    
+    def _message_to_dict(self, msg, chat_id):
+        """Преобразовать сообщение Telethon в формат, подобный CRM"""
+        # Определить тип сообщения
+        message_type = "text"
+        if msg.media:
+            message_type = "media"
+        
+        # Определить отправителя
+        from_me = msg.out
+        sender_name = "Вы" if from_me else ""
+        
+        # Имя отправителя берется из users/chats ответа или из кэша,
+        # без отдельного запроса get_entity на каждое сообщение
+        if not from_me and msg.sender_id:
+            sender_name = sender_cache.get(msg.sender_id) or self.peers.name(_chat_key(msg.sender_id))
+            metrics.cache_lookup('sender', sender_name is not None)
+            sender_name = sender_name or f"Пользователь {msg.sender_id}"
+        
+        # edit_hide - служебные изменения (кнопки, реакции), в клиентах Telegram не помечаются как правка
+        edit_date = None if getattr(msg, 'edit_hide', False) else getattr(msg, 'edit_date', None)
+        
+        return {
+            'id': str(msg.id),
+            'message_id': str(msg.id),
+            'chat_id': str(chat_id),
+            'from_me': from_me,
+            'created_at': msg.date.isoformat() if msg.date else None,
+            'message_type': message_type,
+            'text_content': msg.message,
+            'media_url': f"{self.url_prefix}/messages/{chat_id}/{msg.id}/media" if msg.media else None,
+            'is_read': True,  # Сообщения Telegram обычно прочитаны
+            'is_delivered': True,
+            'sender_name': sender_name,
+            'is_edit': edit_date is not None,
+            'edited_at': edit_date.isoformat() if edit_date else None,
+            'is_deleted': False
+        }
+    
+    def _message_delta(self, event_type, msg, peer_id):
+        """
+        Событие CRM о новом (None для служебных сообщений) или измененном сообщении.
+        Изменение передается только измененными полями (EDIT_FIELDS).
+        """
+        if event_type == 'new_message' and not _has_content(msg):
+            return None
+        sender = getattr(msg, 'sender', None)
+        if isinstance(sender, (User, Chat, Channel)):
+            self._remember_entities([sender])
+        chat_id = _chat_key(peer_id)
+        message = self._message_to_dict(msg, chat_id)
+        if event_type == 'message_edited':
+            return {'type': event_type, 'chat_id': chat_id, 'message_id': message['message_id'],
+                    'changes': {field: message[field] for field in EDIT_FIELDS}}
+        return {'type': event_type, 'chat_id': chat_id, 'message': message}
+    
+    async def _dispatch(self, delta):
+        """
+        Передать событие подписчикам. После переподключения Telethon догружает
+        разрыв, и сообщение, уже пришедшее вживую, может прийти повторно -
+        такие повторы отбрасываются.
+        """
+        if delta['type'] == 'new_message':
+            key = (delta['type'], delta['chat_id'], delta['message']['message_id'])
+        elif delta['type'] == 'message_edited':
+            key = (delta['type'], delta['chat_id'], delta['message_id'], delta['changes']['edited_at'])
+        elif delta['type'] == 'message_deleted':
+            key = (delta['type'], delta['chat_id'], tuple(delta['message_ids']))
+        else:
+            key = None
+        if key is not None:
+            if self._recent_updates.get(key):
+                return
+            self._recent_updates.set(key, True)
+        for callback in self._update_callbacks:
+            await callback(delta)
+    
+    async def publish_sent(self, message):
+        """
+        Передать подписчикам сообщение, отправленное этим клиентом: Telethon
+        не присылает NewMessage для собственных исходящих сообщений сессии
+        """
+        await self._dispatch({'type': 'new_message', 'chat_id': message['chat_id'], 'message': message})
+    
+    def _on_gap(self):
+        """Разрыв слишком велик для догрузки: подписчикам нужно перечитать данные (resync)"""
+        logger.warning(f"Пропущено слишком много обновлений аккаунта {self.account_name}, нужна полная синхронизация")
+        self._gap_task = asyncio.create_task(self._dispatch({'type': 'resync', 'chat_id': None}))
+    
+    def add_update_handler(self, callback):
+        """
+        Подписаться на новые, измененные и удаленные сообщения.
+        
+        callback - корутина, получающая событие в формате CRM:
+        {'type': 'new_message', 'chat_id', 'message'},
+        {'type': 'message_edited', 'chat_id', 'message_id', 'changes'} (поля EDIT_FIELDS)
+        или {'type': 'message_deleted', 'chat_id', 'message_ids'}.
+        chat_id для удалений известен только в каналах и супергруппах.
+        Догруженные после обрыва события приходят так же, как живые (без повторов);
+        если догрузить их нельзя, приходит {'type': 'resync', 'chat_id': None}.
+        """
+        self._update_callbacks.append(callback)
+        if len(self._update_callbacks) > 1:
+            return
+        
+        async def on_new_message(event):
+            delta = self._message_delta('new_message', event.message, event.chat_id)
+            if delta:
+                await self._dispatch(delta)
+        
+        async def on_message_edited(event):
+            delta = self._message_delta('message_edited', event.message, event.chat_id)
+            if delta:
+                await self._dispatch(delta)
+        
+        async def on_message_deleted(event):
+            await self._dispatch({
+                'type': 'message_deleted',
+                'chat_id': _chat_key(event.chat_id) if event.chat_id else None,
+                'message_ids': [str(msg_id) for msg_id in event.deleted_ids]
+            })
+        
+        self.client.add_event_handler(on_new_message, events.NewMessage())
+        self.client.add_event_handler(on_message_edited, events.MessageEdited())
+        self.client.add_event_handler(on_message_deleted, events.MessageDeleted())
+    
+    async def download_chat_photo(self, chat_id):
+        """Скачать аватар чата: (bytes, mime_type) или None, если фото нет"""
+        peer = await self._input_peer(chat_id)
+        photo = self.peers.photo(chat_id)
+        if photo is None:
+            # Запись из старой таблицы собеседников: данные фото запрашиваются один раз
+            self.peers.remember([await self.client.get_entity(peer)])
+            photo = self.peers.photo(chat_id) or (0, None)
+        photo_id, dc_id = photo
+        if not photo_id:
+            return None
+        # Ссылка на файл строится из таблицы собеседников: download_profile_photo
+        # запросил бы сущность заново
+        location = InputPeerPhotoFileLocation(peer=peer, photo_id=photo_id, big=False)
+        data = await self.client.download_file(location, bytes, dc_id=dc_id)
+        return (data, 'image/jpeg') if data else None
+    
+    async def download_message_media(self, chat_id, message_id):
+        """Скачать вложение сообщения: (bytes, mime_type) или None"""
+        entity = await self._input_peer(chat_id)
+        msg = await self.client.get_messages(entity, ids=int(message_id))
+        if not msg or not msg.media:
+            return None
+        data = await self.client.download_media(msg, file=bytes)
+        mime_type = msg.file.mime_type if msg.file else None
+        return (data, mime_type or 'application/octet-stream') if data else None
     
     async def send_message(self, chat_id, text):
         """Отправить сообщение в чат"""
         try:
-            entity = await self.client.get_entity(int(chat_id))
-            await self.client.send_message(entity, text)
+            await self.send_text(chat_id, text)
             return True
         except Exception as e:
             logger.error(f"Ошибка отправки сообщения в чат {chat_id}: {e}")
             return False
     
+    async def send_text(self, chat_id, text):
+        """
+        Отправить сообщение и вернуть его в формате CRM.
+        В отличие от send_message ошибки (в том числе FloodWaitError) пробрасываются.
+        """
+        try:
+            entity = await self._input_peer(chat_id)
+            msg = await self.client.send_message(entity, text)
+        except FloodWaitError as e:
+            self._note_flood_wait(e)
+            raise
+        return self._message_to_dict(msg, chat_id)
+    
     async def disconnect(self):
         """Отключение от Telegram"""
+        self.connected = False
         await self.client.disconnect()
 
 # Пример использования
@@ -0,0 +1,95 @@
+"""
+Пакетная загрузка чатов и сообщений в локальную базу (upsert)
+"""
+import logging
+import os
+import time
+from datetime import datetime
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from .models import BackfillCheckpoint, TelegramChat, TelegramMessage, TelegramPeer, get_async_engine
+
+logger = logging.getLogger(__name__)
+
+# Количество строк в одной транзакции
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', 1000))
+
+# Уникальные ключи, по которым определяется конфликт при вставке
+CHAT_CONFLICT_COLUMNS = ('chat_id',)
+MESSAGE_CONFLICT_COLUMNS = ('chat_id', 'message_id')
+PEER_CONFLICT_COLUMNS = ('chat_id',)
+CHECKPOINT_CONFLICT_COLUMNS = ('chat_id',)
+
+def upsert_statement(dialect_name, table, conflict_columns, update_columns):
+    """INSERT ... ON CONFLICT / ON DUPLICATE KEY UPDATE для диалекта базы данных"""
+    if dialect_name in ('sqlite', 'postgresql'):
+        insert = sqlite.insert if dialect_name == 'sqlite' else postgresql.insert
+        stmt = insert(table)
+        return stmt.on_conflict_do_update(
+            index_elements=list(conflict_columns),
+            set_={column: stmt.excluded[column] for column in update_columns}
+        )
+    if dialect_name == 'mysql':
+        stmt = mysql.insert(table)
+        return stmt.on_duplicate_key_update({column: stmt.inserted[column] for column in update_columns})
+    raise ValueError(f"Пакетная загрузка не поддерживается для диалекта {dialect_name}")
+
+class BulkIngest:
+    """
+    Upsert чатов, сообщений и собеседников пакетами по batch_size строк.
+
+    Каждый пакет отправляется одним executemany в отдельной транзакции.
+    Методы возвращают статистику: rows, batches, seconds, rows_per_second.
+    """
+
+    def __init__(self, database_url=None, batch_size=INGEST_BATCH_SIZE):
+        self.engine = get_async_engine(database_url)
+        self.batch_size = batch_size
+
+    async def upsert_chats(self, rows):
+        """rows - словари со столбцами telegram_chats (см. store.chat_to_row)"""
+        return await self._upsert(TelegramChat.__table__, rows, CHAT_CONFLICT_COLUMNS)
+
+    async def upsert_messages(self, rows):
+        """rows - словари со столбцами telegram_messages (см. store.message_to_row)"""
+        return await self._upsert(TelegramMessage.__table__, rows, MESSAGE_CONFLICT_COLUMNS)
+
+    async def upsert_peers(self, rows):
+        """rows - словари со столбцами telegram_peers (см. peers.peer_row)"""
+        return await self._upsert(TelegramPeer.__table__, rows, PEER_CONFLICT_COLUMNS)
+
+    async def upsert_checkpoints(self, rows):
+        """rows - словари со столбцами telegram_backfill (см. backfill.Backfill)"""
+        return await self._upsert(BackfillCheckpoint.__table__, rows, CHECKPOINT_CONFLICT_COLUMNS)
+
+    async def _upsert(self, table, rows, conflict_columns):
+        # onupdate не срабатывает в ветке ON CONFLICT, поэтому updated_at проставляется явно
+        now = datetime.utcnow()
+        rows = [dict(row, updated_at=now) for row in rows]
+        stats = {'rows': 0, 'batches': 0, 'seconds': 0.0, 'rows_per_second': 0.0}
+        if not rows:
+            return stats
+
+        # executemany требует одинакового набора столбцов, поэтому строки группируются по нему;
+        # обновляются только переданные столбцы, ключ конфликта (в т.ч. chat_id сообщения) не меняется
+        groups = {}
+        for row in rows:
+            groups.setdefault(tuple(row), []).append(row)
+
+        started = time.perf_counter()
+        for columns, group in groups.items():
+            update_columns = [column for column in columns if column not in conflict_columns and column != 'id']
+            stmt = upsert_statement(self.engine.dialect.name, table, conflict_columns, update_columns)
+            for start in range(0, len(group), self.batch_size):
+                batch = group[start:start + self.batch_size]
+                async with self.engine.begin() as conn:
+                    await conn.execute(stmt, batch)
+                stats['rows'] += len(batch)
+                stats['batches'] += 1
+        stats['seconds'] = time.perf_counter() - started
+        if stats['seconds'] > 0:
+            stats['rows_per_second'] = stats['rows'] / stats['seconds']
+        logger.debug(
+            f"Загружено {stats['rows']} строк в {table.name} за {stats['seconds']:.2f} с "
+            f"({stats['rows_per_second']:.0f} строк/с)"
+        )
+        return stats
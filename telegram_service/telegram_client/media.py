@@ -0,0 +1,204 @@
+"""
+Дисковый кэш медиафайлов и аватаров с адресацией по содержимому
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+MEDIA_CACHE_DIR = os.getenv('MEDIA_CACHE_DIR', 'media_cache')
+MEDIA_CACHE_MAX_BYTES = int(os.getenv('MEDIA_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+THUMBNAIL_SIZE = int(os.getenv('THUMBNAIL_SIZE', 320))
+THUMBNAIL_WORKERS = int(os.getenv('THUMBNAIL_WORKERS', 2))
+
+def make_thumbnail(src_path, dst_path, size):
+    """Построить JPEG-миниатюру (выполняется в пуле процессов)"""
+    from PIL import Image
+
+    with Image.open(src_path) as image:
+        image.thumbnail((size, size))
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.save(dst_path, 'JPEG', quality=85)
+
+class MediaCache:
+    """
+    Файлы хранятся под именем sha256 содержимого, поэтому одинаковые
+    медиа из разных чатов занимают место один раз. Ключи (аватар чата,
+    вложение сообщения) ссылаются на содержимое через небольшие файлы-индексы.
+    При превышении max_bytes удаляются давно не использованные файлы.
+    """
+
+    def __init__(self, root=MEDIA_CACHE_DIR, max_bytes=MEDIA_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._blobs_dir = os.path.join(root, 'blobs')
+        self._keys_dir = os.path.join(root, 'keys')
+        os.makedirs(self._blobs_dir, exist_ok=True)
+        os.makedirs(self._keys_dir, exist_ok=True)
+        self._usage = OrderedDict()  # имя файла -> размер, от давно использованных к недавним
+        self._total = 0
+        self._inflight = {}
+        self._executor = None
+        self._load()
+
+    def _load(self):
+        entries = []
+        for name in os.listdir(self._blobs_dir):
+            if name.endswith('.tmp'):
+                continue
+            path = os.path.join(self._blobs_dir, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._usage[name] = size
+            self._total += size
+
+    def _key_path(self, key):
+        return os.path.join(self._keys_dir, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def blob_path(self, name):
+        return os.path.join(self._blobs_dir, name)
+
+    def lookup(self, key):
+        """Вернуть {'digest', 'mime_type', 'path'} для ключа или None"""
+        try:
+            with open(self._key_path(key)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry['digest'] not in self._usage:
+            return None
+        self._touch(entry['digest'])
+        entry['path'] = self.blob_path(entry['digest'])
+        return entry
+
+    def put(self, key, data, mime_type=None):
+        """Сохранить содержимое под ключом и вернуть запись как в lookup"""
+        digest = self._write_blob(data)
+        return self._record(key, digest, len(data), mime_type)
+
+    def _write_blob(self, data):
+        """Хэширование и запись содержимого; не трогает состояние кэша, поэтому выполняется в потоке"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(digest)
+        if not os.path.exists(path):
+            fd, tmp_path = tempfile.mkstemp(dir=self._blobs_dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+        return digest
+
+    def _record(self, key, digest, size, mime_type):
+        if digest not in self._usage:
+            self._usage[digest] = size
+            self._total += size
+        self._touch(digest)
+        entry = {'digest': digest, 'mime_type': mime_type or 'application/octet-stream'}
+        with open(self._key_path(key), 'w') as f:
+            json.dump(entry, f)
+        self._evict()
+        return dict(entry, path=self.blob_path(digest))
+
+    async def get_or_fetch(self, key, fetch):
+        """
+        Вернуть запись из кэша или загрузить ее через fetch() -> (bytes, mime_type).
+        Одновременные запросы одного ключа ждут одну загрузку.
+        """
+        entry = self.lookup(key)
+        metrics.cache_lookup('media', entry is not None)
+        if entry:
+            return entry
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(key, fetch))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key, fetch):
+        result = await fetch()
+        if result is None:
+            return None
+        data, mime_type = result
+        if not data:
+            return None
+        # Большие вложения хэшируются и записываются вне цикла событий
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(None, self._write_blob, data)
+        return self._record(key, digest, len(data), mime_type)
+
+    async def thumbnail(self, entry, size=THUMBNAIL_SIZE):
+        """
+        Миниатюра изображения из кэша; строится в пуле процессов один раз.
+        Одновременные запросы одной миниатюры ждут одно построение.
+        """
+        name = f"{entry['digest']}.thumb{size}"
+        if name not in self._usage:
+            key = f"thumb:{name}"
+            task = self._inflight.get(key)
+            if task is None:
+                task = asyncio.ensure_future(self._build_thumbnail(entry['path'], name, size))
+                self._inflight[key] = task
+                task.add_done_callback(lambda _: self._inflight.pop(key, None))
+            await asyncio.shield(task)
+        self._touch(name)
+        return {'digest': name, 'mime_type': 'image/jpeg', 'path': self.blob_path(name)}
+
+    async def _build_thumbnail(self, src_path, name, size):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS)
+        # Уникальный временный файл: построение не пересекается с другими процессами
+        fd, tmp_path = tempfile.mkstemp(dir=self._blobs_dir, suffix='.tmp')
+        os.close(fd)
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._executor, make_thumbnail, src_path, tmp_path, size)
+            os.replace(tmp_path, self.blob_path(name))
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        if name not in self._usage:
+            file_size = os.path.getsize(self.blob_path(name))
+            self._usage[name] = file_size
+            self._total += file_size
+            self._evict()
+
+    def _touch(self, name):
+        if name in self._usage:
+            self._usage.move_to_end(name)
+            try:
+                os.utime(self.blob_path(name))
+            except OSError:
+                pass
+
+    def _evict(self):
+        while self._total > self.max_bytes and len(self._usage) > 1:
+            name, size = self._usage.popitem(last=False)
+            self._total -= size
+            try:
+                os.remove(self.blob_path(name))
+            except OSError as e:
+                logger.warning(f"Не удалось удалить {name} из кэша медиа: {e}")
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown(wait=False)
+            self._executor = None
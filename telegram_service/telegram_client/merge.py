@@ -0,0 +1,106 @@
+"""
+Ленивое k-путевое слияние отсортированных списков бесед (общий входящий список)
+
+Модуль не зависит от остального пакета и может использоваться на стороне CRM.
+"""
+import asyncio
+import base64
+import heapq
+import json
+import math
+from datetime import datetime, timezone
+
+def parse_timestamp(value):
+    """ISO-строка, datetime или число -> секунды эпохи; None, если время неизвестно"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.timestamp()
+    return None
+
+def newest_first_key(item, source='', date_key='last_message_date', id_key='chat_id'):
+    """
+    Ключ порядка "сначала новые": по убыванию времени, беседы без даты в конце;
+    источник и id делают порядок полным, чтобы курсор был однозначным.
+    """
+    timestamp = parse_timestamp(item.get(date_key))
+    return (math.inf if timestamp is None else -timestamp, source, str(item.get(id_key)))
+
+def encode_cursor(key):
+    position, source, item_id = key
+    data = [None if position == math.inf else position, source, item_id]
+    return base64.urlsafe_b64encode(json.dumps(data).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """Курсор -> ключ последней выданной беседы; ValueError при неверном курсоре"""
+    try:
+        position, source, item_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise ValueError(f"Неверный курсор: {cursor}")
+    return (math.inf if position is None else float(position), source, item_id)
+
+async def iterate(items):
+    """Асинхронный итератор по уже загруженному списку"""
+    for item in items:
+        yield item
+
+async def merge_newest_first(sources, limit=None, cursor=None, date_key='last_message_date', id_key='chat_id'):
+    """
+    Слить источники, каждый из которых уже отсортирован "сначала новые".
+
+    sources - словарь имя -> асинхронный итератор или функция
+    (before_timestamp) -> асинхронный итератор; функции получают время
+    курсора и могут начать выдачу с него, остальные источники читаются
+    с начала и пропускают уже выданное. Из каждого источника читается не
+    больше, чем нужно для limit бесед; после выдачи страницы итераторы
+    закрываются. Возвращает {'items', 'next_cursor'}.
+    """
+    after = decode_cursor(cursor) if cursor else None
+    before_timestamp = None if after is None or after[0] == math.inf else -after[0]
+
+    iterators = {}
+    for name, source in sources.items():
+        if callable(source):
+            source = source(before_timestamp)
+        iterators[name] = source.__aiter__()
+
+    heap = []
+    counter = 0
+
+    async def advance(name):
+        nonlocal counter
+        iterator = iterators[name]
+        while True:
+            try:
+                item = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            key = newest_first_key(item, name, date_key, id_key)
+            if after is None or key > after:
+                counter += 1
+                heapq.heappush(heap, (key, counter, name, item))
+                return
+
+    try:
+        await asyncio.gather(*[advance(name) for name in iterators])
+        items = []
+        last_key = None
+        while heap and (limit is None or len(items) < limit):
+            last_key, _, name, item = heapq.heappop(heap)
+            items.append(item)
+            await advance(name)
+    finally:
+        for iterator in iterators.values():
+            if hasattr(iterator, 'aclose'):
+                await iterator.aclose()
+
+    return {'items': items, 'next_cursor': encode_cursor(last_key) if heap else None}
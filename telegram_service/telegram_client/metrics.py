@@ -0,0 +1,145 @@
+"""
+Метрики процесса в текстовом формате Prometheus без внешних зависимостей
+"""
+import contextvars
+
+# Маршрут HTTP, в рамках которого выполняется код: запросы к Telegram
+# помечаются им, чтобы было видно, какой эндпоинт расходует лимиты
+current_route = contextvars.ContextVar('current_route', default='background')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        for labels, value in sorted(self._values.items()):
+            yield self.name, _format_labels(self.labels, labels), value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(f'{name}{labels} {_format_value(value)}' for name, labels, value in self.samples())
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, *labels, value):
+        self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+class Histogram(Metric):
+    """Гистограмма с фиксированными границами; хранит счетчики корзин, сумму и количество"""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, *labels, value):
+        state = self._values.get(labels)
+        if state is None:
+            state = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+        counts = state[0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        state[1] += value
+        state[2] += 1
+
+    def value(self, *labels):
+        state = self._values.get(labels)
+        return state[2] if state else 0
+
+    def samples(self):
+        for labels, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield (f'{self.name}_bucket',
+                       _format_labels(self.labels, labels, [('le', _format_value(bound))]), cumulative)
+            yield f'{self.name}_sum', _format_labels(self.labels, labels), total
+            yield f'{self.name}_count', _format_labels(self.labels, labels), count
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+HTTP_REQUESTS = registry.register(Counter(
+    'tatargram_http_requests_total', 'HTTP requests by route and status', ('method', 'route', 'status')))
+HTTP_LATENCY = registry.register(Histogram(
+    'tatargram_http_request_duration_seconds', 'HTTP request latency', ('method', 'route')))
+HTTP_IN_FLIGHT = registry.register(Gauge(
+    'tatargram_http_requests_in_flight', 'HTTP requests being served', ('route',)))
+WS_CONNECTIONS = registry.register(Gauge(
+    'tatargram_websocket_connections', 'Open WebSocket connections'))
+WS_CONNECTIONS.set(value=0)
+WS_RESYNCS = registry.register(Counter(
+    'tatargram_websocket_resyncs_total', 'Slow WebSocket clients sent a resync instead of queued events'))
+RPC_REQUESTS = registry.register(Counter(
+    'tatargram_telegram_rpc_total', 'Telegram RPC calls by TL request, HTTP route and outcome',
+    ('account', 'request', 'route', 'outcome')))
+RPC_LATENCY = registry.register(Histogram(
+    'tatargram_telegram_rpc_duration_seconds', 'Telegram RPC latency by TL request', ('request',)))
+FLOOD_WAITS = registry.register(Counter(
+    'tatargram_telegram_flood_waits_total', 'FloodWait errors by TL request', ('account', 'request')))
+FLOOD_WAIT_SECONDS = registry.register(Counter(
+    'tatargram_telegram_flood_wait_seconds_total', 'Seconds of FloodWait imposed by Telegram', ('account',)))
+CACHE_REQUESTS = registry.register(Counter(
+    'tatargram_cache_requests_total', 'Cache lookups by cache and result (hit/miss)', ('cache', 'result')))
+
+def cache_lookup(cache, hit):
+    """Учесть обращение к кэшу"""
+    CACHE_REQUESTS.inc(cache, 'hit' if hit else 'miss')
+
+def request_name(request):
+    """Имя TL-запроса (для пачки запросов - имя первого)"""
+    if isinstance(request, (list, tuple)):
+        request = request[0] if request else None
+    return type(request).__name__
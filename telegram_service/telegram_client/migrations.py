@@ -0,0 +1,71 @@
+"""
+Обновление схемы существующих баз (без Alembic: изменений схемы пока немного)
+"""
+import logging
+from sqlalchemy import inspect, text
+from .models import TelegramMessage, TelegramPeer
+from .search import FTS_TABLE
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_KEY = 'uq_telegram_messages_chat_message'
+
+def upgrade_messages_table(conn):
+    """
+    Перевести telegram_messages со строкового глобально уникального message_id
+    на целочисленный ключ (chat_id, message_id) с индексами диапазонов
+    (синхронный conn, через run_sync). Новые и уже обновленные базы не меняются.
+
+    SQLite не умеет менять ограничения таблицы, поэтому таблица пересоздается
+    с копированием строк; id строк сохраняются, и полнотекстовый индекс,
+    ссылающийся на них, остается верным.
+    """
+    table = TelegramMessage.__tablename__
+    inspector = inspect(conn)
+    if not inspector.has_table(table):
+        return
+    if MESSAGE_KEY in {constraint['name'] for constraint in inspector.get_unique_constraints(table)}:
+        return
+    if conn.dialect.name != 'sqlite':
+        logger.warning(f"Таблица {table} в старой схеме: нужен ключ {MESSAGE_KEY} (chat_id, message_id) "
+                       f"и целочисленный message_id; обновите схему вручную")
+        return
+
+    old_columns = {column['name'] for column in inspector.get_columns(table)}
+    columns = [column.name for column in TelegramMessage.__table__.columns if column.name in old_columns]
+    values = ['CAST(message_id AS INTEGER)' if column == 'message_id' else column for column in columns]
+
+    # Триггеры полнотекстового индекса ссылаются на таблицу; create_search_index создаст их заново
+    for suffix in ('ai', 'ad', 'au'):
+        conn.execute(text(f"DROP TRIGGER IF EXISTS {FTS_TABLE}_{suffix}"))
+    conn.execute(text(f"ALTER TABLE {table} RENAME TO {table}_old"))
+    TelegramMessage.__table__.create(conn)
+    conn.execute(text(
+        f"INSERT INTO {table} ({', '.join(columns)}) SELECT {', '.join(values)} FROM {table}_old"
+    ))
+    conn.execute(text(f"DROP TABLE {table}_old"))
+    logger.info(f"Таблица {table} переведена на ключ (chat_id, message_id)")
+
+def _add_columns(conn, model):
+    table = model.__tablename__
+    inspector = inspect(conn)
+    if not inspector.has_table(table):
+        return
+    existing = {column['name'] for column in inspector.get_columns(table)}
+    for column in model.__table__.columns:
+        if column.name in existing:
+            continue
+        column_type = column.type.compile(dialect=conn.dialect)
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column.name} {column_type}"))
+        logger.info(f"В таблицу {table} добавлен столбец {column.name}")
+
+def add_message_columns(conn):
+    """
+    Добавить в существующую таблицу telegram_messages столбцы, появившиеся
+    в модели позже (все они допускают NULL, поэтому хватает ALTER TABLE ADD COLUMN)
+    """
+    _add_columns(conn, TelegramMessage)
+
+def add_peer_columns(conn):
+    """То же для telegram_peers (данные аватара)"""
+    _add_columns(conn, TelegramPeer)
@@ -2,9 +2,13 @@
 Модели базы данных для хранения данных Telegram
 Это может быть интегрировано с существующей базой данных CRM
 """
-from sqlalchemy import Column, Integer, String, Text, DateTime, Boolean, create_engine
+from sqlalchemy import (Column, Integer, BigInteger, String, Text, DateTime, Boolean, Index,
+                        UniqueConstraint, create_engine)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from datetime import datetime
 import os
 
@@ -31,13 +35,22 @@ class TelegramChat(Base):
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 class TelegramMessage(Base):
+    """
+    Сообщение чата. id сообщения Telegram уникален только в пределах чата,
+    поэтому ключ сообщения - (chat_id, message_id); тот же индекс обслуживает
+    страницы "последние N в чате", индекс (chat_id, created_at) - выборки по датам.
+    id остается rowid строки: на него ссылается полнотекстовый индекс (search.py).
+    """
     __tablename__ = 'telegram_messages'
+    __table_args__ = (
+        UniqueConstraint('chat_id', 'message_id', name='uq_telegram_messages_chat_message'),
+        Index('ix_telegram_messages_chat_created', 'chat_id', 'created_at'),
+    )
     
     id = Column(Integer, primary_key=True)
-    message_id = Column(String(50), unique=True, nullable=False)
     chat_id = Column(String(50), nullable=False)
+    message_id = Column(BigInteger, nullable=False)
     from_me = Column(Boolean, default=False)
-    created_at = Column(DateTime)
     message_type = Column(String(20))  # text, media, etc.
     text_content = Column(Text)
     media_url = Column(String(512))
@@ -45,24 +58,128 @@ class TelegramMessage(Base):
     is_delivered = Column(Boolean, default=False)
     sender_name = Column(String(255))
     is_edit = Column(Boolean, default=False)
-    is_deleted = Column(Boolean, default=False)
+    is_deleted = Column(Boolean, default=False)  # удалено в Telegram; строка остается как надгробие
+    created_at = Column(DateTime, default=datetime.utcnow)  # дата сообщения в Telegram (UTC)
+    edited_at = Column(DateTime)  # дата последней правки в Telegram (UTC)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class TelegramPeer(Base):
+    """Собеседник с access_hash: по нему InputPeer строится без запроса get_entity"""
+    __tablename__ = 'telegram_peers'
+    
+    chat_id = Column(String(50), primary_key=True)
+    peer_type = Column(String(20), nullable=False)  # user, chat, channel
+    access_hash = Column(BigInteger)
+    name = Column(String(255))
+    username = Column(String(255))
+    photo_id = Column(BigInteger)  # 0 - фото нет, NULL - еще неизвестно
+    photo_dc_id = Column(Integer)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class BackfillCheckpoint(Base):
+    """Ход загрузки полной истории чата: с какого сообщения продолжать после перезапуска"""
+    __tablename__ = 'telegram_backfill'
+    
+    chat_id = Column(String(50), primary_key=True)
+    oldest_id = Column(BigInteger)  # наименьший загруженный id; None - загрузка не начата
+    messages = Column(Integer, default=0)
+    total = Column(Integer)  # сообщений в чате по данным Telegram
+    done = Column(Boolean, default=False)
+    last_error = Column(Text)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class OutboxMessage(Base):
+    """Исходящее сообщение в очереди на отправку"""
+    __tablename__ = 'telegram_outbox'
+    
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(String(50), nullable=False, index=True)
+    text_content = Column(Text, nullable=False)
+    status = Column(String(20), default='queued', index=True)  # queued, sending, sent, failed
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)
+    last_error = Column(Text)
+    sent_message_id = Column(String(50))
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 # Настройка базы данных
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+
+# Асинхронные драйверы для синхронных схем URL
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'mysql': 'mysql+aiomysql',
+    'mysql+pymysql': 'mysql+aiomysql',
+    'postgresql': 'postgresql+asyncpg',
+}
+
+_engine = None
+_async_engines = {}
+_async_sessionmakers = {}
+
 def get_database_url():
     return os.getenv('DATABASE_URL', 'sqlite:///telegram.db')
 
+def get_async_database_url(database_url=None):
+    """URL базы данных с асинхронным драйвером (aiosqlite, aiomysql)"""
+    url = database_url or get_database_url()
+    scheme, sep, rest = url.partition('://')
+    return ASYNC_DRIVERS.get(scheme, scheme) + sep + rest
+
 def create_tables():
-    engine = create_engine(get_database_url())
+    engine = get_engine()
     Base.metadata.create_all(engine)
     return engine
 
+def get_engine():
+    """Общий для процесса синхронный движок (скрипты и утилиты)"""
+    global _engine
+    if _engine is None:
+        _engine = create_engine(get_database_url())
+    return _engine
+
 def get_session():
-    engine = create_engine(get_database_url())
-    Session = sessionmaker(bind=engine)
+    Session = sessionmaker(bind=get_engine())
     return Session()
 
+def _pool_options(url):
+    """Размер пула задается только для QueuePool (SQLite :memory: использует StaticPool)"""
+    parsed = make_url(url)
+    if issubclass(parsed.get_dialect().get_pool_class(parsed), QueuePool):
+        return {'pool_size': DB_POOL_SIZE, 'max_overflow': DB_MAX_OVERFLOW}
+    return {}
+
+def get_async_engine(database_url=None):
+    """Общий для процесса асинхронный движок с пулом соединений на каждый URL"""
+    url = get_async_database_url(database_url)
+    engine = _async_engines.get(url)
+    if engine is None:
+        engine = create_async_engine(url, pool_pre_ping=True, **_pool_options(url))
+        _async_engines[url] = engine
+    return engine
+
+def get_async_sessionmaker(database_url=None):
+    url = get_async_database_url(database_url)
+    maker = _async_sessionmakers.get(url)
+    if maker is None:
+        maker = sessionmaker(get_async_engine(url), class_=AsyncSession, expire_on_commit=False)
+        _async_sessionmakers[url] = maker
+    return maker
+
+async def init_models(database_url=None):
+    """Создать таблицы через асинхронный движок"""
+    async with get_async_engine(database_url).begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+async def dispose_engines():
+    """Закрыть все соединения пулов при остановке сервиса"""
+    for engine in _async_engines.values():
+        await engine.dispose()
+    _async_engines.clear()
+    _async_sessionmakers.clear()
+
 if __name__ == "__main__":
     # Создать таблицы
     engine = create_tables()
@@ -0,0 +1,195 @@
+"""
+Постоянная очередь исходящих сообщений с учетом FloodWait
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from sqlalchemy import select, update
+from telethon.errors import FloodWaitError
+from .models import OutboxMessage, get_async_sessionmaker
+from .ratelimit import TokenBucket
+from .store import format_date
+
+logger = logging.getLogger(__name__)
+
+# Частота отправки: на весь аккаунт и на один чат (сообщений в секунду)
+OUTBOX_GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', 5))
+OUTBOX_GLOBAL_BURST = int(os.getenv('OUTBOX_GLOBAL_BURST', 10))
+OUTBOX_CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', 1))
+OUTBOX_CHAT_BURST = int(os.getenv('OUTBOX_CHAT_BURST', 3))
+# Повторы при ошибках: экспоненциальная задержка от базовой до максимальной
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 5))
+OUTBOX_RETRY_BASE_SECONDS = float(os.getenv('OUTBOX_RETRY_BASE_SECONDS', 2))
+OUTBOX_RETRY_MAX_SECONDS = float(os.getenv('OUTBOX_RETRY_MAX_SECONDS', 300))
+OUTBOX_IDLE_SECONDS = 30
+OUTBOX_FETCH_SIZE = 200
+
+def job_to_dict(job):
+    return {
+        'job_id': job.id,
+        'chat_id': job.chat_id,
+        'status': job.status,
+        'attempts': job.attempts,
+        'last_error': job.last_error,
+        'message_id': job.sent_message_id,
+        'next_attempt_at': format_date(job.next_attempt_at) if job.status == 'queued' else None,
+        'created_at': format_date(job.created_at)
+    }
+
+class Outbox:
+    """
+    Очередь исходящих сообщений одного аккаунта в таблице telegram_outbox.
+
+    Фоновый обработчик отправляет сообщения в порядке постановки внутри
+    каждого чата, соблюдая общую и по-чатовую корзины токенов. FloodWaitError
+    откладывает всю очередь на e.seconds, прочие ошибки повторяются с
+    экспоненциальной задержкой до OUTBOX_MAX_ATTEMPTS попыток.
+    """
+
+    def __init__(self, client, database_url=None):
+        self.client = client
+        self.Session = get_async_sessionmaker(database_url)
+        self.global_bucket = TokenBucket(OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_BURST)
+        self._chat_buckets = {}
+        self._wake = asyncio.Event()
+        self._task = None
+
+    async def enqueue(self, chat_id, text):
+        """Поставить сообщение в очередь и вернуть задание"""
+        async with self.Session() as session:
+            job = OutboxMessage(chat_id=str(chat_id), text_content=text, status='queued',
+                                attempts=0, next_attempt_at=datetime.utcnow())
+            session.add(job)
+            await session.commit()
+        self._wake.set()
+        return job_to_dict(job)
+
+    async def get_job(self, job_id):
+        async with self.Session() as session:
+            job = await session.get(OutboxMessage, job_id)
+            return job_to_dict(job) if job else None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        # Задания, прерванные остановкой процесса во время отправки, повторяются
+        async with self.Session() as session:
+            await session.execute(
+                update(OutboxMessage).where(OutboxMessage.status == 'sending').values(status='queued')
+            )
+            await session.commit()
+
+        while True:
+            try:
+                wait = await self.drain()
+            except Exception as e:
+                logger.error(f"Ошибка обработки очереди отправки: {e}")
+                wait = OUTBOX_RETRY_BASE_SECONDS
+            self._wake.clear()
+            if wait:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def drain(self):
+        """Отправить все готовые задания; вернуть паузу до следующего прохода"""
+        if not self.client.connected:
+            # Задания ждут подключения, попытки не расходуются
+            return OUTBOX_RETRY_BASE_SECONDS
+        now = datetime.utcnow()
+        wait = OUTBOX_IDLE_SECONDS
+        sent_any = False
+        blocked_chats = set()
+        async for job in self._ready_jobs(blocked_chats):
+            flood_wait = self.client.flood_wait_remaining()
+            if flood_wait:
+                return flood_wait
+            if job.next_attempt_at and job.next_attempt_at > now:
+                # Более поздние сообщения этого чата ждут, чтобы не нарушить порядок
+                blocked_chats.add(job.chat_id)
+                wait = min(wait, (job.next_attempt_at - now).total_seconds())
+                continue
+
+            chat_bucket = self._chat_buckets.get(job.chat_id)
+            if chat_bucket is None:
+                chat_bucket = self._chat_buckets[job.chat_id] = TokenBucket(OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST)
+            chat_delay = chat_bucket.delay()
+            if chat_delay:
+                blocked_chats.add(job.chat_id)
+                wait = min(wait, chat_delay)
+                continue
+
+            await self.global_bucket.acquire()
+            chat_bucket.take()
+            if not await self._send(job):
+                blocked_chats.add(job.chat_id)
+            sent_any = True
+        return 0 if sent_any else wait
+
+    async def _ready_jobs(self, blocked_chats):
+        """
+        Задания в очереди по порядку постановки, страницами по OUTBOX_FETCH_SIZE.
+        Чаты из blocked_chats (его пополняет drain) исключаются уже в запросе,
+        поэтому длинная очередь одного чата не закрывает остальные.
+        """
+        last_id = 0
+        while True:
+            query = (select(OutboxMessage)
+                     .where(OutboxMessage.status == 'queued', OutboxMessage.id > last_id)
+                     .order_by(OutboxMessage.id).limit(OUTBOX_FETCH_SIZE))
+            if blocked_chats:
+                query = query.where(OutboxMessage.chat_id.notin_(blocked_chats))
+            async with self.Session() as session:
+                jobs = list((await session.execute(query)).scalars())
+            if not jobs:
+                return
+            for job in jobs:
+                last_id = job.id
+                if job.chat_id not in blocked_chats:
+                    yield job
+
+    async def _send(self, job):
+        await self._update(job.id, status='sending', attempts=job.attempts + 1)
+        try:
+            message = await self.client.send_text(job.chat_id, job.text_content)
+        except FloodWaitError as e:
+            # Попытка не засчитывается: Telegram просто просит подождать
+            await self._update(job.id, status='queued', attempts=job.attempts,
+                               next_attempt_at=datetime.utcnow() + timedelta(seconds=e.seconds),
+                               last_error=f"FloodWait {e.seconds} с")
+            return False
+        except Exception as e:
+            attempts = job.attempts + 1
+            if attempts >= OUTBOX_MAX_ATTEMPTS:
+                logger.error(f"Сообщение {job.id} в чат {job.chat_id} не отправлено: {e}")
+                await self._update(job.id, status='failed', last_error=str(e))
+                return True
+            delay = min(OUTBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1), OUTBOX_RETRY_MAX_SECONDS)
+            await self._update(job.id, status='queued', last_error=str(e),
+                               next_attempt_at=datetime.utcnow() + timedelta(seconds=delay))
+            return False
+        await self._update(job.id, status='sent', sent_message_id=message['message_id'], last_error=None)
+        try:
+            # В хранилище, список чатов и WebSocket сообщение попадает тем же путем, что и входящие
+            await self.client.publish_sent(message)
+        except Exception as e:
+            logger.error(f"Отправленное сообщение {job.id} не передано подписчикам: {e}")
+        return True
+
+    async def _update(self, job_id, **values):
+        async with self.Session() as session:
+            await session.execute(update(OutboxMessage).where(OutboxMessage.id == job_id).values(**values))
+            await session.commit()
@@ -0,0 +1,142 @@
+"""
+Таблица собеседников: access_hash пользователей, групп и каналов для InputPeer без get_entity
+"""
+import asyncio
+import logging
+import os
+from telethon.tl.types import (Channel, Chat, ChatPhoto, InputPeerChannel, InputPeerChat, InputPeerUser,
+                               User, UserProfilePhoto)
+
+logger = logging.getLogger(__name__)
+
+# Как часто новые и измененные записи сохраняются в таблицу telegram_peers, секунды
+PEER_FLUSH_SECONDS = float(os.getenv('PEER_FLUSH_SECONDS', 5))
+
+def display_name(entity):
+    """Отображаемое имя пользователя, группы или канала"""
+    if isinstance(entity, User):
+        name = f"{entity.first_name or ''} {entity.last_name or ''}".strip()
+        return name or entity.username or f"Пользователь {entity.id}"
+    return getattr(entity, 'title', None) or str(entity.id)
+
+def peer_row(entity):
+    """
+    Сущность Telethon -> строка telegram_peers или None, если по ней нельзя
+    построить InputPeer (min-сущности из групп приходят без годного access_hash)
+    """
+    if isinstance(entity, User):
+        peer_type = 'user'
+    elif isinstance(entity, Chat):
+        peer_type = 'chat'
+    elif isinstance(entity, Channel):
+        peer_type = 'channel'
+    else:
+        return None
+    access_hash = getattr(entity, 'access_hash', None)
+    if peer_type != 'chat' and (access_hash is None or getattr(entity, 'min', False)):
+        return None
+    photo = getattr(entity, 'photo', None)
+    has_photo = isinstance(photo, (UserProfilePhoto, ChatPhoto))
+    return {
+        'chat_id': str(entity.id),
+        'peer_type': peer_type,
+        'access_hash': access_hash,
+        'name': display_name(entity),
+        'username': getattr(entity, 'username', None),
+        'photo_id': photo.photo_id if has_photo else 0,
+        'photo_dc_id': photo.dc_id if has_photo else None
+    }
+
+class PeerCache:
+    """
+    Индекс chat_id -> строка telegram_peers в памяти.
+
+    Пополняется из users/chats каждого ответа Telegram (диалоги, история,
+    отправка, обновления) и загружается из таблицы при запуске, поэтому
+    InputPeer для уже встречавшегося чата строится без запроса к Telegram.
+    Новые и измененные записи сохраняются в фоне пачками.
+    """
+
+    def __init__(self, flush_interval=PEER_FLUSH_SECONDS):
+        self.flush_interval = flush_interval
+        self._peers = {}
+        self._dirty = {}
+        self._save = None
+        self._task = None
+
+    def __len__(self):
+        return len(self._peers)
+
+    def load(self, rows):
+        """Заполнить индекс строками из хранилища (MessageStore.get_peers)"""
+        for row in rows:
+            self._peers[row['chat_id']] = row
+
+    def remember(self, entities):
+        for entity in entities:
+            row = peer_row(entity)
+            if row is not None and self._peers.get(row['chat_id']) != row:
+                self._peers[row['chat_id']] = row
+                self._dirty[row['chat_id']] = row
+
+    def input_peer(self, chat_id):
+        """InputPeer чата или None, если чат еще не встречался"""
+        row = self._peers.get(str(chat_id))
+        if row is None:
+            return None
+        peer_id = int(row['chat_id'])
+        if row['peer_type'] == 'user':
+            return InputPeerUser(peer_id, row['access_hash'])
+        if row['peer_type'] == 'channel':
+            return InputPeerChannel(peer_id, row['access_hash'])
+        return InputPeerChat(peer_id)
+
+    def photo(self, chat_id):
+        """
+        (photo_id, dc_id) аватара чата; photo_id 0 - фото нет,
+        None - фото неизвестно (строка сохранена до появления этих столбцов)
+        """
+        row = self._peers.get(str(chat_id))
+        if row is None or row.get('photo_id') is None:
+            return None
+        return row['photo_id'], row.get('photo_dc_id')
+
+    def name(self, chat_id):
+        row = self._peers.get(str(chat_id))
+        return row['name'] if row else None
+
+    def start(self, save):
+        """Сохранять изменения в фоне; save - корутина, получающая список строк"""
+        self._save = save
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def flush(self):
+        if not self._dirty or self._save is None:
+            return
+        rows, self._dirty = list(self._dirty.values()), {}
+        try:
+            await self._save(rows)
+        except Exception:
+            # Записи сохранятся при следующей попытке, если не изменятся раньше
+            for row in rows:
+                self._dirty.setdefault(row['chat_id'], row)
+            raise
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка сохранения таблицы собеседников: {e}")
@@ -0,0 +1,189 @@
+"""
+Пул клиентов Telegram для нескольких аккаунтов операторов
+"""
+import asyncio
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from .client import TelegramConversationClient
+from .store import MessageStore
+from .sync import ConversationSync
+from .chat_list import ChatListCache
+from .outbox import Outbox
+from .merge import iterate, merge_newest_first
+from .backfill import BACKFILL_ENABLED, Backfill
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд общий список ждет ответа одного аккаунта
+INBOX_ACCOUNT_TIMEOUT = float(os.getenv('INBOX_ACCOUNT_TIMEOUT', 5))
+
+class Account:
+    """
+    Клиент, хранилище, синхронизация, снимок списка чатов, очередь отправки
+    и загрузка истории одного аккаунта
+    """
+
+    def __init__(self, name, client, store):
+        self.name = name
+        self.client = client
+        self.store = store
+        self.sync = ConversationSync(client, store)
+        self.chat_list = ChatListCache(self.sync)
+        self.outbox = Outbox(client, store.database_url)
+        self.backfill = Backfill(client, store)
+        self.ready = False
+        self.connect_task = None
+
+    @classmethod
+    def from_config(cls, account):
+        """Создать аккаунт из записи Config.accounts()"""
+        client = TelegramConversationClient(
+            account_name=account['name'],
+            session_name=account['session'],
+            phone_number=account['phone_number'],
+            api_id=account['api_id'],
+            api_hash=account['api_hash']
+        )
+        return cls(account['name'], client, MessageStore(account['database_url']))
+
+    async def on_authorized(self):
+        """
+        Запустить фоновую работу аккаунта после входа в Telegram: обновление
+        снимка списка чатов и загрузку истории. Вызывается при подключении
+        и после ввода кода; повторный вызов безопасен.
+        """
+        self.chat_list.start()
+        if self.chat_list.chats is not None:
+            # Снимок из хранилища мог устареть за время простоя
+            self.chat_list.invalidate()
+        if BACKFILL_ENABLED:
+            try:
+                chats, _ = await self.chat_list.get()
+            except Exception as e:
+                logger.error(f"Загрузка истории аккаунта {self.name} не запущена: {e}")
+                return
+            self.backfill.start([chat['chat_id'] for chat in chats])
+
+    async def record_update(self, delta):
+        """
+        Записать событие Telegram в хранилище и применить его к снимку списка чатов.
+        Правки и удаления меняют сохраненные строки на месте; удалению без chat_id
+        проставляется чат, если удаленные сообщения нашлись в одном чате.
+        """
+        if delta['type'] == 'new_message':
+            await self.sync.note_message(delta['chat_id'], delta['message'])
+        elif delta['type'] == 'message_edited':
+            await self.store.apply_edit(delta['chat_id'], delta['message_id'], delta['changes'])
+        elif delta['type'] == 'message_deleted':
+            located = await self.store.mark_deleted(delta['chat_id'], delta['message_ids'])
+            if delta['chat_id'] is None and len(located) == 1:
+                delta['chat_id'] = next(iter(located))
+        self.chat_list.apply_update(delta)
+
+class ClientPool:
+    """
+    Аккаунты по имени. Аккаунты подключаются и опрашиваются независимо,
+    поэтому медленный или ограниченный FloodWait аккаунт не задерживает остальные.
+    """
+
+    def __init__(self, accounts=()):
+        self.accounts = OrderedDict()
+        for account in accounts:
+            self.add(account)
+
+    def add(self, account):
+        self.accounts[account.name] = account
+
+    def get(self, name=None):
+        """Аккаунт по имени; без имени - первый (аккаунт по умолчанию)"""
+        if name is None:
+            return next(iter(self.accounts.values()), None)
+        return self.accounts.get(name)
+
+    def __iter__(self):
+        return iter(self.accounts.values())
+
+    def __len__(self):
+        return len(self.accounts)
+
+    async def start(self, update_handler=None):
+        """
+        Подготовить хранилища и показать последний сохраненный список чатов.
+        Подключение к Telegram идет в фоне (connect_task), поэтому сервис
+        отвечает из локального хранилища сразу после запуска.
+        """
+        async def start_account(account):
+            await account.store.init()
+            account.client.peers.load(await account.store.get_peers())
+            account.client.peers.start(account.store.save_peers)
+            account.chat_list.seed(await account.store.get_chats())
+            account.outbox.start()
+            if update_handler:
+                account.client.add_update_handler(
+                    lambda delta, account=account: update_handler(account, delta)
+                )
+            account.ready = True
+            account.connect_task = asyncio.create_task(self._connect(account))
+
+        await asyncio.gather(*[start_account(account) for account in self])
+
+    async def _connect(self, account):
+        try:
+            await account.client.connect()
+        except Exception as e:
+            logger.error(f"Не удалось подключить аккаунт {account.name}: {e}")
+            return
+        if not account.client.connected:
+            # Сессия не авторизована: обращаться к Telegram до ввода кода бессмысленно
+            logger.warning(f"Аккаунт {account.name} не авторизован, требуется код подтверждения")
+            return
+        logger.info(f"Аккаунт {account.name} подключен к Telegram")
+        await account.on_authorized()
+
+    async def wait_connected(self):
+        """Дождаться завершения фоновых подключений"""
+        tasks = [account.connect_task for account in self if account.connect_task]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def stop(self):
+        async def stop_account(account):
+            if account.connect_task:
+                account.connect_task.cancel()
+            await account.backfill.stop()
+            await account.outbox.stop()
+            await account.chat_list.stop()
+            await account.client.disconnect()
+            await account.client.peers.stop()
+
+        await asyncio.gather(*[stop_account(account) for account in self], return_exceptions=True)
+
+    async def inbox(self, timeout=INBOX_ACCOUNT_TIMEOUT, limit=None, cursor=None):
+        """
+        Общий список чатов всех аккаунтов, сначала самые свежие.
+
+        Аккаунты опрашиваются параллельно; если аккаунт под FloodWait,
+        еще не подключен, не ответил за timeout секунд или вернул ошибку,
+        используется его последний снимок. Снимки аккаунтов уже отсортированы,
+        поэтому они сливаются лениво: для первых limit чатов не нужно
+        сортировать весь список. Возвращает ({'chats', 'next_cursor'}, ETag).
+        """
+        async def account_snapshot(account):
+            if (account.client.flood_wait_remaining() or account.chat_list.chats is not None
+                    or not account.client.connected):
+                return account.chat_list.etag
+            try:
+                await asyncio.wait_for(account.chat_list.get(), timeout)
+            except Exception as e:
+                logger.warning(f"Аккаунт {account.name} пропущен в общем списке: {e}")
+            return account.chat_list.etag
+
+        etags = await asyncio.gather(*[account_snapshot(account) for account in self])
+        page = await merge_newest_first(
+            {account.name: iterate(account.chat_list.by_date()) for account in self},
+            limit=limit, cursor=cursor
+        )
+        digest = hashlib.sha1('|'.join(str(etag) for etag in etags).encode('utf-8')).hexdigest()
+        return {'chats': page['items'], 'next_cursor': page['next_cursor']}, f'"{digest}"'
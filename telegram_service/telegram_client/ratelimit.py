@@ -0,0 +1,40 @@
+"""
+Ограничение частоты запросов
+"""
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self):
+        """Через сколько секунд будет доступен токен (0 - доступен сейчас)"""
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    async def acquire(self):
+        """Дождаться токена и забрать его"""
+        while True:
+            wait = self.delay()
+            if not wait:
+                self.take()
+                return
+            await asyncio.sleep(wait)
@@ -0,0 +1,651 @@
+"""
+Локальный RPC между процессом-владельцем подключения к Telegram и рабочими процессами API
+
+Файл сессии Telegram допускает одно подключение, поэтому при запуске uvicorn
+с несколькими рабочими процессами подключение держит отдельный процесс-владелец
+(python -m telegram_api.owner). Рабочие процессы не подключаются к Telegram:
+они обращаются к владельцу через Unix-сокет и получают от него поток событий
+для своих клиентов WebSocket.
+
+Протокол - по одному JSON-кадру на строку:
+    запрос   {"id": 1, "method": "chats", "params": {...}}
+    ответ    {"id": 1, "result": ...} или {"id": 1, "error": {"type", "message"}}
+    событие  {"event": {"type": "status" | "update" | "resync", ...}}
+"""
+import asyncio
+import base64
+import logging
+import os
+import time
+from . import metrics
+from .chat_list import ChatListCache
+from .pool import ClientPool
+from .serialization import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+# Наибольший кадр; список чатов большого аккаунта занимает мегабайты
+RPC_MAX_FRAME_BYTES = int(os.getenv('RPC_MAX_FRAME_BYTES', 64 * 1024 * 1024))
+# Как часто владелец проверяет состояние аккаунтов и рассылает его при изменении, секунды
+RPC_STATUS_INTERVAL = float(os.getenv('RPC_STATUS_INTERVAL', 1))
+# Сообщений в одной порции потоковой выгрузки
+RPC_STREAM_BATCH = int(os.getenv('RPC_STREAM_BATCH', 500))
+# Сколько событий может ждать отправки одному рабочему процессу
+RPC_EVENT_QUEUE_SIZE = int(os.getenv('RPC_EVENT_QUEUE_SIZE', 1024))
+# Пауза между попытками подключиться к владельцу, секунды
+RPC_RECONNECT_SECONDS = float(os.getenv('RPC_RECONNECT_SECONDS', 1))
+
+class RPCError(Exception):
+    """Ошибка, возникшая в процессе-владельце; kind - имя исходного исключения"""
+
+    def __init__(self, message, kind='Exception', seconds=None):
+        super().__init__(message)
+        self.kind = kind
+        self.seconds = seconds
+
+def encode(frame):
+    return dumps(frame) + b'\n'
+
+def error_payload(error):
+    payload = {'type': type(error).__name__, 'message': str(error)}
+    seconds = getattr(error, 'seconds', None)
+    if isinstance(seconds, (int, float)):
+        payload['seconds'] = seconds
+    return payload
+
+def payload_error(payload):
+    """Ошибка владельца -> исключение; ValueError (неверный курсор и т. п.) сохраняет тип"""
+    if payload['type'] == 'ValueError':
+        return ValueError(payload['message'])
+    return RPCError(payload['message'], payload['type'], payload.get('seconds'))
+
+def encode_media(result):
+    if result is None:
+        return None
+    data, mime_type = result
+    return {'data': base64.b64encode(data).decode('ascii'), 'mime_type': mime_type}
+
+def decode_media(payload):
+    if payload is None:
+        return None
+    return base64.b64decode(payload['data']), payload['mime_type']
+
+async def _raise(error):
+    raise error
+    yield
+
+class _Peer:
+    """Соединение рабочего процесса на стороне владельца"""
+
+    def __init__(self, writer, queue_size):
+        self.writer = writer
+        self.events = asyncio.Queue(maxsize=queue_size)
+        self.lock = asyncio.Lock()
+        self.subscribed = False
+        self.streams = {}
+        self.dropped = 0
+        self.task = None
+
+    async def send(self, frame):
+        async with self.lock:
+            self.writer.write(encode(frame))
+            await self.writer.drain()
+
+class OwnerServer:
+    """
+    Сторона владельца: отвечает на запросы рабочих процессов от имени пула
+    аккаунтов и рассылает подписанным процессам события Telegram и изменения
+    состояния аккаунтов (подключение, FloodWait, ETag списка чатов).
+
+    У каждого рабочего процесса своя ограниченная очередь событий; если процесс
+    не успевает их читать, накопленное заменяется одним событием resync.
+    """
+
+    def __init__(self, pool, path, status_interval=RPC_STATUS_INTERVAL,
+                 queue_size=RPC_EVENT_QUEUE_SIZE, stream_batch=RPC_STREAM_BATCH):
+        self.pool = pool
+        self.path = path
+        self.status_interval = status_interval
+        self.queue_size = queue_size
+        self.stream_batch = stream_batch
+        self.peers = set()
+        self._server = None
+        self._status_task = None
+        self._last_status = None
+        self._next_stream = 0
+        self.methods = {
+            'subscribe': self._subscribe,
+            'chats': self._chats,
+            'inbox': self._inbox,
+            'messages_page': self._messages_page,
+            'search': self._search,
+            'enqueue': self._enqueue,
+            'get_job': self._get_job,
+            'sync_status': self._sync_status,
+            'connect': self._connect,
+            'download_chat_photo': self._download_chat_photo,
+            'download_message_media': self._download_message_media,
+            'open_stream': self._open_stream,
+            'stream_next': self._stream_next,
+            'stream_close': self._stream_close,
+        }
+
+    async def start(self):
+        if os.path.exists(self.path):
+            # Сокет, оставшийся от прошлого запуска
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._serve, path=self.path, limit=RPC_MAX_FRAME_BYTES)
+        self._status_task = asyncio.create_task(self._watch_status())
+        logger.info(f"Владелец подключения Telegram слушает {self.path}")
+
+    async def stop(self):
+        if self._status_task:
+            self._status_task.cancel()
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        for peer in list(self.peers):
+            peer.writer.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def handle_update(self, account, delta):
+        """Обработчик событий пула: записать событие и разослать его рабочим процессам"""
+        try:
+            await account.record_update(delta)
+        except Exception as e:
+            logger.error(f"Ошибка обработки обновления {delta['type']}: {e}")
+        self.publish({'type': 'update', 'account': account.name, 'delta': delta,
+                      'chats_etag': account.chat_list.etag})
+
+    def status(self):
+        return {'type': 'status', 'accounts': [
+            {
+                'name': account.name,
+                'ready': account.ready,
+                'connected': account.client.connected,
+                'flood_wait_seconds': round(account.client.flood_wait_remaining()),
+                'chats_loaded': account.chat_list.chats is not None,
+                'chats_etag': account.chat_list.etag
+            }
+            for account in self.pool
+        ]}
+
+    def publish(self, event):
+        for peer in list(self.peers):
+            if not peer.subscribed:
+                continue
+            try:
+                peer.events.put_nowait(event)
+            except asyncio.QueueFull:
+                peer.dropped += peer.events.qsize()
+                while not peer.events.empty():
+                    peer.events.get_nowait()
+                peer.events.put_nowait({'type': 'resync'})
+                logger.warning(f"Рабочий процесс не успевает получать события, отправлен resync "
+                               f"(всего пропущено {peer.dropped})")
+
+    async def _watch_status(self):
+        while True:
+            await asyncio.sleep(self.status_interval)
+            status = self.status()
+            if status != self._last_status:
+                self._last_status = status
+                self.publish(status)
+
+    async def _serve(self, reader, writer):
+        peer = _Peer(writer, self.queue_size)
+        self.peers.add(peer)
+        peer.task = asyncio.create_task(self._write_events(peer))
+        calls = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                call = asyncio.create_task(self._dispatch(peer, loads(line)))
+                calls.add(call)
+                call.add_done_callback(calls.discard)
+        except Exception as e:
+            logger.warning(f"Соединение рабочего процесса закрыто: {e}")
+        finally:
+            self.peers.discard(peer)
+            peer.task.cancel()
+            for call in calls:
+                call.cancel()
+            for stream in peer.streams.values():
+                await stream.aclose()
+            writer.close()
+
+    async def _write_events(self, peer):
+        try:
+            while True:
+                event = await peer.events.get()
+                await peer.send({'event': event})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.info(f"Не удалось отправить событие рабочему процессу: {e}")
+
+    async def _dispatch(self, peer, frame):
+        try:
+            method = self.methods.get(frame.get('method'))
+            if method is None:
+                raise LookupError(f"Неизвестный метод {frame.get('method')}")
+            reply = {'id': frame['id'], 'result': await method(peer, **(frame.get('params') or {}))}
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            reply = {'id': frame.get('id'), 'error': error_payload(e)}
+        try:
+            await peer.send(reply)
+        except Exception as e:
+            logger.info(f"Не удалось отправить ответ рабочему процессу: {e}")
+
+    def _account(self, name):
+        account = self.pool.get(name)
+        if account is None:
+            raise LookupError(f"Аккаунт {name} не найден")
+        return account
+
+    async def _subscribe(self, peer):
+        peer.subscribed = True
+        return self.status()
+
+    async def _chats(self, peer, account, etag=None):
+        """Снимок списка чатов; если ETag рабочего процесса совпадает - только ETag"""
+        account = self._account(account)
+        chat_list = account.chat_list
+        if chat_list.chats is None and not account.client.connected:
+            raise ConnectionError("Идет подключение к Telegram, список чатов еще не загружен")
+        await chat_list.get()
+        if etag and etag == chat_list.etag:
+            return {'etag': chat_list.etag}
+        return {'etag': chat_list.etag, 'chats': chat_list.chats}
+
+    async def _inbox(self, peer, limit=None, cursor=None):
+        page, etag = await self.pool.inbox(limit=limit, cursor=cursor)
+        return {'page': page, 'etag': etag}
+
+    async def _messages_page(self, peer, account, chat_id, limit=50, before_id=None, after_id=None):
+        return await self._account(account).sync.get_messages_page(chat_id, limit, before_id=before_id,
+                                                                   after_id=after_id)
+
+    async def _search(self, peer, account, query, **filters):
+        return await self._account(account).store.search(query, **filters)
+
+    async def _enqueue(self, peer, account, chat_id, text):
+        return await self._account(account).outbox.enqueue(chat_id, text)
+
+    async def _get_job(self, peer, account, job_id):
+        return await self._account(account).outbox.get_job(job_id)
+
+    async def _sync_status(self, peer, account):
+        return await self._account(account).backfill.status()
+
+    async def _connect(self, peer, account, code=None, password=None):
+        selected = self._account(account)
+        if code:
+            selected.client.set_auth_code(code)
+        if password:
+            selected.client.set_password(password)
+        await selected.client.connect()
+        if selected.client.connected:
+            await selected.on_authorized()
+        return selected.client.connected
+
+    async def _download_chat_photo(self, peer, account, chat_id):
+        return encode_media(await self._account(account).client.download_chat_photo(chat_id))
+
+    async def _download_message_media(self, peer, account, chat_id, message_id):
+        return encode_media(await self._account(account).client.download_message_media(chat_id, message_id))
+
+    async def _open_stream(self, peer, account, source, chat_id, from_id=0):
+        """Начать выгрузку истории чата (source: telegram или store), вернуть первую порцию"""
+        account = self._account(account)
+        if source == 'store':
+            messages = account.store.iter_messages(chat_id, from_id)
+        else:
+            messages = account.client.iter_history(chat_id, from_id)
+        self._next_stream += 1
+        peer.streams[self._next_stream] = messages
+        return dict(await self._stream_next(peer, self._next_stream), stream=self._next_stream)
+
+    async def _stream_next(self, peer, stream):
+        """Следующая порция выгрузки; выгрузка читается по запросу, а не проталкивается"""
+        messages = peer.streams[stream]
+        items = []
+        try:
+            while len(items) < self.stream_batch:
+                items.append(await messages.__anext__())
+        except StopAsyncIteration:
+            del peer.streams[stream]
+            return {'items': items, 'done': True}
+        except Exception as e:
+            if not items:
+                del peer.streams[stream]
+                raise
+            # Уже полученное отдается, ошибка - следующей порцией
+            peer.streams[stream] = _raise(e)
+        return {'items': items, 'done': False}
+
+    async def _stream_close(self, peer, stream):
+        messages = peer.streams.pop(stream, None)
+        if messages is not None:
+            await messages.aclose()
+        return None
+
+class OwnerConnection:
+    """
+    Сторона рабочего процесса: одно соединение с владельцем на процесс, запросы
+    мультиплексируются по id. Соединение поднимается и восстанавливается в фоне;
+    после каждого подключения on_event получает {'type': 'subscribed', ...}
+    с состоянием аккаунтов, после обрыва - {'type': 'disconnected'}.
+    """
+
+    def __init__(self, path, on_event, reconnect_interval=RPC_RECONNECT_SECONDS):
+        self.path = path
+        self.on_event = on_event
+        self.reconnect_interval = reconnect_interval
+        self.connected = False
+        self._writer = None
+        self._lock = None
+        self._pending = {}
+        self._next_id = 0
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def call(self, method, **params):
+        """Вызвать метод владельца; ошибки владельца поднимаются как RPCError или ValueError"""
+        if not self.connected:
+            raise ConnectionError("Нет соединения с процессом-владельцем Telegram")
+        self._next_id += 1
+        request_id = self._next_id
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            async with self._lock:
+                self._writer.write(encode({'id': request_id, 'method': method, 'params': params}))
+                await self._writer.drain()
+            return await future
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def stream(self, source, **params):
+        """Асинхронный итератор по выгрузке истории, читаемой у владельца порциями"""
+        result = await self.call('open_stream', source=source, **params)
+        stream = result['stream']
+        try:
+            while True:
+                for item in result['items']:
+                    yield item
+                if result['done']:
+                    return
+                result = await self.call('stream_next', stream=stream)
+        finally:
+            if not result['done'] and self.connected:
+                try:
+                    await self.call('stream_close', stream=stream)
+                except Exception:
+                    pass
+
+    async def _run(self):
+        while True:
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(self.path, limit=RPC_MAX_FRAME_BYTES)
+            except OSError as e:
+                logger.warning(f"Владелец подключения Telegram недоступен ({self.path}): {e}")
+                await asyncio.sleep(self.reconnect_interval)
+                continue
+            self._lock = asyncio.Lock()
+            self.connected = True
+            subscribe = asyncio.create_task(self._subscribe())
+            try:
+                await self._read(reader)
+            except Exception as e:
+                logger.warning(f"Ошибка соединения с владельцем подключения Telegram: {e}")
+            finally:
+                self.connected = False
+                subscribe.cancel()
+                self._writer.close()
+                for future in self._pending.values():
+                    if not future.done():
+                        future.set_exception(ConnectionError("Соединение с процессом-владельцем Telegram потеряно"))
+            await self._notify({'type': 'disconnected'})
+            await asyncio.sleep(self.reconnect_interval)
+
+    async def _subscribe(self):
+        try:
+            status = await self.call('subscribe')
+        except Exception as e:
+            logger.warning(f"Не удалось подписаться на события владельца: {e}")
+            return
+        await self._notify(dict(status, type='subscribed'))
+
+    async def _read(self, reader):
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            frame = loads(line)
+            if 'event' in frame:
+                await self._notify(frame['event'])
+                continue
+            future = self._pending.get(frame.get('id'))
+            if future is None or future.done():
+                continue
+            if 'error' in frame:
+                future.set_exception(payload_error(frame['error']))
+            else:
+                future.set_result(frame['result'])
+
+    async def _notify(self, event):
+        try:
+            await self.on_event(event)
+        except Exception as e:
+            logger.error(f"Ошибка обработки события владельца {event.get('type')}: {e}")
+
+class _Remote:
+    def __init__(self, account_name, connection):
+        self.account_name = account_name
+        self.connection = connection
+
+    def _call(self, method, **params):
+        return self.connection.call(method, account=self.account_name, **params)
+
+class RemoteClient(_Remote):
+    """Клиент аккаунта в рабочем процессе: состояние приходит от владельца, вызовы уходят ему"""
+
+    def __init__(self, account_name, connection):
+        super().__init__(account_name, connection)
+        self.connected = False
+        self.flood_wait_until = 0.0
+        self.phone_code = None
+        self.password = None
+
+    def flood_wait_remaining(self):
+        return max(0.0, self.flood_wait_until - time.monotonic())
+
+    def update_status(self, entry):
+        self.connected = entry['connected']
+        self.flood_wait_until = time.monotonic() + entry['flood_wait_seconds']
+
+    def set_auth_code(self, code):
+        self.phone_code = code
+
+    def set_password(self, password):
+        """Пароль передается владельцу вместе со следующим connect()"""
+        self.password = password
+
+    async def connect(self):
+        self.connected = await self._call('connect', code=self.phone_code, password=self.password)
+
+    async def download_chat_photo(self, chat_id):
+        return decode_media(await self._call('download_chat_photo', chat_id=chat_id))
+
+    async def download_message_media(self, chat_id, message_id):
+        return decode_media(await self._call('download_message_media', chat_id=chat_id, message_id=message_id))
+
+    def iter_history(self, chat_id, from_id=0):
+        return self.connection.stream('telegram', account=self.account_name, chat_id=chat_id, from_id=from_id)
+
+class RemoteStore(_Remote):
+    async def search(self, query, **filters):
+        return await self._call('search', query=query, **filters)
+
+    def iter_messages(self, chat_id, from_id=0):
+        return self.connection.stream('store', account=self.account_name, chat_id=chat_id, from_id=from_id)
+
+class RemoteSync(_Remote):
+    async def get_messages_page(self, chat_id, limit=50, before_id=None, after_id=None):
+        return await self._call('messages_page', chat_id=chat_id, limit=limit, before_id=before_id,
+                                after_id=after_id)
+
+class RemoteOutbox(_Remote):
+    async def enqueue(self, chat_id, text):
+        return await self._call('enqueue', chat_id=chat_id, text=text)
+
+    async def get_job(self, job_id):
+        return await self._call('get_job', job_id=job_id)
+
+class RemoteBackfill(_Remote):
+    async def status(self):
+        return await self._call('sync_status')
+
+class RemoteChatList(ChatListCache):
+    """
+    Копия снимка списка чатов владельца. Новые сообщения применяются к копии
+    так же, как у владельца, поэтому обычно ее ETag совпадает с ETag владельца
+    без повторной передачи списка; при расхождении копия перечитывается
+    при следующем обращении.
+    """
+
+    def __init__(self, account_name, connection):
+        super().__init__(sync=None)
+        self.account_name = account_name
+        self.connection = connection
+        self.remote_etag = None
+        self.remote_loaded = False
+
+    @property
+    def loaded(self):
+        return self.chats is not None or self.remote_loaded
+
+    async def get(self):
+        fresh = self.chats is not None and self.etag == self.remote_etag
+        metrics.cache_lookup('chat_list', fresh)
+        if not fresh:
+            await self.refresh()
+        return self.chats, self.etag
+
+    async def refresh(self):
+        async with self._lock:
+            if self.chats is not None and self.etag == self.remote_etag:
+                return
+            result = await self.connection.call('chats', account=self.account_name, etag=self.etag)
+            if 'chats' in result:
+                self._publish(result['chats'])
+            self.etag = self.remote_etag = result['etag']
+
+class RemoteAccount:
+    """Аккаунт рабочего процесса с тем же интерфейсом, что и pool.Account"""
+
+    def __init__(self, name, connection):
+        self.name = name
+        self.client = RemoteClient(name, connection)
+        self.store = RemoteStore(name, connection)
+        self.sync = RemoteSync(name, connection)
+        self.outbox = RemoteOutbox(name, connection)
+        self.backfill = RemoteBackfill(name, connection)
+        self.chat_list = RemoteChatList(name, connection)
+        self.ready = False
+        self.connect_task = None
+
+    async def on_authorized(self):
+        """Фоновую работу аккаунта запускает владелец в ответ на connect"""
+
+    async def record_update(self, delta):
+        """Владелец уже записал событие в хранилище; обновляется только копия списка чатов"""
+        self.chat_list.apply_update(delta)
+
+class RemotePool(ClientPool):
+    """
+    Пул рабочего процесса: аккаунты владельца, вызовы которых уходят владельцу
+    через Unix-сокет. События Telegram приходят от владельца и передаются
+    update_handler так же, как в ClientPool.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.connection = OwnerConnection(path, self._on_event)
+        self.update_handler = None
+        self._subscribed = asyncio.Event()
+
+    async def start(self, update_handler=None):
+        """Подключиться к владельцу; ждет, пока владелец не начнет принимать соединения"""
+        self.update_handler = update_handler
+        self.connection.start()
+        await self._subscribed.wait()
+
+    async def stop(self):
+        await self.connection.stop()
+
+    async def inbox(self, timeout=None, limit=None, cursor=None):
+        result = await self.connection.call('inbox', limit=limit, cursor=cursor)
+        return result['page'], result['etag']
+
+    async def _on_event(self, event):
+        if event['type'] == 'subscribed':
+            reconnected = self._subscribed.is_set()
+            for entry in event['accounts']:
+                if self.get(entry['name']) is None:
+                    self.add(RemoteAccount(entry['name'], self.connection))
+            self._apply_status(event)
+            self._subscribed.set()
+            if reconnected:
+                # Пока соединения не было, события могли быть пропущены
+                await self._resync()
+        elif event['type'] == 'disconnected':
+            for account in self:
+                account.ready = False
+                account.client.connected = False
+        elif event['type'] == 'status':
+            self._apply_status(event)
+        elif event['type'] == 'update':
+            account = self.get(event['account'])
+            if account is None:
+                return
+            account.chat_list.remote_etag = event['chats_etag']
+            if self.update_handler:
+                await self.update_handler(account, event['delta'])
+        elif event['type'] == 'resync':
+            await self._resync()
+
+    def _apply_status(self, status):
+        for entry in status['accounts']:
+            account = self.get(entry['name'])
+            if account is None:
+                continue
+            account.ready = entry['ready']
+            account.client.update_status(entry)
+            account.chat_list.remote_loaded = entry['chats_loaded']
+            account.chat_list.remote_etag = entry['chats_etag']
+
+    async def _resync(self):
+        """Сообщить клиентам WebSocket, что события пропущены и данные нужно перечитать"""
+        for account in self:
+            account.chat_list.remote_etag = None
+            if self.update_handler:
+                await self.update_handler(account, {'type': 'resync', 'chat_id': None})
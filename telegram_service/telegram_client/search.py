@@ -0,0 +1,150 @@
+"""
+Полнотекстовый поиск по сохраненным сообщениям (SQLite FTS5)
+"""
+import html
+import logging
+import os
+from sqlalchemy import DateTime, bindparam, text
+from .models import TelegramMessage
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = 'telegram_messages_fts'
+
+# unicode61 приводит к нижнему регистру кириллицу и татарские буквы;
+# 'trigram' (SQLite 3.34+) дает поиск по подстроке ценой большего индекса
+SEARCH_TOKENIZER = os.getenv('SEARCH_TOKENIZER', 'unicode61 remove_diacritics 2')
+
+SNIPPET_TOKENS = 12
+# Границы совпадений в snippet(); заменяются на <b></b> после экранирования текста
+_MATCH_START, _MATCH_END = '\x02', '\x03'
+
+def _schema_statements():
+    messages = TelegramMessage.__tablename__
+    columns = "text_content, sender_name"
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+        f"{columns}, content='{messages}', tokenize='{SEARCH_TOKENIZER}')",
+        # Триггеры поддерживают индекс при любой записи, включая пакетный upsert
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON {messages} BEGIN "
+        f"INSERT INTO {FTS_TABLE}(rowid, {columns}) VALUES (new.rowid, new.text_content, new.sender_name); END",
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON {messages} BEGIN "
+        f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {columns}) "
+        f"VALUES ('delete', old.rowid, old.text_content, old.sender_name); END",
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF text_content, sender_name ON {messages} BEGIN "
+        f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {columns}) "
+        f"VALUES ('delete', old.rowid, old.text_content, old.sender_name); "
+        f"INSERT INTO {FTS_TABLE}(rowid, {columns}) VALUES (new.rowid, new.text_content, new.sender_name); END",
+    ]
+
+def create_search_index(conn):
+    """
+    Создать индекс FTS5 и триггеры (синхронный conn, через run_sync).
+    Уже сохраненные сообщения индексируются при первом создании.
+    """
+    if conn.dialect.name != 'sqlite':
+        return
+    exists = conn.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"
+    ), {'name': FTS_TABLE}).first()
+    for statement in _schema_statements():
+        conn.execute(text(statement))
+    if not exists:
+        conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+        logger.info("Создан полнотекстовый индекс сообщений")
+
+def fts_query(query):
+    """Строка пользователя -> запрос FTS5: каждое слово ищется как префикс"""
+    terms = query.split()
+    return ' '.join('"%s"*' % term.replace('"', '""') for term in terms)
+
+def highlight(snippet):
+    """Фрагмент с маркерами совпадений -> безопасный HTML с <b> вокруг совпадений"""
+    if snippet is None:
+        return None
+    return html.escape(snippet).replace(_MATCH_START, '<b>').replace(_MATCH_END, '</b>')
+
+def _filters(chat_id, sender, date_from, date_to):
+    clauses, params = [], {}
+    if chat_id:
+        clauses.append("m.chat_id = :chat_id")
+        params['chat_id'] = str(chat_id)
+    if sender:
+        clauses.append("m.sender_name = :sender")
+        params['sender'] = sender
+    if date_from:
+        clauses.append("m.created_at >= :date_from")
+        params['date_from'] = date_from
+    if date_to:
+        clauses.append("m.created_at < :date_to")
+        params['date_to'] = date_to
+    clauses.append("COALESCE(m.is_deleted, 0) = 0")
+    return clauses, params
+
+async def search_messages(session, query, chat_id=None, sender=None, date_from=None,
+                          date_to=None, limit=20, cursor=None):
+    """
+    Найти сообщения по тексту. Результаты упорядочены по релевантности (bm25);
+    cursor - значение next_cursor предыдущей страницы, date_from/date_to - datetime в UTC.
+    """
+    match = fts_query(query)
+    if not match:
+        return {'results': [], 'next_cursor': None}
+    limit = max(limit, 1)
+    clauses, params = _filters(chat_id, sender, date_from, date_to)
+    params.update({'limit': limit + 1})
+    dialect = session.bind.dialect.name
+
+    if dialect == 'sqlite':
+        clauses.insert(0, f"{FTS_TABLE} MATCH :match")
+        params.update({'match': match, 'match_start': _MATCH_START, 'match_end': _MATCH_END})
+        if cursor:
+            score, rowid = cursor.rsplit(':', 1)
+            clauses.append(f"(bm25({FTS_TABLE}) > :score OR (bm25({FTS_TABLE}) = :score AND m.rowid > :rowid))")
+            params.update({'score': float(score), 'rowid': int(rowid)})
+        sql = (
+            f"SELECT m.rowid AS rowid, m.chat_id, m.message_id, m.created_at, m.sender_name, m.from_me, "
+            f"snippet({FTS_TABLE}, 0, :match_start, :match_end, '…', {SNIPPET_TOKENS}) AS snippet, "
+            f"bm25({FTS_TABLE}) AS score "
+            f"FROM {FTS_TABLE} JOIN {TelegramMessage.__tablename__} m ON m.rowid = {FTS_TABLE}.rowid "
+            f"WHERE {' AND '.join(clauses)} ORDER BY score, m.rowid LIMIT :limit"
+        )
+    else:
+        # Без FTS5: поиск подстроки, сначала новые сообщения
+        for index, term in enumerate(query.split()):
+            clauses.append(f"m.text_content LIKE :term{index}")
+            params[f'term{index}'] = f"%{term}%"
+        if cursor:
+            clauses.append("m.id < :rowid")
+            params['rowid'] = int(cursor.rsplit(':', 1)[-1])
+        sql = (
+            f"SELECT m.id AS rowid, m.chat_id, m.message_id, m.created_at, m.sender_name, m.from_me, "
+            f"m.text_content AS snippet, 0 AS score FROM {TelegramMessage.__tablename__} m "
+            f"WHERE {' AND '.join(clauses)} ORDER BY m.id DESC LIMIT :limit"
+        )
+
+    statement = text(sql).columns(created_at=DateTime)
+    statement = statement.bindparams(*[
+        bindparam(name, type_=DateTime) for name in ('date_from', 'date_to') if name in params
+    ])
+    rows = (await session.execute(statement, params)).mappings().all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = f"{last['score']!r}:{last['rowid']}"
+    return {
+        'results': [
+            {
+                'chat_id': row['chat_id'],
+                'message_id': str(row['message_id']),
+                'created_at': row['created_at'],
+                'sender_name': row['sender_name'],
+                'from_me': bool(row['from_me']),
+                'snippet': highlight(row['snippet']),
+                'score': row['score']
+            }
+            for row in rows
+        ],
+        'next_cursor': next_cursor
+    }
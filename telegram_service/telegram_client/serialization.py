@@ -0,0 +1,34 @@
+"""
+Быстрая сериализация ответов в JSON и выбор полей (?fields=)
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен: без него используется стандартный json
+    orjson = None
+
+def dumps(value):
+    """Объект -> JSON в байтах (UTF-8, без лишних пробелов)"""
+    if orjson is not None:
+        return orjson.dumps(value, default=str)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8')
+
+def loads(data):
+    """JSON в байтах или строке -> объект"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def parse_fields(fields):
+    """Строка "a,b,c" из параметра запроса -> кортеж имен полей или None (все поля)"""
+    if not fields:
+        return None
+    names = tuple(dict.fromkeys(name.strip() for name in fields.split(',') if name.strip()))
+    return names or None
+
+def project(records, fields):
+    """Оставить в каждой записи только поля fields; неизвестные поля пропускаются"""
+    if not fields:
+        return records
+    return [{name: record[name] for name in fields if name in record} for record in records]
@@ -0,0 +1,254 @@
+"""
+Локальное хранилище чатов и сообщений на основе моделей TelegramChat/TelegramMessage
+"""
+import logging
+from datetime import datetime, timezone
+from sqlalchemy import func, select, update
+from .models import (BackfillCheckpoint, TelegramChat, TelegramMessage, TelegramPeer,
+                     get_async_sessionmaker, init_models)
+from .ingest import BulkIngest
+from .migrations import add_message_columns, add_peer_columns, upgrade_messages_table
+from .search import create_search_index, search_messages
+
+logger = logging.getLogger(__name__)
+
+CHAT_FIELDS = (
+    'user_id', 'platform', 'name', 'unread_count', 'last_message', 'photo_url',
+    'is_verified_read', 'is_no_reply_needed', 'is_pinned', 'account_name'
+)
+
+MESSAGE_FIELDS = (
+    'from_me', 'message_type', 'text_content', 'media_url', 'is_read',
+    'is_delivered', 'sender_name', 'is_edit', 'is_deleted'
+)
+
+def parse_date(value):
+    """ISO-строка из формата CRM -> наивный datetime в UTC для хранения"""
+    if not value:
+        return None
+    date = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+def format_date(value):
+    """Хранимый datetime в UTC -> ISO-строка, как ее отдает Telethon"""
+    return value.replace(tzinfo=timezone.utc).isoformat() if value else None
+
+def chat_to_dict(row):
+    chat = {field: getattr(row, field) for field in CHAT_FIELDS}
+    chat.update({
+        'id': row.chat_id,
+        'chat_id': row.chat_id,
+        'type': row.chat_type,
+        'last_message_date': format_date(row.last_message_date)
+    })
+    return chat
+
+def message_to_dict(row):
+    message = {field: getattr(row, field) for field in MESSAGE_FIELDS}
+    message.update({
+        'id': str(row.message_id),
+        'message_id': str(row.message_id),
+        'chat_id': row.chat_id,
+        'created_at': format_date(row.created_at),
+        'edited_at': format_date(row.edited_at)
+    })
+    return message
+
+def chat_to_row(chat):
+    """
+    Чат в формате CRM -> строка таблицы telegram_chats.
+    В строку попадают только переданные поля, остальные столбцы upsert не трогает.
+    """
+    row = {field: chat[field] for field in CHAT_FIELDS if field in chat}
+    row['chat_id'] = str(chat['chat_id'])
+    if 'type' in chat:
+        row['chat_type'] = chat['type']
+    if 'last_message_date' in chat:
+        row['last_message_date'] = parse_date(chat['last_message_date'])
+    return row
+
+def message_to_row(chat_id, message):
+    """
+    Сообщение в формате CRM -> строка таблицы telegram_messages.
+    В строку попадают только переданные поля, остальные столбцы upsert не трогает.
+    """
+    row = {field: message[field] for field in MESSAGE_FIELDS if field in message}
+    row.update({'chat_id': str(chat_id), 'message_id': int(message['message_id'])})
+    for field in ('created_at', 'edited_at'):
+        if field in message:
+            row[field] = parse_date(message[field])
+    return row
+
+class MessageStore:
+    """Запись и чтение чатов и сообщений в локальной базе данных"""
+
+    def __init__(self, database_url=None):
+        self.database_url = database_url
+        self.Session = get_async_sessionmaker(database_url)
+        self.ingest = BulkIngest(database_url)
+
+    async def init(self):
+        """Создать таблицы и полнотекстовый индекс, если их еще нет; обновить схему старых баз"""
+        async with self.ingest.engine.begin() as conn:
+            await conn.run_sync(upgrade_messages_table)
+            await conn.run_sync(add_message_columns)
+            await conn.run_sync(add_peer_columns)
+        await init_models(self.database_url)
+        async with self.ingest.engine.begin() as conn:
+            await conn.run_sync(create_search_index)
+
+    async def save_chats(self, chats):
+        """Сохранить или обновить список чатов в формате CRM"""
+        return await self.ingest.upsert_chats([chat_to_row(chat) for chat in chats])
+
+    async def save_messages(self, chat_id, messages):
+        """Сохранить или обновить сообщения чата в формате CRM"""
+        return await self.ingest.upsert_messages([message_to_row(chat_id, msg) for msg in messages])
+
+    async def apply_edit(self, chat_id, message_id, changes):
+        """
+        Применить изменение сообщения (событие message_edited) к сохраненной строке.
+        Возвращает False, если сообщения нет в хранилище: оно придет с историей.
+        """
+        values = {field: value for field, value in changes.items() if field in MESSAGE_FIELDS}
+        if 'edited_at' in changes:
+            values['edited_at'] = parse_date(changes['edited_at'])
+        async with self.Session() as session:
+            result = await session.execute(
+                update(TelegramMessage)
+                .where(TelegramMessage.chat_id == str(chat_id), TelegramMessage.message_id == int(message_id))
+                .values(updated_at=datetime.utcnow(), **values)
+            )
+            await session.commit()
+            return result.rowcount > 0
+
+    async def mark_deleted(self, chat_id, message_ids):
+        """
+        Пометить сообщения удаленными (is_deleted); строки остаются надгробиями,
+        чтобы повторная загрузка и поиск знали об удалении.
+
+        Для личных чатов и групп Telegram не сообщает chat_id удаления (None):
+        id таких сообщений общие для аккаунта, поэтому они ищутся во всех
+        чатах, кроме каналов. Возвращает chat_id -> id найденных сообщений.
+        """
+        conditions = [TelegramMessage.message_id.in_([int(msg_id) for msg_id in message_ids])]
+        if chat_id is not None:
+            conditions.append(TelegramMessage.chat_id == str(chat_id))
+        else:
+            channels = select(TelegramPeer.chat_id).where(TelegramPeer.peer_type == 'channel')
+            conditions.append(TelegramMessage.chat_id.notin_(channels))
+        async with self.Session() as session:
+            rows = (await session.execute(
+                select(TelegramMessage.id, TelegramMessage.chat_id, TelegramMessage.message_id).where(*conditions)
+            )).all()
+            if rows:
+                await session.execute(
+                    update(TelegramMessage)
+                    .where(TelegramMessage.id.in_([row.id for row in rows]))
+                    .values(is_deleted=True, updated_at=datetime.utcnow())
+                )
+                await session.commit()
+        located = {}
+        for row in rows:
+            located.setdefault(row.chat_id, []).append(str(row.message_id))
+        return located
+
+    async def save_peers(self, peers):
+        """Сохранить строки таблицы собеседников (см. peers.PeerCache)"""
+        return await self.ingest.upsert_peers(peers)
+
+    async def get_peers(self):
+        """Все сохраненные собеседники для индекса PeerCache"""
+        async with self.Session() as session:
+            result = await session.execute(select(TelegramPeer))
+            return [
+                {'chat_id': row.chat_id, 'peer_type': row.peer_type, 'access_hash': row.access_hash,
+                 'name': row.name, 'username': row.username, 'photo_id': row.photo_id,
+                 'photo_dc_id': row.photo_dc_id}
+                for row in result.scalars()
+            ]
+
+    async def save_checkpoint(self, checkpoint):
+        """Сохранить ход загрузки истории чата (см. backfill.Backfill)"""
+        return await self.ingest.upsert_checkpoints([checkpoint])
+
+    async def get_checkpoints(self):
+        """Сохраненный ход загрузки истории: chat_id -> словарь столбцов telegram_backfill"""
+        async with self.Session() as session:
+            result = await session.execute(select(BackfillCheckpoint))
+            return {
+                row.chat_id: {
+                    'chat_id': row.chat_id, 'oldest_id': row.oldest_id, 'messages': row.messages or 0,
+                    'total': row.total, 'done': bool(row.done), 'last_error': row.last_error
+                }
+                for row in result.scalars()
+            }
+
+    async def get_chats(self):
+        """Получить сохраненные чаты, сначала с самым свежим сообщением"""
+        async with self.Session() as session:
+            result = await session.execute(
+                select(TelegramChat).order_by(TelegramChat.last_message_date.desc())
+            )
+            return [chat_to_dict(row) for row in result.scalars()]
+
+    async def get_messages(self, chat_id, limit=50, before_id=None, after_id=None):
+        """
+        Получить сохраненные сообщения чата (сначала старые) по курсору.
+        Страница - обход диапазона индекса (chat_id, message_id).
+        """
+        message_id = TelegramMessage.message_id
+        query = select(TelegramMessage).where(TelegramMessage.chat_id == str(chat_id))
+        if after_id:
+            query = query.where(message_id > int(after_id)).order_by(message_id.asc())
+        else:
+            if before_id:
+                query = query.where(message_id < int(before_id))
+            query = query.order_by(message_id.desc())
+        async with self.Session() as session:
+            rows = list((await session.execute(query.limit(limit))).scalars())
+        if not after_id:
+            rows.reverse()
+        return [message_to_dict(row) for row in rows]
+
+    async def iter_messages(self, chat_id, from_id=0, batch_size=500):
+        """Все сохраненные сообщения чата после from_id (сначала старые), пачками по batch_size"""
+        message_id = TelegramMessage.message_id
+        last_id = int(from_id or 0)
+        while True:
+            async with self.Session() as session:
+                rows = list((await session.execute(
+                    select(TelegramMessage)
+                    .where(TelegramMessage.chat_id == str(chat_id), message_id > last_id)
+                    .order_by(message_id.asc()).limit(batch_size)
+                )).scalars())
+            for row in rows:
+                yield message_to_dict(row)
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1].message_id
+
+    async def max_message_id(self, chat_id):
+        """Наибольший сохраненный id сообщения в чате или 0"""
+        async with self.Session() as session:
+            value = await session.scalar(
+                select(func.max(TelegramMessage.message_id)).where(
+                    TelegramMessage.chat_id == str(chat_id)
+                )
+            )
+            return value or 0
+
+    async def search(self, query, chat_id=None, sender=None, date_from=None, date_to=None,
+                     limit=20, cursor=None):
+        """Полнотекстовый поиск по сохраненным сообщениям (см. search.search_messages)"""
+        async with self.Session() as session:
+            page = await search_messages(
+                session, query, chat_id=chat_id, sender=sender,
+                date_from=parse_date(date_from), date_to=parse_date(date_to),
+                limit=limit, cursor=cursor
+            )
+        for result in page['results']:
+            result['created_at'] = format_date(result['created_at'])
+        return page
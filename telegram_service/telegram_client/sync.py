@@ -0,0 +1,111 @@
+"""
+Слой синхронизации: чтение чатов и истории из локального хранилища
+с инкрементальной догрузкой из Telegram
+"""
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд история чата считается актуальной, если id последнего сообщения неизвестен
+SYNC_FRESH_SECONDS = int(os.getenv('SYNC_FRESH_SECONDS', 30))
+# Размер страницы и предел страниц при догрузке новых сообщений
+SYNC_PAGE_SIZE = 100
+SYNC_MAX_DELTA_PAGES = 20
+
+class ConversationSync:
+    """
+    Обертка над TelegramConversationClient, записывающая полученные чаты
+    и сообщения в MessageStore и отвечающая на повторные запросы из него
+    """
+
+    def __init__(self, client, store, fresh_for=SYNC_FRESH_SECONDS):
+        self.client = client
+        self.store = store
+        self.fresh_for = fresh_for
+        self._top_ids = {}      # chat_id -> id последнего сообщения по данным диалогов
+        self._synced_max = {}   # chat_id -> наибольший id, полученный из Telegram
+        self._synced_at = {}    # chat_id -> время последней догрузки
+        self._floor = {}        # chat_id -> наименьший загруженный id (0 - история загружена полностью)
+
+    async def get_chats(self):
+        """Получить диалоги из Telegram и сохранить их локально"""
+        chats = await self.client.get_chats()
+        await self.store.save_chats(chats)
+        for chat in chats:
+            if chat.get('last_message_id'):
+                self._top_ids[chat['chat_id']] = chat['last_message_id']
+        return chats
+
+    async def note_message(self, chat_id, message):
+        """Записать сообщение, полученное вне истории (отправка, обновления)"""
+        chat_id = str(chat_id)
+        await self.store.save_messages(chat_id, [message])
+        message_id = int(message['message_id'])
+        self._top_ids[chat_id] = max(self._top_ids.get(chat_id, 0), message_id)
+        self._synced_max[chat_id] = max(self._synced_max.get(chat_id, 0), message_id)
+
+    async def get_messages(self, chat_id, limit=50, before_id=None, after_id=None):
+        page = await self.get_messages_page(chat_id, limit, before_id, after_id)
+        return page['messages']
+
+    async def get_messages_page(self, chat_id, limit=50, before_id=None, after_id=None):
+        """Страница истории в том же формате, что и TelegramConversationClient.get_messages_page"""
+        chat_id = str(chat_id)
+        if not before_id:
+            await self._sync_newer(chat_id)
+        local = await self.store.get_messages(chat_id, limit, before_id=before_id, after_id=after_id)
+        if after_id or len(local) >= limit or self._floor.get(chat_id) == 0:
+            return self._page(chat_id, local, limit, after_id)
+        if not self.client.connected:
+            # Пока Telegram подключается, отдается то, что есть локально
+            return self._page(chat_id, local, limit, after_id)
+
+        # Локально сообщений недостаточно - догрузить более старую историю
+        oldest = [int(local[0]['message_id'])] if local else []
+        if before_id:
+            oldest.append(int(before_id))
+        if self._floor.get(chat_id):
+            oldest.append(self._floor[chat_id])
+        live = await self.client.get_messages_page(chat_id, limit, before_id=min(oldest) if oldest else None)
+        await self.store.save_messages(chat_id, live['messages'])
+        self._floor[chat_id] = int(live['next_cursor']) if live['next_cursor'] else 0
+        if not oldest and live['prev_cursor']:
+            self._synced_max[chat_id] = int(live['prev_cursor'])
+            self._synced_at[chat_id] = time.monotonic()
+
+        local = await self.store.get_messages(chat_id, limit, before_id=before_id)
+        return self._page(chat_id, local, limit, after_id)
+
+    async def _sync_newer(self, chat_id):
+        """Догрузить сообщения новее сохраненного максимума (min_id)"""
+        if not self.client.connected:
+            return
+        known_max = max(await self.store.max_message_id(chat_id), self._synced_max.get(chat_id, 0))
+        if not known_max:
+            return
+        top_id = self._top_ids.get(chat_id)
+        if top_id is not None:
+            if known_max >= top_id:
+                return
+        elif time.monotonic() - self._synced_at.get(chat_id, 0) < self.fresh_for:
+            return
+
+        after_id = known_max
+        for _ in range(SYNC_MAX_DELTA_PAGES):
+            page = await self.client.get_messages_page(chat_id, SYNC_PAGE_SIZE, after_id=after_id)
+            await self.store.save_messages(chat_id, page['messages'])
+            if not page['prev_cursor'] or int(page['prev_cursor']) <= after_id:
+                break
+            after_id = int(page['prev_cursor'])
+        self._synced_max[chat_id] = after_id
+        self._synced_at[chat_id] = time.monotonic()
+
+    def _page(self, chat_id, messages, limit, after_id):
+        ids = [int(msg['message_id']) for msg in messages]
+        next_cursor = None
+        if ids and not after_id and (len(ids) >= limit or self._floor.get(chat_id) != 0):
+            next_cursor = str(min(ids))
+        prev_cursor = str(max(ids)) if ids else (str(after_id) if after_id else None)
+        return {'messages': messages, 'next_cursor': next_cursor, 'prev_cursor': prev_cursor}
@@ -0,0 +1,152 @@
+"""
+In-process stand-in for Telethon's TelegramClient.
+
+Serves a synthetic account with configurable dialog counts, history sizes,
+per-RPC latency and injected FloodWaits, so the client layer and the API can
+be tested and benchmarked without a live Telegram account.
+"""
+import asyncio
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from telethon import utils
+from telethon.errors import FloodWaitError
+from telethon.tl.functions.messages import GetHistoryRequest
+from telethon.tl.types import Message, PeerUser, User
+
+EPOCH = datetime(2023, 1, 1, tzinfo=timezone.utc)
+SELF_ID = 1
+
+class FakeDialogMessage:
+    """Last message of a dialog, as far as get_chats looks at it"""
+
+    def __init__(self, msg_id, text):
+        self.id = msg_id
+        self.text = text
+
+    def __str__(self):
+        return self.text
+
+class FakeTelegramClient:
+    """
+    Fake account with `dialogs` private chats of `history` messages each.
+
+    Chat ids start at 1000; message ids run 1..history in every chat, and
+    message N of a chat was sent N minutes after EPOCH. Every RPC sleeps
+    `latency` seconds; with `flood_every` set, every flood_every-th RPC
+    raises FloodWaitError(flood_seconds) instead. `calls` counts RPCs by name.
+
+    `emit` passes an event to the registered handlers the way Telethon's
+    update loop does, both for live updates and for ones it fetched to
+    fill a gap after a reconnect.
+    """
+
+    def __init__(self, dialogs=100, history=1000, latency=0.0, flood_every=0, flood_seconds=30):
+        self.dialogs = dialogs
+        self.history = history
+        self.latency = latency
+        self.flood_every = flood_every
+        self.flood_seconds = flood_seconds
+        self.calls = Counter()
+        self.sent = {}
+        self.handlers = []
+        self.flood_sleep_threshold = 0
+
+    def chat_ids(self):
+        return range(1000, 1000 + self.dialogs)
+
+    def user(self, user_id):
+        return User(id=user_id, access_hash=user_id * 31, first_name=f"User {user_id}", last_name=None,
+                    username=None, photo=None)
+
+    def message(self, chat_id, msg_id):
+        sender = SELF_ID if msg_id % 3 == 0 else chat_id
+        return Message(
+            id=msg_id,
+            peer_id=PeerUser(chat_id),
+            date=EPOCH + timedelta(minutes=msg_id),
+            message=f"Message {msg_id} in chat {chat_id}",
+            out=sender == SELF_ID,
+            from_id=PeerUser(sender)
+        )
+
+    async def _rpc(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.flood_every and sum(self.calls.values()) % self.flood_every == 0:
+            raise FloodWaitError(request=None, capture=self.flood_seconds)
+
+    async def connect(self):
+        pass
+
+    async def disconnect(self):
+        pass
+
+    async def is_user_authorized(self):
+        return True
+
+    def add_event_handler(self, callback, event=None):
+        self.handlers.append((callback, event))
+
+    async def get_dialogs(self, limit=None):
+        await self._rpc('GetDialogsRequest')
+        chat_ids = list(self.chat_ids())[:limit]
+        return [
+            SimpleNamespace(
+                entity=self.user(chat_id),
+                unread_count=chat_id % 5,
+                message=FakeDialogMessage(self.history, f"Message {self.history} in chat {chat_id}"),
+                date=EPOCH + timedelta(minutes=self.history) - timedelta(seconds=index)
+            )
+            for index, chat_id in enumerate(chat_ids)
+        ]
+
+    async def get_entity(self, peer):
+        await self._rpc('GetUsersRequest')
+        return self.user(peer if isinstance(peer, int) else utils.get_peer_id(peer))
+
+    async def emit(self, builder, event):
+        for callback, kind in self.handlers:
+            if type(kind) is builder:
+                await callback(event)
+
+    async def __call__(self, request):
+        if not isinstance(request, GetHistoryRequest):
+            raise NotImplementedError(type(request).__name__)
+        await self._rpc('GetHistoryRequest')
+        chat_id = utils.get_peer_id(request.peer)
+        return SimpleNamespace(
+            messages=[self.message(chat_id, msg_id) for msg_id in self.history_ids(request)],
+            users=[self.user(chat_id), self.user(SELF_ID)],
+            chats=[],
+            count=self.history
+        )
+
+    def history_ids(self, request):
+        """Message ids a GetHistoryRequest selects, newest first, as Telegram pages them"""
+        newest = self.history
+        start = newest if not request.offset_id else min(newest, request.offset_id - 1)
+        start -= request.add_offset or 0
+        start = min(start, newest)
+        ids = range(start, max(start - request.limit, 0), -1)
+        return [
+            msg_id for msg_id in ids
+            if msg_id > (request.min_id or 0) and (not request.max_id or msg_id < request.max_id)
+        ]
+
+    async def send_message(self, entity, text):
+        await self._rpc('SendMessageRequest')
+        msg_id = self.history + len(self.sent) + 1
+        chat_id = utils.get_peer_id(entity)
+        self.sent[msg_id] = (chat_id, text)
+        return Message(id=msg_id, peer_id=PeerUser(chat_id), date=datetime.now(timezone.utc),
+                       message=text, out=True, from_id=PeerUser(SELF_ID))
+
+    async def download_file(self, location, file=bytes, dc_id=None):
+        await self._rpc('GetFileRequest')
+        return f"photo {location.photo_id}".encode('utf-8')
+
+    async def download_profile_photo(self, entity, file=bytes):
+        await self._rpc('GetFileRequest')
+        return None
@@ -1,9 +1,23 @@
 """
 Tests for Telegram API
 """
+import asyncio
+import json
+import httpx
 import pytest
 from fastapi.testclient import TestClient
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, Mock
+from telegram_api import main
 from telegram_api.main import app
+from telegram_client import pool as pool_module
+from telegram_client.backfill import Backfill
+from telegram_client.chat_list import ChatListCache
+from telegram_client.client import TelegramConversationClient
+from telegram_client.models import dispose_engines
+from telegram_client.pool import Account, ClientPool
+from telegram_client.store import MessageStore
+from tests.fake_telegram import FakeTelegramClient
 
 client = TestClient(app)
 
@@ -12,6 +26,13 @@ def test_health_check():
     assert response.status_code == 200
     assert response.json() == {"status": "healthy"}
 
+def test_metrics_endpoint_reports_routes():
+    client.get("/health")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert 'tatargram_http_requests_total{method="GET",route="/health",status="200"}' in response.text
+    assert 'tatargram_websocket_connections 0' in response.text
+
 def test_get_chats_without_client():
     # This will test the error handling when client is not initialized
     response = client.get("/api/chats")
@@ -26,5 +47,226 @@ def test_send_message_without_client():
     response = client.post("/api/chats/123/messages", json={"text": "Hello"})
     assert response.status_code == 503
 
+def test_get_chats_conditional_get(monkeypatch):
+    sync = Mock()
+    sync.get_chats = AsyncMock(return_value=[{'chat_id': '1', 'name': 'John', 'unread_count': 0}])
+    account = SimpleNamespace(name='Telegram', client=Mock(), sync=sync, chat_list=ChatListCache(sync))
+    monkeypatch.setattr(main, "client_pool", ClientPool([account]))
+    
+    first = client.get("/api/chats")
+    assert first.status_code == 200
+    assert first.json() == {"chats": [{'chat_id': '1', 'name': 'John', 'unread_count': 0}]}
+    etag = first.headers["etag"]
+    
+    second = client.get("/api/chats", headers={"If-None-Match": etag})
+    assert second.status_code == 304
+    assert sync.get_chats.await_count == 1
+    
+    account.chat_list.apply_update({
+        'type': 'new_message',
+        'chat_id': '1',
+        'message': {'message_id': '5', 'text_content': 'Hi', 'created_at': None, 'from_me': False}
+    })
+    third = client.get("/api/chats", headers={"If-None-Match": etag})
+    assert third.status_code == 200
+    assert third.json()["chats"][0]["unread_count"] == 1
+
+def test_get_chats_fields_projection(monkeypatch):
+    sync = Mock()
+    sync.get_chats = AsyncMock(return_value=[
+        {'chat_id': '1', 'name': 'Әлфия', 'unread_count': 2, 'photo_url': None},
+        {'chat_id': '2', 'name': 'John', 'unread_count': 0, 'photo_url': None},
+    ])
+    account = SimpleNamespace(name='Telegram', client=Mock(), sync=sync, chat_list=ChatListCache(sync))
+    monkeypatch.setattr(main, "client_pool", ClientPool([account]))
+
+    full = client.get("/api/chats")
+    compact = client.get("/api/chats?fields=chat_id,name,missing")
+    assert compact.json() == {"chats": [{'chat_id': '1', 'name': 'Әлфия'}, {'chat_id': '2', 'name': 'John'}]}
+    assert compact.headers["etag"] != full.headers["etag"]
+    assert client.get("/api/chats?fields=chat_id,name,missing",
+                      headers={"If-None-Match": compact.headers["etag"]}).status_code == 304
+    # Request values never leak into the header: quotes and non-ASCII are hashed
+    odd = client.get("/api/chats", params={"fields": 'name,"имя"'}).headers["etag"]
+    assert odd.isascii() and odd.count('"') == 2
+    # The serialized snapshot is reused for every request
+    assert account.chat_list.render() is account.chat_list.render()
+
+def _account(name, chats, last_date, flood_wait=0):
+    sync = Mock()
+    sync.get_chats = AsyncMock(return_value=[
+        {'chat_id': chat_id, 'account_name': name, 'last_message_date': last_date + str(index)}
+        for index, chat_id in enumerate(chats)
+    ])
+    telegram_client = Mock()
+    telegram_client.flood_wait_remaining.return_value = flood_wait
+    return SimpleNamespace(name=name, client=telegram_client, sync=sync, chat_list=ChatListCache(sync))
+
+def test_account_scoped_routes_and_inbox(monkeypatch):
+    first = _account('ops1', ['1', '2'], '2023-01-01T10:00:0')
+    second = _account('ops2', ['3'], '2023-01-02T10:00:0')
+    throttled = _account('ops3', ['4'], '2023-01-03T10:00:0', flood_wait=120)
+    monkeypatch.setattr(main, "client_pool", ClientPool([first, second, throttled]))
+    
+    scoped = client.get("/api/accounts/ops2/chats")
+    assert [chat['chat_id'] for chat in scoped.json()["chats"]] == ['3']
+    assert client.get("/api/accounts/unknown/chats").status_code == 404
+    
+    inbox = client.get("/api/inbox").json()["chats"]
+    # ops3 is under FloodWait and has no snapshot yet, so it is skipped without a request
+    assert [chat['chat_id'] for chat in inbox] == ['3', '2', '1']
+    assert throttled.sync.get_chats.await_count == 0
+    
+    first_page = client.get("/api/inbox?limit=2").json()
+    assert [chat['chat_id'] for chat in first_page["chats"]] == ['3', '2']
+    second_page = client.get(f"/api/inbox?limit=2&cursor={first_page['next_cursor']}").json()
+    assert [chat['chat_id'] for chat in second_page["chats"]] == ['1']
+    assert second_page["next_cursor"] is None
+    assert client.get("/api/inbox?cursor=bogus").status_code == 400
+
+def test_search_rejects_bad_parameters(monkeypatch):
+    store = Mock()
+    store.search = AsyncMock(side_effect=ValueError("Invalid isoformat string: 'yesterday'"))
+    monkeypatch.setattr(main, "client_pool", ClientPool([SimpleNamespace(name='Telegram', store=store)]))
+    
+    assert client.get("/api/search?q=hi&limit=0").status_code == 422
+    assert client.get("/api/search?q=hi&limit=101").status_code == 422
+    assert store.search.await_count == 0
+    assert client.get("/api/search?q=hi&date_from=yesterday").status_code == 400
+
+def test_export_streams_ndjson_and_reports_resume_point(monkeypatch):
+    async def iter_history(chat_id, from_id):
+        for msg_id in (from_id + 1, from_id + 2):
+            yield {'message_id': str(msg_id), 'text_content': 'Сәлам'}
+        raise RuntimeError("FloodWait")
+
+    telegram_client = Mock()
+    telegram_client.iter_history = iter_history
+    account = SimpleNamespace(name='Telegram', client=telegram_client)
+    monkeypatch.setattr(main, "client_pool", ClientPool([account]))
+
+    response = client.get("/api/chats/123/export?from_id=10")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line.get('message_id') for line in lines[:2]] == ['11', '12']
+    assert lines[2] == {'error': 'FloodWait', 'from_id': 12}
+    assert client.get("/api/chats/123/export?source=ftp").status_code == 400
+
+@pytest.mark.asyncio
+async def test_cold_start_serves_store_while_connecting(tmp_path, monkeypatch):
+    store = MessageStore(f"sqlite:///{tmp_path / 'cold.db'}")
+    await store.init()
+    await store.save_chats([{'chat_id': '1000', 'user_id': '1000', 'name': 'Saved', 'type': 'user',
+                             'last_message_date': '2023-01-01T00:05:00+00:00'}])
+    await store.save_messages('1000', [{'message_id': '5', 'text_content': 'Сәлам',
+                                        'created_at': '2023-01-01T00:05:00+00:00'}])
+
+    fake = FakeTelegramClient(dialogs=1, history=10)
+    connecting = asyncio.Event()
+    fake.connect = connecting.wait
+    telegram_client = TelegramConversationClient(telegram_client=fake)
+    pool = ClientPool([Account('Telegram', telegram_client, store)])
+    await pool.start()
+    monkeypatch.setattr(main, "client_pool", pool)
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as http:
+            ready = await http.get("/health/ready")
+            assert ready.status_code == 200
+            assert ready.json()["accounts"][0]["telegram_connected"] is False
+
+            chats = await http.get("/api/chats")
+            assert [chat['name'] for chat in chats.json()["chats"]] == ['Saved']
+            messages = await http.get("/api/chats/1000/messages")
+            assert [m['message_id'] for m in messages.json()["messages"]] == ['5']
+            revalidated = await http.get("/api/chats/1000/messages",
+                                         headers={"If-None-Match": messages.headers["etag"]})
+            assert revalidated.status_code == 304
+            assert sum(fake.calls.values()) == 0
+
+            connecting.set()
+            await pool.wait_connected()
+            assert telegram_client.connected
+    finally:
+        await pool.stop()
+        await dispose_engines()
+
+@pytest.mark.asyncio
+async def test_backfill_runs_after_connect_and_reports_status(tmp_path, monkeypatch):
+    monkeypatch.setattr(pool_module, "BACKFILL_ENABLED", True)
+    store = MessageStore(f"sqlite:///{tmp_path / 'backfill.db'}")
+    telegram_client = TelegramConversationClient(telegram_client=FakeTelegramClient(dialogs=3, history=12))
+    account = Account('Telegram', telegram_client, store)
+    account.backfill = Backfill(telegram_client, store, requests_per_second=1000, batch_size=5)
+    pool = ClientPool([account])
+    await pool.start()
+    monkeypatch.setattr(main, "client_pool", pool)
+    try:
+        await pool.wait_connected()
+        await account.backfill._task
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as http:
+            status = (await http.get("/api/sync/status")).json()
+            assert status['running'] is False
+            assert status['chats_total'] == status['chats_done'] == 3
+            assert status['messages'] == 36
+            assert (await http.get("/api/accounts/Telegram/sync/status")).json()['chats_done'] == 3
+            assert (await http.get("/api/accounts/nobody/sync/status")).status_code == 404
+    finally:
+        await pool.stop()
+        await dispose_engines()
+
+async def _until(condition, timeout=2.0):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("condition not reached")
+
+@pytest.mark.asyncio
+async def test_account_authorized_after_start_keeps_chat_list_fresh(tmp_path, monkeypatch):
+    fake = FakeTelegramClient(dialogs=3, history=12)
+    fake.is_user_authorized = AsyncMock(return_value=False)
+    fake.send_code_request = AsyncMock()
+    fake.sign_in = AsyncMock()
+    telegram_client = TelegramConversationClient(telegram_client=fake)
+    store = MessageStore(f"sqlite:///{tmp_path / 'auth.db'}")
+    await store.init()
+    await store.save_chats([{'chat_id': '1000', 'user_id': '1000', 'name': 'Stale', 'type': 'user'}])
+    account = Account('Telegram', telegram_client, store)
+    pool = ClientPool([account])
+    await pool.start()
+    monkeypatch.setattr(main, "client_pool", pool)
+    try:
+        await pool.wait_connected()
+        # Nothing is asked from Telegram until the login code arrives
+        assert not telegram_client.connected
+        assert account.chat_list._task is None
+        assert sum(fake.calls.values()) == 0
+
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as http:
+            assert (await http.post("/api/auth/code", json={"code": "12345"})).status_code == 200
+        assert telegram_client.connected
+        # The snapshot served from the store is replaced by the dialogs from Telegram
+        await _until(lambda: fake.calls['GetDialogsRequest'] == 1)
+        await _until(lambda: len(account.chat_list.chats) == 3)
+
+        etag = account.chat_list.etag
+        await account.record_update({'type': 'message_edited', 'chat_id': '1000', 'message_id': '12',
+                                     'changes': {'text_content': 'Fixed', 'edited_at': None}})
+        assert [chat['last_message'] for chat in account.chat_list.chats if chat['chat_id'] == '1000'] == ['Fixed']
+        assert account.chat_list.etag != etag
+
+        # Deleting the last message needs the new preview from Telegram
+        await account.record_update({'type': 'message_deleted', 'chat_id': '1000', 'message_ids': ['12']})
+        await _until(lambda: fake.calls['GetDialogsRequest'] == 2)
+    finally:
+        await pool.stop()
+        await dispose_engines()
+
+def test_readiness_without_accounts():
+    response = client.get("/health/ready")
+    assert response.status_code == 503
+    assert client.get("/health/live").status_code == 200
+
 if __name__ == "__main__":
     pytest.main([__file__])
\ No newline at end of file
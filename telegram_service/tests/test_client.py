@@ -3,21 +3,29 @@ Tests for Telegram client
 """
 import pytest
 import asyncio
-from unittest.mock import Mock, patch
-from telegram_client.client import TelegramConversationClient
+from datetime import datetime, timezone
+from unittest.mock import Mock, AsyncMock, patch
+from telethon import TelegramClient
+from telethon.errors import FloodWaitError
+from telethon.sessions import StringSession
+from telethon.tl.functions.updates import GetDifferenceRequest
+from telethon.tl.types import User
+from telethon.tl.types.updates import DifferenceEmpty, DifferenceTooLong
+from telegram_client.client import InstrumentedTelegramClient, TelegramConversationClient, sender_cache
+from tests.fake_telegram import FakeTelegramClient
 
 @pytest.fixture
 def telegram_client():
-    with patch('telegram_client.client.TelegramClient') as mock_client:
-        client = TelegramConversationClient()
-        client.client = mock_client
-        yield client
+    client = TelegramConversationClient(telegram_client=AsyncMock())
+    client.client.get_entity.return_value = User(id=123, access_hash=42, first_name="Chat")
+    sender_cache.clear()
+    yield client
 
 @pytest.mark.asyncio
 async def test_get_chats(telegram_client):
     # Mock the get_dialogs method
     mock_dialog = Mock()
-    mock_entity = Mock()
+    mock_entity = Mock(spec=User)
     mock_entity.id = 123456789
     mock_entity.first_name = "John"
     mock_entity.last_name = "Doe"
@@ -39,10 +47,7 @@ async def test_get_chats(telegram_client):
 
 @pytest.mark.asyncio
 async def test_get_messages(telegram_client):
-    # Mock the get_entity and GetHistoryRequest
-    mock_entity = Mock()
-    telegram_client.client.get_entity.return_value = mock_entity
-    
+    # Mock GetHistoryRequest; the chat is resolved by the fixture's get_entity
     # Mock message
     mock_message = Mock()
     mock_message.id = 987654321
@@ -55,6 +60,8 @@ async def test_get_messages(telegram_client):
     # Mock GetHistoryRequest response
     mock_messages = Mock()
     mock_messages.messages = [mock_message]
+    mock_messages.users = []
+    mock_messages.chats = []
     telegram_client.client.return_value = mock_messages
     
     with patch('telegram_client.client.GetHistoryRequest') as mock_request:
@@ -70,5 +77,207 @@ async def test_get_messages(telegram_client):
         assert messages[0]['text_content'] == 'Test message'
         assert messages[0]['from_me'] == False
 
+@pytest.mark.asyncio
+async def test_get_messages_resolves_senders_from_history(telegram_client):
+    sender = User(id=555, first_name="Ivan", last_name="Petrov")
+    
+    history = Mock()
+    history.users = [sender]
+    history.chats = []
+    history.messages = []
+    for msg_id in range(1, 51):
+        msg = Mock()
+        msg.id = msg_id
+        msg.message = f"Message {msg_id}"
+        msg.date.isoformat.return_value = "2023-01-01T10:00:00Z"
+        msg.out = False
+        msg.media = None
+        msg.sender_id = 555 if msg_id % 2 else 777
+        history.messages.append(msg)
+    telegram_client.client.return_value = history
+    
+    messages = await telegram_client.get_messages('123456789')
+    
+    # Только разрешение самого чата, без запросов на каждого отправителя
+    assert telegram_client.client.get_entity.await_count == 1
+    assert len(messages) == 50
+    assert messages[0]['sender_name'] == 'Ivan Petrov'
+    assert messages[1]['sender_name'] == 'Пользователь 777'
+    assert sender_cache.get(555) == 'Ivan Petrov'
+
+def _history(ids):
+    history = Mock()
+    history.users = []
+    history.chats = []
+    history.messages = []
+    for msg_id in ids:
+        msg = Mock()
+        msg.id = msg_id
+        msg.message = f"Message {msg_id}"
+        msg.date.isoformat.return_value = f"2023-01-01T10:00:{msg_id % 60:02d}Z"
+        msg.out = True
+        msg.media = None
+        history.messages.append(msg)
+    return history
+
+@pytest.mark.asyncio
+async def test_get_messages_page_before_cursor(telegram_client):
+    telegram_client.client.return_value = _history([99, 98, 97])
+    
+    with patch('telegram_client.client.GetHistoryRequest') as mock_request:
+        page = await telegram_client.get_messages_page('123', limit=3, before_id=100)
+    
+    kwargs = mock_request.call_args.kwargs
+    assert kwargs['offset_id'] == 100
+    assert kwargs['min_id'] == 0
+    assert kwargs['add_offset'] == 0
+    assert page['next_cursor'] == '97'
+    assert page['prev_cursor'] == '99'
+
+@pytest.mark.asyncio
+async def test_get_messages_page_after_cursor(telegram_client):
+    telegram_client.client.return_value = _history([12, 11])
+    
+    with patch('telegram_client.client.GetHistoryRequest') as mock_request:
+        page = await telegram_client.get_messages_page('123', limit=5, after_id=10)
+    
+    kwargs = mock_request.call_args.kwargs
+    assert kwargs['offset_id'] == 11
+    assert kwargs['min_id'] == 10
+    assert kwargs['add_offset'] == -5
+    assert page['next_cursor'] is None
+    assert page['prev_cursor'] == '12'
+
+@pytest.mark.asyncio
+async def test_iter_history_walks_forward_in_batches(telegram_client):
+    second = _history([4, 3])
+    # 4 is a photo without a caption, 3 a service message (someone joined)
+    second.messages[0].message, second.messages[0].media = '', Mock()
+    second.messages[1].message = None
+    telegram_client.client.side_effect = [_history([2, 1]), second, _history([5])]
+    telegram_client.export_bucket = Mock(acquire=AsyncMock())
+    
+    with patch('telegram_client.client.GetHistoryRequest') as mock_request:
+        messages = [msg async for msg in telegram_client.iter_history('123', batch_size=2)]
+    
+    assert [msg['message_id'] for msg in messages] == ['1', '2', '4', '5']
+    assert messages[2]['message_type'] == 'media'
+    assert messages[2]['media_url'].endswith('/messages/123/4/media')
+    assert [call.kwargs['min_id'] for call in mock_request.call_args_list] == [0, 2, 4]
+
+@pytest.mark.asyncio
+async def test_update_handlers_emit_crm_deltas(telegram_client):
+    telegram_client.client.add_event_handler = Mock()
+    deltas = []
+    
+    async def callback(delta):
+        deltas.append(delta)
+    
+    telegram_client.add_update_handler(callback)
+    handlers = [call.args[0] for call in telegram_client.client.add_event_handler.call_args_list]
+    on_new, on_edit, on_delete = handlers
+    
+    message = _history([42]).messages[0]
+    message.sender = None
+    message.edit_date = None
+    await on_new(Mock(message=message, chat_id=-1000000001234))
+    message.message = "Edited"
+    message.edit_hide = False
+    message.edit_date = datetime(2023, 1, 2, tzinfo=timezone.utc)
+    await on_edit(Mock(message=message, chat_id=-1000000001234))
+    await on_delete(Mock(chat_id=None, deleted_ids=[7, 8]))
+    
+    assert deltas[0]['type'] == 'new_message'
+    assert deltas[0]['chat_id'] == '1234'
+    assert deltas[0]['message']['message_id'] == '42'
+    assert deltas[0]['message']['is_edit'] is False
+    # Edits carry only the fields an edit can change
+    assert deltas[1] == {'type': 'message_edited', 'chat_id': '1234', 'message_id': '42', 'changes': {
+        'text_content': 'Edited', 'message_type': 'text', 'media_url': None, 'is_edit': True,
+        'edited_at': '2023-01-02T00:00:00+00:00'
+    }}
+    assert deltas[2] == {'type': 'message_deleted', 'chat_id': None, 'message_ids': ['7', '8']}
+
+@pytest.mark.asyncio
+async def test_paging_against_fake_backend():
+    fake = FakeTelegramClient(dialogs=3, history=250)
+    client = TelegramConversationClient(telegram_client=fake)
+    client.export_bucket = Mock(acquire=AsyncMock())
+    
+    chats = await client.get_chats()
+    assert [chat['chat_id'] for chat in chats] == ['1000', '1001', '1002']
+    
+    latest = await client.get_messages_page('1000', limit=100)
+    assert [m['message_id'] for m in latest['messages']][-1] == '250'
+    older = await client.get_messages_page('1000', limit=100, before_id=latest['next_cursor'])
+    assert older['messages'][-1]['message_id'] == '150'
+    newer = await client.get_messages_page('1000', limit=100, after_id=200)
+    assert [m['message_id'] for m in newer['messages']] == [str(i) for i in range(201, 251)]
+    assert newer['messages'][1]['sender_name'] == 'User 1000'
+    
+    exported = [m['message_id'] async for m in client.iter_history('1000', from_id=20)]
+    assert exported == [str(i) for i in range(21, 251)]
+    # Chats seen in the dialog list are never resolved again
+    assert fake.calls['GetUsersRequest'] == 0
+
+@pytest.mark.asyncio
+async def test_peer_table_replaces_get_entity_round_trips():
+    fake = FakeTelegramClient(dialogs=3, history=10)
+    client = TelegramConversationClient(telegram_client=fake)
+    
+    await client.get_messages_page('5000', limit=5)
+    await client.get_messages_page('5000', limit=5)
+    assert fake.calls['GetUsersRequest'] == 1
+    
+    # A restarted client loaded from the peer table opens and answers chats straight away
+    restarted = TelegramConversationClient(telegram_client=fake)
+    restarted.peers.load([{'chat_id': '1001', 'peer_type': 'user', 'access_hash': 1001 * 31,
+                           'name': 'User 1001', 'username': None}])
+    page = await restarted.get_messages_page('1001', limit=5)
+    await restarted.send_text('1001', 'Hi')
+    assert [m['message_id'] for m in page['messages']] == ['6', '7', '8', '9', '10']
+    assert fake.calls['GetUsersRequest'] == 1
+    assert list(fake.sent.values()) == [(1001, 'Hi')]
+    
+    # Avatars are downloaded from the photo stored with the peer, without resolving the chat
+    restarted.peers.load([
+        {'chat_id': '1002', 'peer_type': 'user', 'access_hash': 1002 * 31, 'name': 'User 1002',
+         'username': None, 'photo_id': 77, 'photo_dc_id': 2},
+        # Saved before photos were stored: resolved once, then known to have no photo
+        {'chat_id': '1003', 'peer_type': 'user', 'access_hash': 1003 * 31, 'name': 'User 1003',
+         'username': None}
+    ])
+    assert await restarted.download_chat_photo('1002') == (b'photo 77', 'image/jpeg')
+    assert await restarted.download_chat_photo('1001') is None
+    assert fake.calls['GetUsersRequest'] == 1
+    assert await restarted.download_chat_photo('1003') is None
+    assert await restarted.download_chat_photo('1003') is None
+    assert fake.calls['GetUsersRequest'] == 2
+
+@pytest.mark.asyncio
+async def test_fake_backend_injects_flood_waits():
+    fake = FakeTelegramClient(dialogs=2, flood_every=2, flood_seconds=42)
+    client = TelegramConversationClient(telegram_client=fake)
+    
+    await client.get_chats()
+    with pytest.raises(FloodWaitError):
+        await client.get_chats()
+    assert 41 < client.flood_wait_remaining() <= 42
+    assert fake.calls['GetDialogsRequest'] == 2
+
 if __name__ == "__main__":
-    pytest.main([__file__])
\ No newline at end of file
+    pytest.main([__file__])
+@pytest.mark.asyncio
+async def test_gap_too_long_for_difference_is_reported(monkeypatch):
+    client = InstrumentedTelegramClient(StringSession(), 1, 'x')
+    assert client._catch_up is True
+    client.on_gap = Mock()
+    request = GetDifferenceRequest(pts=1, date=0, qts=0)
+
+    monkeypatch.setattr(TelegramClient, '_call', AsyncMock(return_value=DifferenceEmpty(date=None, seq=0)))
+    await client._call(None, request)
+    client.on_gap.assert_not_called()
+
+    monkeypatch.setattr(TelegramClient, '_call', AsyncMock(return_value=DifferenceTooLong(pts=5)))
+    assert await client._call(None, request) == DifferenceTooLong(pts=5)
+    client.on_gap.assert_called_once()
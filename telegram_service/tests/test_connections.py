@@ -0,0 +1,67 @@
+"""
+Tests for WebSocket fan-out
+"""
+import asyncio
+import json
+import pytest
+from telegram_api.connections import ConnectionManager, RESYNC_MESSAGE
+
+class FakeWebSocket:
+    def __init__(self, blocked=False):
+        self.sent = []
+        self.unblock = asyncio.Event()
+        if not blocked:
+            self.unblock.set()
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, message):
+        await self.unblock.wait()
+        self.sent.append(message)
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+@pytest.mark.asyncio
+async def test_slow_consumer_does_not_block_others():
+    manager = ConnectionManager(queue_size=3)
+    fast, slow = FakeWebSocket(), FakeWebSocket(blocked=True)
+    await manager.connect(fast)
+    await manager.connect(slow)
+    
+    for index in range(10):
+        await manager.broadcast({'type': 'new_message', 'n': index}, chat_id='1')
+        await _settle()
+    
+    assert [json.loads(m)['n'] for m in fast.sent] == list(range(10))
+    slow.unblock.set()
+    await _settle()
+    assert RESYNC_MESSAGE in slow.sent
+    assert len(slow.sent) < 10
+    
+    manager.disconnect(fast)
+    manager.disconnect(slow)
+
+@pytest.mark.asyncio
+async def test_chat_subscriptions():
+    manager = ConnectionManager()
+    everything, subscribed = FakeWebSocket(), FakeWebSocket()
+    await manager.connect(everything)
+    await manager.connect(subscribed)
+    await manager.handle_command(subscribed, json.dumps({'action': 'subscribe', 'chat_ids': ['2']}))
+    
+    await manager.broadcast({'chat_id': '1'}, chat_id='1')
+    await manager.broadcast({'chat_id': '2'}, chat_id='2')
+    await manager.broadcast({'chat_id': None})
+    await _settle()
+    
+    assert len(everything.sent) == 3
+    received = [json.loads(m) for m in subscribed.sent]
+    assert received[0] == {'type': 'subscriptions', 'chat_ids': ['2']}
+    assert received[1:] == [{'chat_id': '2'}, {'chat_id': None}]
+    
+    manager.disconnect(subscribed)
+    assert manager.chat_subscribers == {}
+    manager.disconnect(everything)
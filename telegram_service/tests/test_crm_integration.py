@@ -0,0 +1,94 @@
+"""
+Tests for the async CRM integration client
+"""
+import asyncio
+import pytest
+import pytest_asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from crm_integration_example import AsyncTelegramCRMIntegration
+from telegram_client.merge import iterate, merge_newest_first
+
+@pytest_asyncio.fixture
+async def service():
+    state = {'chat_requests': 0, 'not_modified': 0, 'in_flight': 0, 'max_in_flight': 0, 'ports': set()}
+
+    async def chats(request):
+        state['chat_requests'] += 1
+        if request.headers.get('If-None-Match') == '"v1"':
+            state['not_modified'] += 1
+            return web.Response(status=304, headers={'ETag': '"v1"'})
+        return web.json_response({'chats': [{'chat_id': '1', 'last_message_date': '2023-01-02'}]},
+                                 headers={'ETag': '"v1"'})
+
+    async def messages(request):
+        state['ports'].add(request.transport.get_extra_info('peername')[1])
+        state['in_flight'] += 1
+        state['max_in_flight'] = max(state['max_in_flight'], state['in_flight'])
+        await asyncio.sleep(0.02)
+        state['in_flight'] -= 1
+        chat_id = request.match_info['chat_id']
+        return web.json_response({'messages': [{'chat_id': chat_id}], 'totalCount': 1})
+
+    async def inbox(request):
+        state.setdefault('inbox_pages', 0)
+        state['inbox_pages'] += 1
+        chats = [{'chat_id': f't{i}', 'last_message_date': f'2023-01-01T10:{59 - i:02d}:00Z'} for i in range(60)]
+        # Paged like ClientPool.inbox
+        page = await merge_newest_first({'ops1': iterate(chats)}, limit=int(request.query['limit']),
+                                        cursor=request.query.get('cursor'))
+        return web.json_response({'chats': page['items'], 'next_cursor': page['next_cursor']})
+
+    app = web.Application()
+    app.router.add_get('/api/inbox', inbox)
+    app.router.add_get('/api/chats', chats)
+    app.router.add_get('/api/chats/{chat_id}/messages', messages)
+    server = TestServer(app)
+    await server.start_server()
+    yield str(server.make_url('')), state
+    await server.close()
+
+@pytest.mark.asyncio
+async def test_many_chats_fetched_concurrently_over_pooled_connections(service):
+    url, state = service
+    async with AsyncTelegramCRMIntegration(url, concurrency=4) as telegram_crm:
+        pages = await telegram_crm.get_messages_for_chats([str(i) for i in range(20)])
+
+    assert [page['messages'][0]['chat_id'] for page in pages.values()] == [str(i) for i in range(20)]
+    assert 1 < state['max_in_flight'] <= 4
+    # Keep-alive: 20 requests over at most 4 connections
+    assert len(state['ports']) <= 4
+
+@pytest.mark.asyncio
+async def test_chats_are_cached_and_revalidated(service):
+    url, state = service
+    async with AsyncTelegramCRMIntegration(url, cache_ttl=60) as telegram_crm:
+        first = await telegram_crm.get_telegram_chats()
+        assert await telegram_crm.get_telegram_chats() == first
+        assert state['chat_requests'] == 1
+
+        telegram_crm.cache_ttl = 0
+        merged = await telegram_crm.merge_with_crm_chats([{'chat_id': 'wa', 'last_message_date': '2023-01-01'}])
+        assert state['not_modified'] == 1
+        assert [chat['chat_id'] for chat in merged] == ['1', 'wa']
+
+@pytest.mark.asyncio
+async def test_merged_inbox_reads_one_page_per_screen(service):
+    url, state = service
+
+    async def whatsapp():
+        for i in range(1000):
+            yield {'chat_id': f'w{i}', 'last_message_date': f'2023-01-01T10:{58 - 2 * i:02d}:30Z' if i < 30 else None}
+
+    async with AsyncTelegramCRMIntegration(url, cache_ttl=0) as telegram_crm:
+        screen = await telegram_crm.merged_inbox({'whatsapp': whatsapp()}, limit=4)
+        assert [chat['chat_id'] for chat in screen['chats']] == ['t0', 'w0', 't1', 't2']
+        assert screen['chats'][0]['platform'] == 'telegram'
+        assert screen['next_cursor']
+        assert state['inbox_pages'] == 1
+
+        # Later screens resume the Telegram listing at the cursor time instead of re-reading it
+        for _ in range(3):
+            screen = await telegram_crm.merged_inbox({'whatsapp': whatsapp()}, limit=4, cursor=screen['next_cursor'])
+        assert [chat['chat_id'] for chat in screen['chats']] == ['t8', 'w4', 't9', 't10']
+        assert state['inbox_pages'] == 4
@@ -0,0 +1,83 @@
+"""
+Tests for the media cache
+"""
+import asyncio
+import io
+import threading
+import pytest
+from PIL import Image
+from telegram_client.media import MediaCache
+
+def _png(color, size=(640, 480)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_download_once(tmp_path):
+    cache = MediaCache(str(tmp_path))
+    calls = []
+    
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return _png('red'), 'image/png'
+    
+    entries = await asyncio.gather(*[cache.get_or_fetch('avatar:1:5', fetch) for _ in range(10)])
+    again = await cache.get_or_fetch('avatar:1:5', fetch)
+    
+    assert len(calls) == 1
+    assert {entry['digest'] for entry in entries} == {again['digest']}
+    assert again['mime_type'] == 'image/png'
+
+@pytest.mark.asyncio
+async def test_downloads_are_hashed_and_written_off_the_event_loop(tmp_path):
+    cache = MediaCache(str(tmp_path))
+    write_blob, threads = cache._write_blob, []
+    
+    def tracked(data):
+        threads.append(threading.get_ident())
+        return write_blob(data)
+    
+    cache._write_blob = tracked
+    
+    async def fetch():
+        return _png('red'), 'image/png'
+    
+    entry = await cache.get_or_fetch('media:1:1', fetch)
+    
+    assert threads and threads[0] != threading.get_ident()
+    assert cache.lookup('media:1:1')['digest'] == entry['digest']
+    assert not [path for path in tmp_path.joinpath('blobs').iterdir() if path.suffix == '.tmp']
+
+def test_identical_content_is_stored_once_and_evicted_by_size(tmp_path):
+    red, blue = _png('red'), _png('blue')
+    cache = MediaCache(str(tmp_path), max_bytes=len(red) + len(blue))
+    
+    first = cache.put('media:1:1', red, 'image/png')
+    second = cache.put('media:2:7', red, 'image/png')
+    assert first['digest'] == second['digest']
+    
+    cache.put('media:1:2', blue, 'image/png')
+    cache.lookup('media:1:1')
+    cache.put('media:1:3', _png('green'), 'image/png')
+    
+    # blue was the least recently used blob
+    assert cache.lookup('media:1:2') is None
+    assert cache.lookup('media:2:7') is not None
+
+@pytest.mark.asyncio
+async def test_thumbnail(tmp_path):
+    cache = MediaCache(str(tmp_path))
+    entry = cache.put('media:1:1', _png('red'), 'image/png')
+    try:
+        thumbs = await asyncio.gather(*[cache.thumbnail(entry, size=100) for _ in range(5)])
+    finally:
+        cache.close()
+    
+    thumb = thumbs[0]
+    assert {t['path'] for t in thumbs} == {thumb['path']}
+    with Image.open(thumb['path']) as image:
+        assert max(image.size) == 100
+    assert thumb['mime_type'] == 'image/jpeg'
+    assert not [path for path in tmp_path.joinpath('blobs').iterdir() if path.suffix == '.tmp']
@@ -0,0 +1,82 @@
+"""
+Tests for the lazy k-way inbox merge
+"""
+import pytest
+from telegram_client.merge import merge_newest_first, newest_first_key
+
+def _chats(prefix, minutes):
+    return [
+        {'chat_id': f'{prefix}{index}',
+         'last_message_date': f'2023-01-01T10:{minute:02d}:00Z' if minute is not None else None}
+        for index, minute in enumerate(minutes)
+    ]
+
+class Source:
+    """Sorted async source that records how many items were read"""
+
+    def __init__(self, items):
+        self.items = items
+        self.read = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.read >= len(self.items):
+            raise StopAsyncIteration
+        self.read += 1
+        return self.items[self.read - 1]
+
+def test_missing_dates_sort_last():
+    chats = _chats('t', [None, 5]) + [{'chat_id': 'w', 'last_message_date': '2023-01-01T13:00:00+03:00'}]
+    assert [chat['chat_id'] for chat in sorted(chats, key=newest_first_key)] == ['t1', 'w', 't0']
+
+@pytest.mark.asyncio
+async def test_first_screen_reads_only_what_it_needs():
+    telegram = Source(_chats('t', range(59, -1, -1)))
+    whatsapp = Source(_chats('w', range(58, -1, -2)))
+
+    page = await merge_newest_first({'telegram': telegram, 'whatsapp': whatsapp}, limit=6)
+
+    assert [chat['chat_id'] for chat in page['items']] == ['t0', 't1', 'w0', 't2', 't3', 'w1']
+    assert page['next_cursor']
+    assert telegram.read <= 5 and whatsapp.read <= 3
+
+@pytest.mark.asyncio
+async def test_cursor_pages_cover_everything_once():
+    telegram = _chats('t', [50, 40, 40, 10, None])
+    whatsapp = _chats('w', [45, 40, 5, None])
+    expected = [chat['chat_id'] for chat in sorted(
+        telegram + whatsapp,
+        key=lambda chat: newest_first_key(chat, 'telegram' if chat['chat_id'][0] == 't' else 'whatsapp')
+    )]
+
+    seen, cursor = [], None
+    while True:
+        page = await merge_newest_first({'telegram': Source(telegram), 'whatsapp': Source(whatsapp)},
+                                        limit=2, cursor=cursor)
+        seen.extend(chat['chat_id'] for chat in page['items'])
+        cursor = page['next_cursor']
+        if not cursor:
+            break
+
+    assert seen == expected
+    assert len(seen) == 9
+
+@pytest.mark.asyncio
+async def test_source_factories_receive_cursor_time():
+    calls = []
+
+    def factory(before):
+        calls.append(before)
+        return Source(_chats('t', [30, 20, 10]))
+
+    first = await merge_newest_first({'telegram': factory}, limit=1)
+    await merge_newest_first({'telegram': factory}, limit=1, cursor=first['next_cursor'])
+    assert calls[0] is None
+    assert calls[1] == newest_first_key(_chats('t', [30])[0])[0] * -1
+
+@pytest.mark.asyncio
+async def test_invalid_cursor():
+    with pytest.raises(ValueError):
+        await merge_newest_first({}, cursor='not-a-cursor')
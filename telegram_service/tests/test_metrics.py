@@ -0,0 +1,51 @@
+"""
+Tests for in-process metrics
+"""
+import pytest
+from unittest.mock import AsyncMock, patch
+from telethon.errors import FloodWaitError
+from telethon.sessions import MemorySession
+from telethon.tl.functions.messages import GetHistoryRequest
+from telegram_client import metrics
+from telegram_client.client import InstrumentedTelegramClient
+from telegram_client.metrics import Counter, Histogram
+
+def test_render_prometheus_text():
+    counter = Counter('requests_total', 'Requests', ('route',))
+    counter.inc('/api/chats')
+    counter.inc('/api/chats', amount=2)
+    histogram = Histogram('latency_seconds', 'Latency', ('route',), buckets=(0.1, 1))
+    histogram.observe('/a"b', value=0.05)
+    histogram.observe('/a"b', value=0.5)
+
+    text = '\n'.join(counter.render() + histogram.render())
+    assert '# TYPE requests_total counter' in text
+    assert 'requests_total{route="/api/chats"} 3' in text
+    assert 'latency_seconds_bucket{route="/a\\"b",le="0.1"} 1' in text
+    assert 'latency_seconds_bucket{route="/a\\"b",le="1"} 2' in text
+    assert 'latency_seconds_bucket{route="/a\\"b",le="+Inf"} 2' in text
+    assert 'latency_seconds_count{route="/a\\"b"} 2' in text
+
+@pytest.mark.asyncio
+async def test_rpc_calls_and_flood_waits_are_counted():
+    client = InstrumentedTelegramClient(MemorySession(), 1, 'hash', account_name='ops',
+                                        flood_sleep_threshold=5)
+    request = GetHistoryRequest(peer=None, offset_id=0, offset_date=None, add_offset=0,
+                                limit=1, max_id=0, min_id=0, hash=0)
+    before = metrics.FLOOD_WAITS.value('ops', 'GetHistoryRequest')
+    token = metrics.current_route.set('/api/chats/{chat_id}/messages')
+    short_wait = FloodWaitError(request=None, capture=2)
+    long_wait = FloodWaitError(request=None, capture=600)
+    try:
+        with patch('telethon.TelegramClient._call', AsyncMock(side_effect=[short_wait, 'ok', long_wait])), \
+                patch('telegram_client.client.asyncio.sleep', AsyncMock()) as sleep:
+            # A short FloodWait is slept through and retried, a long one is raised
+            assert await client._call(None, request) == 'ok'
+            sleep.assert_awaited_once_with(2)
+            with pytest.raises(FloodWaitError):
+                await client._call(None, request)
+    finally:
+        metrics.current_route.reset(token)
+
+    assert metrics.FLOOD_WAITS.value('ops', 'GetHistoryRequest') == before + 2
+    assert metrics.RPC_REQUESTS.value('ops', 'GetHistoryRequest', '/api/chats/{chat_id}/messages', 'ok') >= 1
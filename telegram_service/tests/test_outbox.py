@@ -0,0 +1,133 @@
+"""
+Tests for the outbound message queue
+"""
+import asyncio
+import pytest
+import pytest_asyncio
+from unittest.mock import AsyncMock, Mock
+from telethon.errors import FloodWaitError
+from telegram_client.client import TelegramConversationClient
+from telegram_client.models import dispose_engines, init_models
+from telegram_client.outbox import Outbox
+from telegram_client.pool import Account, ClientPool
+from telegram_client.store import MessageStore
+from tests.fake_telegram import FakeTelegramClient
+
+@pytest_asyncio.fixture
+async def database_url(tmp_path):
+    url = f"sqlite:///{tmp_path / 'outbox.db'}"
+    await init_models(url)
+    yield url
+    await dispose_engines()
+
+def _client(*results):
+    # Like the real client, a FloodWaitError is remembered until it expires
+    client = Mock()
+    client.flood_wait_remaining.return_value = 0
+    results = list(results)
+    
+    async def send_text(chat_id, text):
+        result = results.pop(0)
+        if isinstance(result, FloodWaitError):
+            client.flood_wait_remaining.return_value = result.seconds
+        if isinstance(result, Exception):
+            raise result
+        return result
+    
+    client.send_text = AsyncMock(side_effect=send_text)
+    client.publish_sent = AsyncMock()
+    return client
+
+@pytest.mark.asyncio
+async def test_flood_wait_pauses_whole_queue_and_keeps_order(database_url):
+    client = _client(
+        FloodWaitError(request=None, capture=30),
+        {'message_id': '101'}
+    )
+    outbox = Outbox(client, database_url)
+    first = await outbox.enqueue('1', 'first')
+    second = await outbox.enqueue('1', 'second')
+    other = await outbox.enqueue('2', 'other chat')
+    
+    assert await outbox.drain() == 30
+    
+    assert [call.args for call in client.send_text.await_args_list] == [('1', 'first')]
+    flooded = await outbox.get_job(first['job_id'])
+    assert flooded['status'] == 'queued'
+    assert flooded['attempts'] == 0
+    assert flooded['last_error'] == 'FloodWait 30 с'
+    assert (await outbox.get_job(second['job_id']))['status'] == 'queued'
+    assert (await outbox.get_job(other['job_id']))['status'] == 'queued'
+    
+    # Once the wait is over the other chat goes out; chat 1 waits for its own retry time
+    client.flood_wait_remaining.return_value = 0
+    await outbox.drain()
+    
+    sent = await outbox.get_job(other['job_id'])
+    assert sent['status'] == 'sent'
+    assert sent['message_id'] == '101'
+
+@pytest.mark.asyncio
+async def test_errors_are_retried_then_failed(database_url, monkeypatch):
+    monkeypatch.setattr('telegram_client.outbox.OUTBOX_MAX_ATTEMPTS', 2)
+    monkeypatch.setattr('telegram_client.outbox.OUTBOX_RETRY_BASE_SECONDS', 0)
+    client = _client(RuntimeError('boom'), RuntimeError('boom again'))
+    outbox = Outbox(client, database_url)
+    job = await outbox.enqueue('1', 'hello')
+    
+    await outbox.drain()
+    assert (await outbox.get_job(job['job_id']))['attempts'] == 1
+    await outbox.drain()
+    
+    failed = await outbox.get_job(job['job_id'])
+    assert failed['status'] == 'failed'
+    assert failed['attempts'] == 2
+    assert failed['last_error'] == 'boom again'
+
+@pytest.mark.asyncio
+async def test_backlog_of_one_chat_does_not_block_others(database_url, monkeypatch):
+    monkeypatch.setattr('telegram_client.outbox.OUTBOX_FETCH_SIZE', 3)
+    client = _client(RuntimeError('boom'), {'message_id': '201'})
+    outbox = Outbox(client, database_url)
+    for index in range(5):
+        await outbox.enqueue('1', f'backlog {index}')
+    other = await outbox.enqueue('2', 'other chat')
+    
+    await outbox.drain()
+    
+    assert [call.args for call in client.send_text.await_args_list] == [('1', 'backlog 0'), ('2', 'other chat')]
+    assert (await outbox.get_job(other['job_id']))['status'] == 'sent'
+
+@pytest.mark.asyncio
+async def test_sent_message_reaches_store_chat_list_and_subscribers(tmp_path):
+    store = MessageStore(f"sqlite:///{tmp_path / 'sent.db'}")
+    account = Account('Telegram', TelegramConversationClient(telegram_client=FakeTelegramClient(dialogs=2, history=5)),
+                      store)
+    broadcast = []
+    
+    async def update_handler(account, delta):
+        await account.record_update(delta)
+        broadcast.append(delta)
+    
+    pool = ClientPool([account])
+    await pool.start(update_handler)
+    try:
+        await pool.wait_connected()
+        await account.chat_list.get()
+        job = await account.outbox.enqueue('1001', 'Reply from the operator')
+        for _ in range(200):
+            if (await account.outbox.get_job(job['job_id']))['status'] == 'sent':
+                break
+            await asyncio.sleep(0.01)
+        
+        assert [(d['type'], d['message']['text_content']) for d in broadcast] == [
+            ('new_message', 'Reply from the operator')
+        ]
+        stored = await store.get_messages('1001', limit=10)
+        assert stored[-1]['message_id'] == '6'
+        assert stored[-1]['from_me'] is True
+        top = account.chat_list.chats[0]
+        assert (top['chat_id'], top['last_message']) == ('1001', 'Reply from the operator')
+    finally:
+        await pool.stop()
+        await dispose_engines()
@@ -0,0 +1,126 @@
+"""
+Tests for the connection owner and the worker-side proxies talking to it over a Unix socket
+"""
+import asyncio
+import httpx
+import pytest
+import pytest_asyncio
+from telegram_api import main
+from telegram_client.client import TelegramConversationClient
+from telegram_client.models import dispose_engines
+from telegram_client.pool import Account, ClientPool
+from telegram_client.rpc import OwnerServer, RemotePool
+from telegram_client.store import MessageStore
+from tests.fake_telegram import FakeTelegramClient
+
+async def _eventually(condition, timeout=2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline
+        await asyncio.sleep(0.01)
+
+@pytest_asyncio.fixture
+async def owner(tmp_path):
+    fake = FakeTelegramClient(dialogs=3, history=30)
+    store = MessageStore(f"sqlite:///{tmp_path / 'owner.db'}")
+    pool = ClientPool([Account('Telegram', TelegramConversationClient(telegram_client=fake), store)])
+    server = OwnerServer(pool, str(tmp_path / 'owner.sock'), status_interval=0.05, stream_batch=7)
+    await pool.start(server.handle_update)
+    await pool.wait_connected()
+    await server.start()
+    yield server
+    await server.stop()
+    await pool.stop()
+    await dispose_engines()
+
+@pytest_asyncio.fixture
+async def worker(owner):
+    updates = []
+
+    async def on_update(account, delta):
+        updates.append((account.name, delta))
+
+    pool = RemotePool(owner.path)
+    await asyncio.wait_for(pool.start(on_update), 2)
+    pool.updates = updates
+    yield pool
+    await pool.stop()
+
+@pytest.mark.asyncio
+async def test_worker_mirrors_owner_accounts_and_chat_list(owner, worker):
+    account = worker.get()
+    assert [a.name for a in worker] == ['Telegram']
+    assert account.ready and account.client.connected
+
+    chat_calls = []
+    chats_method = owner.methods['chats']
+
+    async def counted(peer, **params):
+        chat_calls.append(params)
+        return await chats_method(peer, **params)
+
+    owner.methods['chats'] = counted
+
+    chats, etag = await account.chat_list.get()
+    owner_chats, owner_etag = await owner.pool.get().chat_list.get()
+    assert chats == owner_chats and etag == owner_etag
+    await account.chat_list.get()
+    assert len(chat_calls) == 1
+
+    # A new message is recorded by the owner and fanned out; the worker applies it to its copy
+    # and ends up with the owner's ETag without transferring the list again
+    delta = {'type': 'new_message', 'chat_id': '1001', 'message': {
+        'message_id': '31', 'chat_id': '1001', 'text_content': 'Сәлам', 'from_me': False,
+        'created_at': '2023-01-02T00:00:00+00:00', 'message_type': 'text'
+    }}
+    await owner.handle_update(owner.pool.get(), delta)
+    await _eventually(lambda: worker.updates)
+    assert worker.updates[0][1]['message']['message_id'] == '31'
+    await account.record_update(worker.updates[0][1])
+
+    chats, etag = await account.chat_list.get()
+    assert chats[0]['chat_id'] == '1001' and chats[0]['last_message'] == 'Сәлам'
+    assert etag == owner.pool.get().chat_list.etag
+    assert len(chat_calls) == 1
+
+@pytest.mark.asyncio
+async def test_worker_calls_and_streams_through_owner(owner, worker):
+    account = worker.get()
+    page = await account.sync.get_messages_page('1000', 10)
+    assert [m['message_id'] for m in page['messages']] == [str(i) for i in range(21, 31)]
+
+    exported = [m['message_id'] async for m in account.client.iter_history('1000')]
+    assert exported == [str(i) for i in range(1, 31)]
+    stored = [m['message_id'] async for m in account.store.iter_messages('1000', from_id=25)]
+    assert stored == ['26', '27', '28', '29', '30']
+
+    job = await account.outbox.enqueue('1000', 'Hi')
+    assert (await account.outbox.get_job(job['job_id']))['job_id'] == job['job_id']
+
+    page, etag = await worker.inbox(limit=2)
+    assert len(page['chats']) == 2 and page['next_cursor'] and etag
+    with pytest.raises(ValueError):
+        await worker.inbox(cursor='bogus')
+
+@pytest.mark.asyncio
+async def test_api_worker_serves_through_owner(owner, worker, monkeypatch):
+    monkeypatch.setattr(main, "client_pool", worker)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as http:
+        chats = await http.get("/api/chats")
+        assert chats.status_code == 200
+        assert len(chats.json()["chats"]) == 3
+        revalidated = await http.get("/api/chats", headers={"If-None-Match": chats.headers["etag"]})
+        assert revalidated.status_code == 304
+
+        export = await http.get("/api/chats/1000/export")
+        assert len(export.text.splitlines()) == 30
+        assert (await http.get("/health/ready")).status_code == 200
+
+@pytest.mark.asyncio
+async def test_worker_notices_owner_going_away(owner, worker):
+    account = worker.get()
+    await owner.stop()
+    await _eventually(lambda: not account.ready)
+    assert not account.client.connected
+    with pytest.raises(ConnectionError):
+        await account.sync.get_messages_page('1000', 10)
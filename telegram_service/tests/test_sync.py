@@ -0,0 +1,362 @@
+"""
+Tests for the local message store and sync layer
+"""
+import pytest
+import pytest_asyncio
+from sqlalchemy import create_engine, text
+from unittest.mock import AsyncMock
+from types import SimpleNamespace
+from telethon import events
+from telethon.tl.types import Channel, InputPeerChannel, InputPeerUser, User
+from telegram_client.backfill import Backfill
+from telegram_client.client import TelegramConversationClient
+from telegram_client.models import dispose_engines
+from telegram_client.peers import PeerCache
+from telegram_client.pool import Account, ClientPool
+from telegram_client.search import create_search_index
+from telegram_client.store import MessageStore, message_to_row
+from telegram_client.sync import ConversationSync
+from tests.fake_telegram import FakeTelegramClient
+
+def _message(chat_id, msg_id):
+    return {
+        'id': str(msg_id),
+        'message_id': str(msg_id),
+        'chat_id': str(chat_id),
+        'from_me': False,
+        'created_at': f"2023-01-01T10:{msg_id // 60 % 60:02d}:{msg_id % 60:02d}+00:00",
+        'message_type': 'text',
+        'text_content': f"Message {msg_id}",
+        'media_url': None,
+        'is_read': True,
+        'is_delivered': True,
+        'sender_name': 'Ivan',
+        'is_edit': False,
+        'is_deleted': False
+    }
+
+def _page(chat_id, ids, next_cursor=None):
+    return {
+        'messages': [_message(chat_id, msg_id) for msg_id in sorted(ids)],
+        'next_cursor': next_cursor,
+        'prev_cursor': str(max(ids)) if ids else None
+    }
+
+@pytest_asyncio.fixture
+async def store(tmp_path):
+    store = MessageStore(f"sqlite:///{tmp_path / 'store.db'}")
+    await store.init()
+    yield store
+    await dispose_engines()
+
+@pytest.mark.asyncio
+async def test_store_roundtrip(store):
+    await store.save_messages('1', [_message('1', msg_id) for msg_id in (5, 10, 7)])
+    await store.save_messages('1', [dict(_message('1', 7), text_content='Edited')])
+
+    messages = await store.get_messages('1', limit=10)
+    assert [m['message_id'] for m in messages] == ['5', '7', '10']
+    assert messages[1]['text_content'] == 'Edited'
+    assert messages[0]['created_at'] == '2023-01-01T10:00:05+00:00'
+    assert await store.max_message_id('1') == 10
+    assert [m['message_id'] for m in await store.get_messages('1', limit=10, before_id=10)] == ['5', '7']
+
+@pytest.mark.asyncio
+async def test_partial_upsert_keeps_other_columns_and_chats(store):
+    await store.save_messages('1', [_message('1', 5)])
+    await store.save_messages('2', [_message('2', 5)])
+    await store.save_messages('1', [
+        {'message_id': '5', 'is_read': False},
+        dict(_message('1', 6), text_content='Full row in the same call')
+    ])
+
+    stored = (await store.get_messages('1', limit=10))[0]
+    assert stored['is_read'] is False
+    assert stored['text_content'] == 'Message 5'
+    assert stored['created_at'] == '2023-01-01T10:00:05+00:00'
+    assert (await store.get_messages('2', limit=10))[0]['is_read'] is True
+
+    await store.save_chats([{'chat_id': '1', 'user_id': '1', 'name': 'Ivan', 'type': 'user', 'unread_count': 3}])
+    await store.save_chats([{'chat_id': '1', 'user_id': '1', 'unread_count': 0}])
+    chat = (await store.get_chats())[0]
+    assert (chat['name'], chat['type'], chat['unread_count']) == ('Ivan', 'user', 0)
+
+@pytest.mark.asyncio
+async def test_in_memory_database_url_is_supported():
+    store = MessageStore('sqlite:///:memory:')
+    try:
+        await store.init()
+        await store.save_messages('1', [_message('1', 1)])
+        assert await store.max_message_id('1') == 1
+    finally:
+        await dispose_engines()
+
+@pytest.mark.asyncio
+async def test_repeat_open_served_from_store(store):
+    client = AsyncMock()
+    client.get_chats.return_value = [{'chat_id': '1', 'user_id': '1', 'type': 'user', 'last_message_id': 3}]
+    client.get_messages_page.return_value = _page('1', [1, 2, 3])
+    sync = ConversationSync(client, store)
+
+    await sync.get_chats()
+    first = await sync.get_messages_page('1', limit=50)
+    second = await sync.get_messages_page('1', limit=50)
+
+    assert client.get_messages_page.await_count == 1
+    assert first == second
+    assert [m['message_id'] for m in second['messages']] == ['1', '2', '3']
+    assert second['next_cursor'] is None
+
+@pytest.mark.asyncio
+async def test_only_delta_is_fetched(store):
+    await store.save_messages('1', [_message('1', msg_id) for msg_id in (1, 2, 3)])
+    client = AsyncMock()
+    client.get_chats.return_value = [{'chat_id': '1', 'user_id': '1', 'type': 'user', 'last_message_id': 5}]
+    client.get_messages_page.side_effect = [_page('1', [4, 5]), _page('1', [])]
+    sync = ConversationSync(client, store)
+
+    await sync.get_chats()
+    page = await sync.get_messages_page('1', limit=5)
+
+    assert client.get_messages_page.await_args_list[0].kwargs['after_id'] == 3
+    assert [m['message_id'] for m in page['messages']] == ['1', '2', '3', '4', '5']
+
+@pytest.mark.asyncio
+async def test_bulk_ingest_upserts_in_batches(store):
+    store.ingest.batch_size = 1000
+    rows = [message_to_row('1', _message('1', msg_id)) for msg_id in range(1, 2501)]
+
+    stats = await store.ingest.upsert_messages(rows)
+    assert stats['rows'] == 2500
+    assert stats['batches'] == 3
+    assert stats['rows_per_second'] > 0
+
+    rows[0]['text_content'] = 'Updated'
+    await store.ingest.upsert_messages(rows[:1])
+    messages = await store.get_messages('1', limit=2500)
+    assert len(messages) == 2500
+    assert messages[0]['text_content'] == 'Updated'
+
+@pytest.mark.asyncio
+async def test_store_iter_messages_resumes_from_id(store):
+    await store.save_messages('1', [_message('1', msg_id) for msg_id in range(1, 12)])
+    await store.save_messages('2', [_message('2', 50)])
+
+    ids = [msg['message_id'] async for msg in store.iter_messages('1', from_id=3, batch_size=4)]
+    assert ids == [str(msg_id) for msg_id in range(4, 12)]
+
+@pytest.mark.asyncio
+async def test_search_ranked_paged_and_filtered(store):
+    texts = {
+        1: 'Привет, как дела?',
+        2: 'Сәлам! Привет привет всем',
+        3: 'Отчет за неделю',
+        4: 'привет из другого чата',
+    }
+    await store.save_messages('1', [dict(_message('1', i), text_content=texts[i]) for i in (1, 2, 3)])
+    await store.save_messages('2', [dict(_message('2', 4), text_content=texts[4])])
+
+    first = await store.search('привет', limit=2)
+    assert len(first['results']) == 2
+    assert first['results'][0]['message_id'] == '2'
+    assert '<b>Привет</b>' in first['results'][0]['snippet']
+    second = await store.search('привет', limit=2, cursor=first['next_cursor'])
+    assert len(second['results']) == 1
+    assert second['next_cursor'] is None
+
+    in_chat = await store.search('прив', chat_id='2')
+    assert [r['message_id'] for r in in_chat['results']] == ['4']
+    assert (await store.search('сәлам'))['results'][0]['message_id'] == '2'
+
+    # Updates through the bulk upsert keep the index current
+    await store.save_messages('1', [dict(_message('1', 3), text_content='Привет, отчет готов')])
+    assert len((await store.search('привет'))['results']) == 4
+
+    # Stored text is escaped, only the match markers are HTML
+    await store.save_messages('2', [dict(_message('2', 5), text_content='<script>x</script> привет')])
+    snippet = (await store.search('script'))['results'][0]['snippet']
+    assert snippet.startswith('&lt;<b>script</b>&gt;x&lt;/')
+    with pytest.raises(ValueError):
+        await store.search('привет', cursor='abc')
+    with pytest.raises(ValueError):
+        await store.search('привет', date_from='yesterday')
+
+@pytest.mark.asyncio
+async def test_peer_table_survives_restart(store):
+    peers = PeerCache(flush_interval=3600)
+    peers.start(store.save_peers)
+    peers.remember([
+        User(id=10, access_hash=-77, first_name='Ivan', username='ivan'),
+        User(id=11, access_hash=5, first_name='Min', min=True),
+        Channel(id=20, access_hash=99, title='News', photo=None, date=None)
+    ])
+    await peers.stop()
+
+    restarted = PeerCache()
+    restarted.load(await store.get_peers())
+    assert len(restarted) == 2
+    assert restarted.input_peer('10') == InputPeerUser(10, -77)
+    assert restarted.input_peer(20) == InputPeerChannel(20, 99)
+    assert restarted.input_peer('11') is None
+    assert restarted.name('10') == 'Ivan'
+
+@pytest.mark.asyncio
+async def test_backfill_checkpoints_and_resumes(store):
+    # Chat 1000 was interrupted after its newest 15 messages; 1001 has not started
+    await store.save_checkpoint({'chat_id': '1000', 'oldest_id': 11, 'messages': 15, 'total': 25,
+                                 'done': False, 'last_error': None})
+    fake = FakeTelegramClient(dialogs=2, history=25, flood_every=4, flood_seconds=0)
+    backfill = Backfill(TelegramConversationClient(telegram_client=fake), store,
+                        concurrency=2, requests_per_second=1000, batch_size=10)
+    await backfill.run(['1000', '1001'])
+
+    assert [m['message_id'] async for m in store.iter_messages('1000')] == [str(i) for i in range(1, 11)]
+    assert [m['message_id'] async for m in store.iter_messages('1001')] == [str(i) for i in range(1, 26)]
+    status = await backfill.status()
+    assert status['chats_total'] == status['chats_done'] == 2
+    assert status['messages'] == 35
+    # FloodWaits are retried, not counted as progress
+    assert status['requests'] > 4
+    assert {chat['chat_id']: chat['messages'] for chat in status['chats']} == {'1000': 25, '1001': 25}
+    assert all(chat['progress'] == 1.0 for chat in status['chats'])
+
+    # Finished chats are not fetched again after a restart
+    calls = sum(fake.calls.values())
+    await Backfill(TelegramConversationClient(telegram_client=fake), store).run(['1000', '1001'])
+    assert sum(fake.calls.values()) == calls
+
+@pytest.mark.asyncio
+async def test_updates_replayed_after_reconnect_are_applied_once(store):
+    fake = FakeTelegramClient(dialogs=2, history=30)
+    deltas = []
+
+    async def on_update(account, delta):
+        deltas.append(delta)
+        await account.record_update(delta)
+
+    pool = ClientPool([Account('Telegram', TelegramConversationClient(telegram_client=fake), store)])
+    await pool.start(on_update)
+    await pool.wait_connected()
+    account = pool.get()
+    try:
+        chats, _ = await account.chat_list.get()
+        unread = chats[0]['unread_count']
+
+        live = SimpleNamespace(message=fake.message(1000, 31), chat_id=1000)
+        await fake.emit(events.NewMessage, live)
+        # After a reconnect Telethon fills the gap through the same handlers,
+        # including message 31 that had already arrived live
+        await fake.emit(events.NewMessage, live)
+        await fake.emit(events.NewMessage, SimpleNamespace(message=fake.message(1000, 32), chat_id=1000))
+        await fake.emit(events.MessageDeleted, SimpleNamespace(chat_id=None, deleted_ids=[31]))
+        await fake.emit(events.MessageDeleted, SimpleNamespace(chat_id=None, deleted_ids=[31]))
+
+        assert [(d['type'], d.get('message', {}).get('message_id')) for d in deltas] == [
+            ('new_message', '31'), ('new_message', '32'), ('message_deleted', None)
+        ]
+        assert [m['message_id'] async for m in store.iter_messages('1000', from_id=30)] == ['31', '32']
+        chats, _ = await account.chat_list.get()
+        assert chats[0]['chat_id'] == '1000' and chats[0]['unread_count'] == unread + 2
+
+        # A gap too long for getDifference asks subscribers to reload
+        account.client._on_gap()
+        await account.client._gap_task
+        assert deltas[-1] == {'type': 'resync', 'chat_id': None}
+    finally:
+        await pool.stop()
+
+@pytest.mark.asyncio
+async def test_edits_and_deletes_patch_store_and_chat_list(store):
+    await store.save_messages('1000', [_message('1000', msg_id) for msg_id in (1, 2, 3)])
+    await store.save_messages('1001', [_message('1001', 4)])
+    await store.save_messages('3000', [_message('3000', 4)])
+    await store.save_peers([{'chat_id': '3000', 'peer_type': 'channel', 'access_hash': 1, 'name': 'News',
+                             'username': None}])
+    account = Account('Telegram', TelegramConversationClient(telegram_client=FakeTelegramClient()), store)
+    account.chat_list.seed([
+        {'chat_id': '1000', 'last_message_id': 3, 'last_message': 'Message 3'},
+        {'chat_id': '1001', 'last_message_id': 9, 'last_message': 'Message 9'}
+    ])
+    etag = account.chat_list.etag
+
+    await account.record_update({'type': 'message_edited', 'chat_id': '1000', 'message_id': '3', 'changes': {
+        'text_content': 'Fixed typo', 'message_type': 'text', 'media_url': None, 'is_edit': True,
+        'edited_at': '2023-01-02T00:00:00+00:00'
+    }})
+    edited = (await store.get_messages('1000', limit=5))[-1]
+    assert edited['text_content'] == 'Fixed typo' and edited['is_edit'] is True
+    assert edited['edited_at'] == '2023-01-02T00:00:00+00:00'
+    assert (await store.search('typo'))['results'][0]['message_id'] == '3'
+    # The preview is patched in place instead of reloading the chat list
+    assert account.chat_list.chats[0]['last_message'] == 'Fixed typo'
+    assert account.chat_list.etag != etag and not account.chat_list._stale.is_set()
+
+    # Telegram does not say which private chat a deletion belongs to; channels are not searched
+    delta = {'type': 'message_deleted', 'chat_id': None, 'message_ids': ['4']}
+    await account.record_update(delta)
+    assert delta['chat_id'] == '1001'
+    assert (await store.get_messages('1001', limit=5))[0]['is_deleted'] is True
+    assert (await store.get_messages('3000', limit=5))[0]['is_deleted'] is False
+    assert not account.chat_list._stale.is_set()
+
+    # Deleting the last message leaves a tombstone and needs a fresh preview from Telegram
+    await account.record_update({'type': 'message_deleted', 'chat_id': '1000', 'message_ids': ['3']})
+    assert [m['is_deleted'] for m in await store.get_messages('1000', limit=5)] == [False, False, True]
+    assert (await store.search('typo'))['results'] == []
+    assert account.chat_list._stale.is_set()
+
+    # Edits of messages that were never stored are left to the history sync
+    assert await store.apply_edit('1000', 99, {'text_content': 'Later'}) is False
+
+OLD_MESSAGES_TABLE = """
+CREATE TABLE telegram_messages (
+    id INTEGER NOT NULL, message_id VARCHAR(50) NOT NULL, chat_id VARCHAR(50) NOT NULL,
+    from_me BOOLEAN, created_at DATETIME, message_type VARCHAR(20), text_content TEXT,
+    media_url VARCHAR(512), is_read BOOLEAN, is_delivered BOOLEAN, sender_name VARCHAR(255),
+    is_edit BOOLEAN, is_deleted BOOLEAN, updated_at DATETIME,
+    PRIMARY KEY (id), UNIQUE (message_id)
+)
+"""
+
+@pytest.mark.asyncio
+async def test_old_message_table_is_migrated_to_chat_scoped_key(tmp_path):
+    path = tmp_path / 'old.db'
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.begin() as conn:
+        conn.execute(text(OLD_MESSAGES_TABLE))
+        for msg_id in (9, 10, 11):
+            conn.execute(text(
+                "INSERT INTO telegram_messages (message_id, chat_id, text_content, created_at) "
+                "VALUES (:id, '1', :text, '2023-01-01 10:00:00')"
+            ), {'id': str(msg_id), 'text': f"Сәлам {msg_id}"})
+        create_search_index(conn)
+    engine.dispose()
+
+    store = MessageStore(f"sqlite:///{path}")
+    await store.init()
+    try:
+        # Ids are compared as numbers now (9 < 10), and another chat may reuse a message id
+        assert [m['message_id'] for m in await store.get_messages('1', limit=2)] == ['10', '11']
+        await store.save_messages('2', [_message('2', 10)])
+        assert [m['chat_id'] for m in await store.get_messages('2', limit=5)] == ['2']
+        assert len(await store.get_messages('1', limit=5)) == 3
+        assert (await store.search('сәлам', chat_id='1'))['results'][0]['message_id'] in ('9', '10', '11')
+        assert (await store.search('Message'))['results'][0]['chat_id'] == '2'
+
+        async with store.ingest.engine.connect() as conn:
+            plan = ' '.join(row[-1] for row in await conn.execute(text(
+                "EXPLAIN QUERY PLAN SELECT * FROM telegram_messages "
+                "WHERE chat_id = '1' AND message_id < 11 ORDER BY message_id DESC LIMIT 2"
+            )))
+        # A range scan of the (chat_id, message_id) key, already in page order
+        assert 'USING INDEX' in plan and '(chat_id=? AND message_id<?)' in plan
+        assert 'TEMP B-TREE' not in plan
+
+        # Columns added to the model later are added to existing tables
+        async with store.ingest.engine.begin() as conn:
+            await conn.execute(text("ALTER TABLE telegram_messages DROP COLUMN edited_at"))
+        await store.init()
+        assert (await store.get_messages('1', limit=1))[0]['edited_at'] is None
+    finally:
+        await dispose_engines()
+